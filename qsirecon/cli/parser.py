@@ -188,6 +188,14 @@ def _build_parser(**kwargs):
         type=PositiveInt,
         help="Maximum number of threads per-process",
     )
+    g_perfm.add_argument(
+        "--n-shards",
+        "--n_shards",
+        action="store",
+        type=PositiveInt,
+        help="Split the participants into this many groups, each built and run by its own "
+        "process with an equal share of --nprocs and --mem",
+    )
     g_perfm.add_argument(
         "--mem",
         "--mem_mb",
@@ -203,6 +211,16 @@ def _build_parser(**kwargs):
         action="store_true",
         help="Attempt to reduce memory usage (will increase disk usage in working directory)",
     )
+    g_perfm.add_argument(
+        "--compression-level",
+        "--compression_level",
+        action="store",
+        type=int,
+        choices=range(1, 10),
+        metavar="[1-9]",
+        help="gzip compression level of the compressed NIfTI outputs: 1 is fastest, "
+        "9 gives the smallest files (default: 9)",
+    )
     g_perfm.add_argument(
         "--use-plugin",
         "--nipype-plugin-file",
@@ -3,21 +3,23 @@ import os
 import sys
 import warnings
 from argparse import ArgumentParser, RawTextHelpFormatter
+from concurrent.futures import ProcessPoolExecutor
 
 import nibabel as nb
 import numpy as np
-from dipy.core.ndindex import ndindex
 from dipy.core.sphere import HemiSphere
-from dipy.direction import peak_directions
 from dipy.reconst.odf import gfa
 from fury import actor, window
 from nipype import logging
 from PIL import Image
 
+from ..utils.peaks import batch_peak_directions
 from ..viz.utils import slices_from_bbox
 from qsirecon.interfaces.converters import fib2amps, mif2amps
 
 LOGGER = logging.getLogger("nipype.interface")
+DEFAULT_TILE_SIZE = 1200
+SLOPPY_TILE_SIZE = 300
 
 warnings.filterwarnings("ignore", category=ImportWarning)
 warnings.filterwarnings("ignore", category=PendingDeprecationWarning)
@@ -99,10 +101,22 @@ def recon_plot():
     parser.add_argument("--peaks_only", action="store_true", help="only plot the peaks")
     parser.add_argument("--ncuts", type=int, default=3, help="number of slices to plot")
     parser.add_argument("--padding", type=int, default=10, help="number of slices to plot")
+    parser.add_argument(
+        "--nthreads",
+        type=int,
+        default=1,
+        help="number of threads used to find peaks and processes used to render tiles",
+    )
+    parser.add_argument(
+        "--tile_size", type=int, help="width and height in pixels of each rendered slice"
+    )
+    parser.add_argument(
+        "--sloppy", action="store_true", help="render small tiles to minimize run time"
+    )
     opts = parser.parse_args()
 
     if opts.mif:
-        odf_img, directions = mif2amps(opts.mif, os.getcwd())
+        odf_img, directions = mif2amps(opts.mif)
         LOGGER.info("converting %s to plot ODF/peaks", opts.mif)
     elif opts.fib:
         odf_img, directions = fib2amps(opts.fib, opts.background_image, os.getcwd())
@@ -118,10 +132,14 @@ def recon_plot():
     else:
         raise Exception("Requires either a mif file or fib file")
 
-    odf_4d = odf_img.get_fdata()
+    if opts.tile_size is None:
+        opts.tile_size = SLOPPY_TILE_SIZE if opts.sloppy else DEFAULT_TILE_SIZE
+
+    # Slices are read from the image as they are plotted, never the whole volume at once
+    odf_4d = odf_img.dataobj
     sphere = HemiSphere(xyz=directions.astype(float))
     if not opts.background_image:
-        background_data = odf_4d.mean(3)
+        background_data = mean_amplitude(odf_4d)
     else:
         background_data = nb.load(opts.background_image).get_fdata()
 
@@ -134,6 +152,8 @@ def recon_plot():
         n_cuts=opts.ncuts,
         mask_image=opts.mask_file,
         padding=opts.padding,
+        tile_size=opts.tile_size,
+        n_threads=opts.nthreads,
     )
 
     # Plot ODFs in interesting regions
@@ -145,12 +165,32 @@ def recon_plot():
             background_data,
             opts.odfs_image,
             opts.odf_rois,
+            tile_size=opts.tile_size,
             subtract_iso=opts.subtract_iso,
-            mask=opts.mask_file,
+            n_procs=opts.nthreads,
         )
     sys.exit(0)
 
 
+def take_slice(odf_4d, slicenum, axis):
+    """Read a single slice of 4D amplitudes as float32, keeping a length-1 ``axis``.
+
+    ``odf_4d`` can be an array or an image's data proxy, in which case only
+    the slice is read from disk.
+    """
+    index = [slice(None)] * 4
+    index[axis] = slice(slicenum, slicenum + 1)
+    return np.asarray(odf_4d[tuple(index)], dtype="float32")
+
+
+def mean_amplitude(odf_4d):
+    """Average the amplitudes of each voxel, reading one axial slice at a time."""
+    mean_data = np.zeros(odf_4d.shape[:3], dtype="float32")
+    for slicenum in range(odf_4d.shape[2]):
+        mean_data[:, :, slicenum] = take_slice(odf_4d, slicenum, 2).mean(3)[:, :, 0]
+    return mean_data
+
+
 def plot_peak_slice(
     odf_4d,
     sphere,
@@ -161,43 +201,40 @@ def plot_peak_slice(
     mask_data,
     tile_size=1200,
     normalize_peaks=True,
+    peaks=None,
 ):
+    image_slice = np.take(background_data, [slicenum], axis=axis)
+
+    # Find the actual peaks, unless they were already computed for the whole volume
+    if peaks is None:
+        peak_dirs, peak_values = peaks_from_odfs(
+            take_slice(odf_4d, slicenum, axis),
+            sphere,
+            relative_peak_threshold=0.1,
+            min_separation_angle=15,
+            mask=np.take(mask_data, [slicenum], axis=axis),
+            normalize_peaks=normalize_peaks,
+            npeaks=3,
+        )
+    else:
+        peak_dirs, peak_values = [np.take(peak_data, [slicenum], axis=axis) for peak_data in peaks]
+
+    tile = render_peak_tile(peak_dirs, peak_values, image_slice, axis, tile_size, normalize_peaks)
+    if out_file is not None:
+        Image.fromarray(tile).save(out_file)
+    return tile
+
+
+def render_peak_tile(peak_dirs, peak_values, image_slice, axis, tile_size, normalize_peaks=True):
+    """Render the peaks of a single slice offscreen and return the RGB tile."""
     view_up = [(0.0, 0.0, 1.0), (0.0, 0.0, 1.0), (0.0, -1.0, 0.0)]
 
-    # Make a slice mask to reduce memory
-    new_shape = list(odf_4d.shape)
-    new_shape[axis] = 1
-    image_shape = new_shape[:3]
+    new_shape = image_slice.shape
     midpoint = (new_shape[0] / 2.0, new_shape[1] / 2.0, new_shape[2] / 2.0)
-
-    if axis == 0:
-        odf_slice = odf_4d[slicenum, :, :, :].reshape(new_shape)
-        image_slice = background_data[slicenum, :, :].reshape(image_shape)
-        mask_slice = mask_data[slicenum, :, :].reshape(image_shape)
-        camera_dist = max(midpoint[1], midpoint[2]) * np.pi
-    elif axis == 1:
-        odf_slice = odf_4d[:, slicenum, :, :].reshape(new_shape)
-        image_slice = background_data[:, slicenum, :].reshape(image_shape)
-        mask_slice = mask_data[:, slicenum, :].reshape(image_shape)
-        camera_dist = max(midpoint[0], midpoint[2]) * np.pi
-    elif axis == 2:
-        odf_slice = odf_4d[:, :, slicenum, :].reshape(new_shape)
-        image_slice = background_data[:, :, slicenum].reshape(image_shape)
-        mask_slice = mask_data[:, :, slicenum].reshape(image_shape)
-        camera_dist = max(midpoint[0], midpoint[1]) * np.pi
+    camera_dist = max(midpoint[dim] for dim in range(3) if dim != axis) * np.pi
     position = list(midpoint)
     position[axis] += camera_dist
 
-    # Find the actual peaks
-    peak_dirs, peak_values = peaks_from_odfs(
-        odf_slice,
-        sphere,
-        relative_peak_threshold=0.1,
-        min_separation_angle=15,
-        mask=mask_slice,
-        normalize_peaks=normalize_peaks,
-        npeaks=3,
-    )
     if normalize_peaks:
         peak_values = peak_values / peak_values.max() * np.pi
     peak_actor = actor.peak_slicer(peak_dirs, peak_values, colors=None)
@@ -213,7 +250,22 @@ def plot_peak_slice(
     peak_actor.display_extent(xfov_min, xfov_max, yfov_min, yfov_max, zfov_min, zfov_max)
     image_actor.display_extent(xfov_min, xfov_max, yfov_min, yfov_max, zfov_min, zfov_max)
     scene.set_camera(focal_point=tuple(midpoint), position=tuple(position), view_up=view_up[axis])
-    window.record(scene, out_path=out_file, reset_camera=False, size=image_size)
+    tile = window.snapshot(scene, size=image_size, offscreen=True)
+    scene.clear()
+    return np.ascontiguousarray(tile[..., :3])
+
+
+def render_tiles(render_function, tile_args, n_procs=1):
+    """Render a list of tiles, using worker processes if ``n_procs > 1``.
+
+    Each VTK render is single threaded, so independent tiles are rendered
+    in separate processes. Only the inputs of each tile are sent to the workers
+    and the rendered tiles come back as arrays.
+    """
+    if n_procs > 1 and len(tile_args) > 1:
+        with ProcessPoolExecutor(max_workers=min(n_procs, len(tile_args))) as executor:
+            return list(executor.map(render_function, *zip(*tile_args)))
+    return [render_function(*args) for args in tile_args]
 
 
 def peak_slice_series(
@@ -227,6 +279,7 @@ def peak_slice_series(
     n_cuts=3,
     padding=4,
     normalize_peaks=True,
+    n_threads=1,
 ):
 
     # Make a slice mask to reduce memory
@@ -238,62 +291,41 @@ def peak_slice_series(
 
     slice_indices = slices_from_bbox(background_data, cuts=n_cuts, padding=padding)
     LOGGER.info("Plotting slice indices %s", slice_indices)
-    # Render the axial slices
-    z_image = Image.new("RGB", (tile_size, tile_size * n_cuts))
-    for slicenum, z_slice in enumerate(slice_indices["z"]):
-        png_file = "{}_tra_{:03d}.png".format(prefix, z_slice)
-        plot_peak_slice(
-            odf_4d,
-            sphere,
-            background_data,
-            png_file,
-            2,
-            z_slice,
-            image_mask,
-            tile_size,
-            normalize_peaks,
-        )
-        z_image.paste(Image.open(png_file), (0, slicenum * tile_size))
 
-    # Render the sagittal slices
-    x_image = Image.new("RGB", (tile_size, tile_size * n_cuts))
-    for slicenum, x_slice in enumerate(slice_indices["x"]):
-        png_file = "{}_sag_{:03d}.png".format(prefix, x_slice)
-        plot_peak_slice(
-            odf_4d,
-            sphere,
-            background_data,
-            png_file,
-            0,
-            x_slice,
-            image_mask,
-            tile_size,
-            normalize_peaks,
-        )
-        x_image.paste(Image.open(png_file), (0, slicenum * tile_size))
+    # Read the plotted slices and find the peaks of all their masked voxels at once
+    plotted_slices = []
+    slice_odfs = []
+    for axis, axis_name in [(2, "z"), (0, "x"), (1, "y")]:
+        for slicenum in slice_indices[axis_name]:
+            slice_mask = np.take(image_mask, [slicenum], axis=axis) != 0
+            slice_odfs.append(take_slice(odf_4d, slicenum, axis)[slice_mask])
+            plotted_slices.append((axis, slicenum, slice_mask))
+    all_dirs, all_values = peaks_from_odfs(
+        np.concatenate(slice_odfs),
+        sphere,
+        relative_peak_threshold=0.1,
+        min_separation_angle=15,
+        normalize_peaks=normalize_peaks,
+        npeaks=3,
+        n_threads=n_threads,
+    )
 
-    # Render the coronal slices
-    y_image = Image.new("RGB", (tile_size, tile_size * n_cuts))
-    for slicenum, y_slice in enumerate(slice_indices["y"]):
-        png_file = "{}_cor_{:03d}.png".format(prefix, y_slice)
-        plot_peak_slice(
-            odf_4d,
-            sphere,
-            background_data,
-            png_file,
-            1,
-            y_slice,
-            image_mask,
-            tile_size,
-            normalize_peaks,
-        )
-        y_image.paste(Image.open(png_file), (0, slicenum * tile_size))
+    # Render the axial, sagittal and coronal slices as the columns of the mosaic
+    tile_args = []
+    start = 0
+    for axis, slicenum, slice_mask in plotted_slices:
+        stop = start + int(slice_mask.sum())
+        peak_dirs = np.zeros(slice_mask.shape + all_dirs.shape[1:])
+        peak_dirs[slice_mask] = all_dirs[start:stop]
+        peak_values = np.zeros(slice_mask.shape + all_values.shape[1:])
+        peak_values[slice_mask] = all_values[start:stop]
+        start = stop
+        image_slice = np.take(background_data, [slicenum], axis=axis)
+        tile_args.append((peak_dirs, peak_values, image_slice, axis, tile_size, normalize_peaks))
+    tiles = render_tiles(render_peak_tile, tile_args, n_procs=n_threads)
 
-    final_image = Image.new("RGB", (tile_size * 3, tile_size * n_cuts))
-    final_image.paste(z_image, (0, 0))
-    final_image.paste(x_image, (tile_size, 0))
-    final_image.paste(y_image, (tile_size * 2, 0))
-    final_image.save(out_file)
+    columns = [np.vstack(tiles[start : start + n_cuts]) for start in range(0, len(tiles), n_cuts)]
+    Image.fromarray(np.hstack(columns)).save(out_file)
 
 
 def peaks_from_odfs(
@@ -305,6 +337,7 @@ def peaks_from_odfs(
     gfa_thr=0,
     normalize_peaks=False,
     npeaks=5,
+    n_threads=1,
 ):
 
     shape = odf4d.shape[:-1]
@@ -314,41 +347,33 @@ def peaks_from_odfs(
         if mask.shape != shape:
             raise ValueError("Mask is not the same shape as data.")
 
-    gfa_array = np.zeros(shape)
-    qa_array = np.zeros((shape + (npeaks,)))
-
     peak_dirs = np.zeros((shape + (npeaks, 3)))
     peak_values = np.zeros((shape + (npeaks,)))
-    peak_indices = np.zeros((shape + (npeaks,)), dtype="int")
-    peak_indices.fill(-1)
-
-    global_max = -np.inf
-    for idx in ndindex(shape):
-        if not mask[idx]:
-            continue
-        odf = odf4d[idx]
-        gfa_array[idx] = gfa(odf)
-        if gfa_array[idx] < gfa_thr:
-            global_max = max(global_max, odf.max())
-            continue
-        # Get peaks of odf
-        direction, pk, ind = peak_directions(
-            odf, sphere, relative_peak_threshold, min_separation_angle
-        )
-        # Calculate peak metrics
-        if pk.shape[0] != 0:
-            global_max = max(global_max, pk[0])
-            n = min(npeaks, pk.shape[0])
-            qa_array[idx][:n] = pk[:n] - odf.min()
-            peak_dirs[idx][:n] = direction[:n]
-            peak_indices[idx][:n] = ind[:n]
-            peak_values[idx][:n] = pk[:n]
 
-            if normalize_peaks:
-                peak_values[idx][:n] /= pk[0]
-                peak_dirs[idx] *= peak_values[idx][:, None]
+    # Only process the ODFs in the mask that pass the GFA threshold
+    odfs = odf4d[mask != 0]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        gfa_values = gfa(odfs)
+    process = ~(gfa_values < gfa_thr)
 
-    qa_array /= global_max
+    values, indices = batch_peak_directions(
+        odfs[process],
+        sphere,
+        num_peaks=npeaks,
+        relative_peak_threshold=relative_peak_threshold,
+        min_separation_angle=min_separation_angle,
+        n_threads=n_threads,
+    )
+    directions = sphere.vertices[indices] * (indices >= 0)[..., np.newaxis]
+    if normalize_peaks:
+        values = np.divide(
+            values, values[:, :1], out=np.zeros_like(values), where=values[:, :1] != 0
+        )
+        directions *= values[..., np.newaxis]
+
+    voxels = tuple(index[process] for index in np.nonzero(mask))
+    peak_dirs[voxels] = directions
+    peak_values[voxels] = values
 
     return peak_dirs, peak_values
 
@@ -375,11 +400,30 @@ def plot_an_odf_slice(
     axis,
     camera_distance,
     subtract_iso,
-    mask_image,
 ):
-    view_up = [(0.0, 0.0, 1.0), (0.0, 0.0, 1.0), (0.0, -1.0, 0.0)]
+    tile = render_odf_tile(
+        *odf_slice_tile_args(
+            odf_4d,
+            full_sphere,
+            background_data,
+            tile_size,
+            centroid,
+            axis,
+            camera_distance,
+            subtract_iso,
+        )
+    )
+    if filename is not None:
+        Image.fromarray(tile).save(filename)
+    return tile
+
 
+def odf_slice_tile_args(
+    odf_4d, full_sphere, background_data, tile_size, centroid, axis, camera_distance, subtract_iso
+):
+    """Extract the data and camera needed to render the ODFs of a single slice."""
     # Adjust the centroid so it's only a single slice
+    centroid = np.array(centroid, dtype=float)
     slicenum = int(np.round(centroid)[axis])
     centroid[axis] = 0
     position = centroid.copy()
@@ -389,24 +433,22 @@ def plot_an_odf_slice(
     roll = 3 if axis == 2 else 0
     position[1] = position[1] - roll
 
-    # Ensure the dimensions reflect that there is only one slice
-    new_shape = list(odf_4d.shape)
-    new_shape[axis] = 1
-    image_shape = new_shape[:3]
-    if axis == 0:
-        odf_slice = odf_4d[slicenum, :, :, :].reshape(new_shape)
-        image_slice = background_data[slicenum, :, :].reshape(image_shape)
-    elif axis == 1:
-        odf_slice = odf_4d[:, slicenum, :, :].reshape(new_shape)
-        image_slice = background_data[:, slicenum, :].reshape(image_shape)
-    elif axis == 2:
-        odf_slice = odf_4d[:, :, slicenum, :].reshape(new_shape)
-        image_slice = background_data[:, :, slicenum].reshape(image_shape)
+    # Keep a single slice, with the dimensions reflecting that there is only one
+    odf_slice = take_slice(odf_4d, slicenum, axis)
+    image_slice = np.take(background_data, [slicenum], axis=axis)
 
     # Tile to get the whole ODF
     odf_slice = np.tile(odf_slice, (1, 1, 1, 2))
     if subtract_iso:
         odf_slice = odf_slice - odf_slice.min(3, keepdims=True)
+    return odf_slice, full_sphere, image_slice, centroid, position, axis, tile_size
+
+
+def render_odf_tile(odf_slice, full_sphere, image_slice, centroid, position, axis, tile_size):
+    """Render the ODFs of a single slice offscreen and return the RGB tile."""
+    view_up = [(0.0, 0.0, 1.0), (0.0, 0.0, 1.0), (0.0, -1.0, 0.0)]
+
+    new_shape = image_slice.shape
     # Make graphics objects
     odf_actor = actor.odf_slicer(
         odf_slice, sphere=full_sphere, colormap=None, scale=0.6, mask=image_slice
@@ -422,8 +464,9 @@ def plot_an_odf_slice(
     odf_actor.display_extent(xfov_min, xfov_max, yfov_min, yfov_max, zfov_min, zfov_max)
     image_actor.display_extent(xfov_min, xfov_max, yfov_min, yfov_max, zfov_min, zfov_max)
     scene.set_camera(focal_point=tuple(centroid), position=tuple(position), view_up=view_up[axis])
-    window.record(scene, out_path=filename, reset_camera=False, size=image_size)
+    tile = window.snapshot(scene, size=image_size, offscreen=True)
     scene.clear()
+    return np.ascontiguousarray(tile[..., :3])
 
 
 def odf_roi_plot(
@@ -435,69 +478,33 @@ def odf_roi_plot(
     prefix="odf",
     tile_size=1200,
     subtract_iso=False,
-    mask=None,
+    n_procs=1,
 ):
 
     roi_data = nb.load(roi_file).get_fdata()
-    roi_image = Image.new("RGB", (tile_size * 3, tile_size))
     roi1_centroid, roi1_distance = get_camera_for_roi(roi_data, 1, 2)
     roi2_centroid, roi2_distance = get_camera_for_roi(roi_data, 2, 1)
     roi3_centroid, roi3_distance = get_camera_for_roi(roi_data, 3, 1)
 
     camera_distance = max(roi1_distance, roi2_distance, roi3_distance)
-    # Make a slice mask to reduce memory
-    if mask is None:
-        image_mask = np.ones(roi_data.shape)
-    else:
-        image_mask = nb.load(mask).get_fdata()
 
     # Fill out the other half of the sphere
     odf_sphere = halfsphere.mirror()
-    semiovale_axial_file = "{}_semoivale_axial.png".format(prefix)
-    plot_an_odf_slice(
-        odf_4d,
-        odf_sphere,
-        background_data,
-        tile_size,
-        semiovale_axial_file,
-        centroid=roi1_centroid,
-        axis=2,
-        camera_distance=camera_distance,
-        subtract_iso=subtract_iso,
-        mask_image=image_mask,
-    )
-    roi_image.paste(Image.open(semiovale_axial_file), (0, 0))
-
-    # Render the coronal slice with a double-crossing
-    cst_x_cc_file = "{}_CSTxCC.png".format(prefix)
-    plot_an_odf_slice(
-        odf_4d,
-        odf_sphere,
-        background_data,
-        tile_size,
-        cst_x_cc_file,
-        centroid=roi2_centroid,
-        axis=1,
-        camera_distance=camera_distance,
-        subtract_iso=subtract_iso,
-        mask_image=image_mask,
-    )
-    roi_image.paste(Image.open(cst_x_cc_file), (tile_size, 0))
 
-    # Render the corpus callosum
-    cc_file = "{}_CC.png".format(prefix)
-    plot_an_odf_slice(
-        odf_4d,
-        odf_sphere,
-        background_data,
-        tile_size,
-        cc_file,
-        centroid=roi3_centroid,
-        axis=1,
-        camera_distance=camera_distance,
-        subtract_iso=subtract_iso,
-        mask_image=image_mask,
-    )
-    roi_image.paste(Image.open(cc_file), (2 * tile_size, 0))
-
-    roi_image.save(out_file)
+    # Render the semiovale axial slice, the coronal slice with a double-crossing
+    # and the corpus callosum side by side
+    tile_args = [
+        odf_slice_tile_args(
+            odf_4d,
+            odf_sphere,
+            background_data,
+            tile_size,
+            centroid=centroid,
+            axis=axis,
+            camera_distance=camera_distance,
+            subtract_iso=subtract_iso,
+        )
+        for centroid, axis in [(roi1_centroid, 2), (roi2_centroid, 1), (roi3_centroid, 1)]
+    ]
+    tiles = render_tiles(render_odf_tile, tile_args, n_procs=n_procs)
+    Image.fromarray(np.hstack(tiles)).save(out_file)
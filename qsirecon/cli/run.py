@@ -62,6 +62,17 @@ def main():
     config_file.parent.mkdir(exist_ok=True, parents=True)
     config.to_filename(config_file)
 
+    # With several shards, each one builds and runs its own workflow. The workflow of
+    # all the participants is still built here, to check the dependencies and write
+    # the boilerplate, but it is not run.
+    shard_configs = []
+    if config.nipype.n_shards > 1 and "pdb" not in config.execution.debug:
+        from .shards import write_shard_configs
+
+        shard_configs = write_shard_configs(config_file, config.nipype.n_shards)
+        if len(shard_configs) == 1:
+            shard_configs = []
+
     # CRITICAL Call build_workflow(config_file, retval) in a subprocess.
     # Because Python on Linux does not ever free virtual memory (VM), running the
     # workflow construction jailed within a process preempts excessive VM buildup.
@@ -127,7 +138,19 @@ def main():
     config.loggers.workflow.log(25, "QSIRecon started!")
     errno = 1  # Default is error exit unless otherwise set
     try:
-        qsirecon_wf.run(**config.nipype.get_plugin())
+        if shard_configs:
+            from .shards import run_shards
+
+            n_failed = run_shards(
+                shard_configs,
+                config.execution.log_dir / f"shards_{config.execution.run_uuid}.json",
+            )
+            if n_failed:
+                raise RuntimeError(
+                    f"{n_failed} of {len(shard_configs)} shards did not execute cleanly"
+                )
+        else:
+            qsirecon_wf.run(**config.nipype.get_plugin())
     except Exception as e:
         if not config.execution.notrack:
             from ..utils.sentry import process_crashfile
@@ -146,6 +169,18 @@ def main():
         raise
     else:
         config.loggers.workflow.log(25, "QSIRecon finished successfully!")
+        if config.nipype.resource_monitor:
+            if shard_configs:
+                from .shards import merge_resource_monitor_files
+
+                resource_monitor_file = merge_resource_monitor_files(
+                    shard_configs, config_file.parent / "resource_monitor.json"
+                )
+            else:
+                resource_monitor_file = (
+                    config.execution.work_dir / qsirecon_wf.name / "resource_monitor.json"
+                )
+            _calibrate_memory_models(resource_monitor_file)
         if sentry_sdk is not None:
             success_message = "QSIRecon finished without errors"
             sentry_sdk.add_breadcrumb(message=success_message, level="info")
@@ -227,3 +262,29 @@ def main():
             print(failed_reports)
 
         sys.exit(int(errno + len(failed_reports)) > 0)
+
+
+def _calibrate_memory_models(resource_monitor_file):
+    """Refit the node memory estimates to the peaks recorded during this run."""
+    import json
+
+    from ..utils.memory import (
+        MEMORY_FEATURES_FILE,
+        MEMORY_MODEL_FILE,
+        calibrate_memory_models,
+        load_memory_models,
+    )
+
+    work_dir = config.execution.work_dir
+    features_file = work_dir / MEMORY_FEATURES_FILE
+    if not (resource_monitor_file and resource_monitor_file.exists() and features_file.exists()):
+        return
+
+    model_file = work_dir / MEMORY_MODEL_FILE
+    calibrated = calibrate_memory_models(
+        resource_monitor_file, features_file, models=load_memory_models(model_file)
+    )
+    if model_file.exists():
+        calibrated = {**json.loads(model_file.read_text()), **calibrated}
+    model_file.write_text(json.dumps(calibrated, indent=1, sort_keys=True))
+    config.loggers.workflow.info("Calibrated memory estimates written to %s", model_file)
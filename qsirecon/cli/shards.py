@@ -0,0 +1,223 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Running the participants in independent shards
+^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^
+
+With ``--n-shards``, the participants are split into groups. Each group
+is built and run by its own process, with its own scheduler and an equal share
+of the CPUs and memory. This keeps any single graph, and the scheduler walking it,
+small. The shards share the working directory, where each one runs a workflow
+with a name of its own.
+
+"""
+import json
+import os
+from pathlib import Path
+from queue import Empty
+from time import strftime
+
+
+def shard_participants(participant_label, n_shards):
+    """Split the participants into at most ``n_shards`` groups of similar size."""
+    shards = [participant_label[i_shard::n_shards] for i_shard in range(n_shards)]
+    return [shard for shard in shards if shard]
+
+
+def write_shard_configs(config_file, n_shards):
+    """Write one configuration file per shard, with its participants and resources.
+
+    Parameters
+    ----------
+    config_file : :obj:`pathlib.Path`
+        The configuration file of the whole run.
+    n_shards : :obj:`int`
+        Maximum number of shards.
+
+    Returns
+    -------
+    shards : :obj:`list` of :obj:`tuple`
+        The configuration file and the participants of each shard.
+    """
+    from .. import config
+
+    config.load(config_file)
+    participant_label = list(config.execution.participant_label)
+    nprocs = config.nipype.nprocs
+    omp_nthreads = config.nipype.omp_nthreads
+    memory_gb = config.nipype.memory_gb
+    shards = shard_participants(participant_label, min(n_shards, nprocs))
+
+    shard_configs = []
+    for i_shard, shard in enumerate(shards):
+        config.execution.participant_label = shard
+        config.nipype.n_shards = 1
+        config.nipype.shard_index = i_shard
+        config.nipype.nprocs = max(1, nprocs // len(shards))
+        config.nipype.omp_nthreads = min(omp_nthreads, config.nipype.nprocs)
+        if memory_gb:
+            config.nipype.memory_gb = memory_gb / len(shards)
+
+        shard_config_file = config_file.parent / f"shard-{i_shard:03d}" / "config.toml"
+        shard_config_file.parent.mkdir(exist_ok=True, parents=True)
+        config.to_filename(shard_config_file)
+        shard_configs.append((shard_config_file, shard))
+
+    # Restore the settings of the whole run
+    config.nipype.shard_index = None
+    config.load(config_file)
+    return shard_configs
+
+
+def shard_resource_monitor_file(shard_config_file):
+    """Get the file where the resource monitor of a shard writes its summary."""
+    return Path(shard_config_file).parent / "resource_monitor.json"
+
+
+def merge_resource_monitor_files(shard_configs, out_file):
+    """Concatenate the resource monitor summaries of the shards into a single file.
+
+    Each shard writes its summary next to its configuration file, so the summaries
+    of a run can be found from :func:`write_shard_configs`'s output alone.
+
+    Parameters
+    ----------
+    shard_configs : :obj:`list` of :obj:`tuple`
+        The output of :func:`write_shard_configs`.
+    out_file : :obj:`pathlib.Path`
+        The merged ``resource_monitor.json`` file.
+
+    Returns
+    -------
+    out_file : :obj:`pathlib.Path` or None
+        The merged file, or None if no shard wrote a summary.
+    """
+    merged = {}
+    for shard_config_file, _ in shard_configs:
+        summary_file = shard_resource_monitor_file(shard_config_file)
+        if not summary_file.exists():
+            continue
+        with open(summary_file) as fobj:
+            summary = json.load(fobj)
+        for column, values in summary.items():
+            merged.setdefault(column, []).extend(values)
+
+    if not merged:
+        return None
+    _write_summary(merged, out_file)
+    return out_file
+
+
+def run_shard(shard_config_file, i_shard, status_queue):
+    """Build and run the workflow of one shard, reporting its progress."""
+    from nipype import config as ncfg
+
+    from .. import config
+    from .workflow import build_workflow
+
+    status_queue.put((i_shard, "building", None))
+    try:
+        retval = build_workflow(str(shard_config_file), {})
+    except Exception as e:
+        status_queue.put((i_shard, "failed", f"Building the workflow failed: {e}"))
+        raise
+    qsirecon_wf = retval.get("workflow")
+    if retval.get("return_code", 1) or qsirecon_wf is None:
+        status_queue.put(
+            (i_shard, "failed", f"Building the workflow failed ({retval.get('return_code')})")
+        )
+        raise SystemExit(retval.get("return_code") or 1)
+
+    config.load(shard_config_file)
+    if config.nipype.resource_monitor:
+        ncfg.set("monitoring", "summary_file", str(shard_resource_monitor_file(shard_config_file)))
+    status_queue.put((i_shard, "running", None))
+    try:
+        qsirecon_wf.run(**config.nipype.get_plugin())
+    except Exception as e:
+        status_queue.put((i_shard, "failed", str(e)))
+        raise
+    status_queue.put((i_shard, "finished", None))
+
+
+def _write_summary(summary, summary_file):
+    tmp_file = f"{summary_file}.tmp"
+    with open(tmp_file, "w") as fobj:
+        json.dump(summary, fobj, indent=2)
+    os.replace(tmp_file, summary_file)
+
+
+def run_shards(shard_configs, summary_file):
+    """Run every shard in its own process and keep a summary of their status.
+
+    Parameters
+    ----------
+    shard_configs : :obj:`list` of :obj:`tuple`
+        The output of :func:`write_shard_configs`.
+    summary_file : :obj:`pathlib.Path`
+        JSON file that is updated every time a shard changes status.
+
+    Returns
+    -------
+    n_failed : :obj:`int`
+        The number of shards that did not finish cleanly.
+    """
+    from multiprocessing import Manager, Process
+
+    from .. import config
+
+    summary = {
+        "shards": [
+            {
+                "config_file": str(shard_config_file),
+                "participant_label": participant_label,
+                "status": "pending",
+                "updated": strftime("%Y-%m-%d %H:%M:%S"),
+            }
+            for shard_config_file, participant_label in shard_configs
+        ]
+    }
+
+    with Manager() as mgr:
+        status_queue = mgr.Queue()
+        processes = [
+            Process(target=run_shard, args=(shard_config_file, i_shard, status_queue))
+            for i_shard, (shard_config_file, _) in enumerate(shard_configs)
+        ]
+        for process in processes:
+            process.start()
+        _write_summary(summary, summary_file)
+
+        while True:
+            try:
+                i_shard, status, message = status_queue.get(timeout=5)
+            except Empty:
+                if not any(process.is_alive() for process in processes):
+                    break
+                continue
+
+            shard = summary["shards"][i_shard]
+            shard["status"] = status
+            shard["updated"] = strftime("%Y-%m-%d %H:%M:%S")
+            if message:
+                shard["message"] = message
+            config.loggers.workflow.log(
+                25,
+                "Shard %d (%s): %s",
+                i_shard,
+                ", ".join(shard["participant_label"]),
+                status,
+            )
+            _write_summary(summary, summary_file)
+
+        for process in processes:
+            process.join()
+
+    n_failed = 0
+    for shard, process in zip(summary["shards"], processes):
+        shard["exitcode"] = process.exitcode
+        if process.exitcode or shard["status"] != "finished":
+            n_failed += 1
+            shard["status"] = "failed"
+    _write_summary(summary, summary_file)
+    return n_failed
@@ -311,6 +311,10 @@ class nipype(_Config):
     """Run NiPype's tool to enlist linked libraries for every interface."""
     memory_gb = None
     """Estimation in GB of the RAM this workflow can allocate at any given time."""
+    n_shards = 1
+    """Number of groups of participants that are built and run by separate processes."""
+    shard_index = None
+    """Index of the shard these settings run, if the participants are split in shards."""
     nprocs = os.cpu_count()
     """Number of processes (compute tasks) that can be run in parallel (multiprocessing only)."""
     omp_nthreads = None
@@ -393,6 +397,8 @@ class execution(_Config):
     """A dictionary of BIDS selection filters."""
     boilerplate_only = False
     """Only generate a boilerplate."""
+    compression_level = 9
+    """Gzip compression level (1-9) of the compressed NIfTI derivatives."""
     sloppy = False
     """Run in sloppy mode (meaning, suboptimal parameters that minimize run-time)."""
     debug = []
@@ -121,7 +121,7 @@ class AmicoReconInterface(SimpleInterface):
                 self.inputs.dwi_file, suffix=suffix + ".mif", newpath=runtime.cwd, use_ext=False
             )
             LOGGER.info("Writing sh mif file %s", output_mif_file)
-            amplitudes_to_sh_mif(odf_amplitudes, verts, output_mif_file, runtime.cwd)
+            amplitudes_to_sh_mif(odf_amplitudes, verts, output_mif_file)
             self._results["fod_sh_mif"] = output_mif_file
 
 
@@ -9,7 +9,9 @@ Image tools interfaces
 
 """
 
+import os
 import os.path as op
+import re
 from glob import glob
 from pathlib import Path
 
@@ -18,6 +20,7 @@ import numpy as np
 from nipype import logging
 from nipype.interfaces.base import (
     BaseInterfaceInputSpec,
+    Directory,
     File,
     SimpleInterface,
     TraitedSpec,
@@ -26,7 +29,9 @@ from nipype.interfaces.base import (
 )
 from nipype.utils.filemanip import fname_presuffix
 
+from ..utils.file_cache import FileCache, file_hash
 from ..utils.ingress import ukb_dirname_to_bids
+from ..utils.mif import load_image
 from .images import to_lps
 
 LOGGER = logging.getLogger("nipype.interface")
@@ -239,7 +244,9 @@ def calculate_steinhardt(sh_l, sh_m, data, q_num):
 
 
 class CalculateSOPInputSpec(BaseInterfaceInputSpec):
-    sh_nifti = traits.File(mandatory=True, exists=True)
+    sh_nifti = traits.File(
+        mandatory=True, exists=True, desc="SH coefficients, as NIfTI or MRtrix (.mif, .mif.gz)"
+    )
     order = traits.Enum(2, 4, 6, 8, default=6, usedefault=True)
 
 
@@ -256,8 +263,8 @@ class CalculateSOP(SimpleInterface):
 
     def _run_interface(self, runtime):
 
-        # load the input nifti image
-        img = nb.load(self.inputs.sh_nifti)
+        # load the input image, e.g. FOD SH straight from MRtrix, in LPS+ orientation
+        img = to_lps(load_image(self.inputs.sh_nifti))
 
         # determine what the lmax was based on the number of volumes
         num_vols = img.shape[3]
@@ -280,7 +287,7 @@ class CalculateSOP(SimpleInterface):
         # to get a specific order
         def calculate_order(order):
             out_fname = fname_presuffix(
-                self.inputs.sh_nifti,
+                re.sub(r"\.mif\.gz$", ".mif", self.inputs.sh_nifti),
                 suffix="q-%d_SOP.nii.gz" % order,
                 use_ext=False,
                 newpath=runtime.cwd,
@@ -352,30 +359,110 @@ class GetTemplate(SimpleInterface):
     output_spec = _GetTemplateOutputSpec
 
     def _run_interface(self, runtime):
-        from templateflow.api import get as get_template
-
-        template_file = str(
-            get_template(
-                self.inputs.template_name,
-                cohort=[None, "2"],
-                resolution="1",
-                desc=None,
-                suffix="T1w",
-                extension=".nii.gz",
-            ),
-        )
-        mask_file = str(
-            get_template(
-                self.inputs.template_name,
-                cohort=[None, "2"],
-                resolution="1",
-                desc="brain",
-                suffix="mask",
-                extension=".nii.gz",
-            ),
-        )
-
+        template_file, mask_file = get_template_files(self.inputs.template_name)
         self._results["template_file"] = template_file
         self._results["mask_file"] = mask_file
 
         return runtime
+
+
+class _TemplateGridInputSpec(_GetTemplateInputSpec):
+    padding = traits.Int(8, usedefault=True, desc="voxels of padding around the brain")
+    cache_dir = Directory(
+        nohash=True, desc="directory for caching the grids across runs and invocations"
+    )
+
+
+class _TemplateGridOutputSpec(TraitedSpec):
+    grid_image = File(exists=True)
+
+
+class TemplateGrid(SimpleInterface):
+    """Create a non-oblique grid around the template brain, in LPS+ orientation.
+
+    The grid only depends on the template and the padding, so a single node makes it
+    for all the runs of a subject, which then resample it to their own voxel size.
+    With ``cache_dir`` it is created once and other subjects copy it from the cache.
+    """
+
+    input_spec = _TemplateGridInputSpec
+    output_spec = _TemplateGridOutputSpec
+
+    def _run_interface(self, runtime):
+        template_file, mask_file = get_template_files(self.inputs.template_name)
+        grid_image = op.join(runtime.cwd, "template_grid.nii.gz")
+
+        def _create():
+            make_template_grid(
+                template_file,
+                mask_file,
+                self.inputs.padding,
+                grid_image,
+                work_dir=op.join(runtime.cwd, "template_grid_work"),
+            )
+            return {}
+
+        if isdefined(self.inputs.cache_dir):
+            cache = FileCache(self.inputs.cache_dir)
+            key = cache.key(
+                file_hash(template_file),
+                file_hash(mask_file),
+                "%d" % self.inputs.padding,
+                "template_grid",
+            )
+            cache.get_or_create(key, {"grid_image.nii.gz": grid_image}, _create)
+        else:
+            _create()
+
+        self._results["grid_image"] = grid_image
+        return runtime
+
+
+def get_template_files(template_name):
+    """Get the 1mm T1w image and brain mask of a template from TemplateFlow."""
+    from templateflow.api import get as get_template
+
+    template_file = str(
+        get_template(
+            template_name,
+            cohort=[None, "2"],
+            resolution="1",
+            desc=None,
+            suffix="T1w",
+            extension=".nii.gz",
+        ),
+    )
+    mask_file = str(
+        get_template(
+            template_name,
+            cohort=[None, "2"],
+            resolution="1",
+            desc="brain",
+            suffix="mask",
+            extension=".nii.gz",
+        ),
+    )
+    return template_file, mask_file
+
+
+def make_template_grid(template_file, mask_file, padding, out_file, work_dir):
+    """Mask, reorient (LPS+), autobox and deoblique a template image."""
+    from nipype.interfaces import afni
+
+    os.makedirs(work_dir, exist_ok=True)
+    masked = afni.Calc(
+        in_file_a=template_file, in_file_b=mask_file, expr="a*b", outputtype="NIFTI_GZ"
+    ).run(cwd=work_dir)
+    reoriented = afni.Resample(
+        in_file=masked.outputs.out_file, orientation="RAI", outputtype="NIFTI_GZ"
+    ).run(cwd=work_dir)
+    autoboxed = afni.Autobox(
+        in_file=reoriented.outputs.out_file, padding=padding, outputtype="NIFTI_GZ"
+    ).run(cwd=work_dir)
+    afni.Warp(
+        in_file=autoboxed.outputs.out_file,
+        deoblique=True,
+        out_file=out_file,
+        outputtype="NIFTI_GZ",
+    ).run(cwd=work_dir)
+    return out_file
@@ -38,6 +38,7 @@ from niworkflows.interfaces.bids import (
 
 from qsirecon import config
 from qsirecon.data import load as load_data
+from qsirecon.utils.compression import parallel_gzip
 
 LOGGER = logging.getLogger("nipype.interface")
 BIDS_NAME = re.compile(
@@ -165,6 +166,13 @@ class _ReconDerivativesDataSinkInputSpec(_DerivativesDataSinkInputSpec):
     qsirecon_suffix = traits.Str(
         "", usedefault=True, desc="name appended to qsirecon- in the derivatives"
     )
+    num_threads = traits.Int(
+        1,
+        usedefault=True,
+        nohash=True,
+        desc="number of threads used to compress outputs. Sinks usually run in the "
+        "scheduler process, so only raise it for nodes that are submitted",
+    )
 
 
 class _ReconDerivativesDataSinkOutputSpec(_DerivativesDataSinkOutputSpec):
@@ -250,7 +258,9 @@ class ReconDerivativesDataSink(DerivativesDataSink):
             if isdefined(self.inputs.extra_values):
                 out_file = out_file.format(extra_value=self.inputs.extra_values[i])
             self._results["out_file"].append(out_file)
-            self._results["compression"].append(_copy_any(fname, out_file))
+            self._results["compression"].append(
+                _copy_any(fname, out_file, n_threads=self.inputs.num_threads)
+            )
         return runtime
 
 
@@ -262,7 +272,7 @@ def _splitext(fname):
     return fname, ext
 
 
-def _copy_any(src, dst):
+def _copy_any(src, dst, n_threads=1):
     src_isgz = src.endswith(".gz")
     dst_isgz = dst.endswith(".gz")
     if src_isgz == dst_isgz:
@@ -273,9 +283,16 @@ def _copy_any(src, dst):
     if os.path.exists(dst):
         os.unlink(dst)
 
-    src_open = gzip.open if src_isgz else open
-    dst_open = gzip.open if dst_isgz else open
-    with src_open(src, "rb") as f_in:
-        with dst_open(dst, "wb") as f_out:
+    if dst_isgz:
+        parallel_gzip(
+            src,
+            dst,
+            compresslevel=config.execution.compression_level,
+            n_threads=n_threads,
+        )
+        return True
+
+    with gzip.open(src, "rb") as f_in:
+        with open(dst, "wb") as f_out:
             copyfileobj(f_in, f_out)
     return True
@@ -2,22 +2,13 @@
 
 import gzip
 import logging
-import os
-import os.path as op
 import re
-import subprocess
+from numbers import Integral
 
 import nibabel as nb
 import numpy as np
-
-try:
-    from StringIO import StringIO
-except ImportError:
-    from io import BytesIO as StringIO
-
-from dipy.core.geometry import cart2sphere
-from dipy.core.sphere import HemiSphere
-from dipy.direction import peak_directions
+from dipy.core.sphere import HemiSphere, Sphere
+from nibabel.fileslice import canonical_slicers
 from nipype.interfaces.base import (
     BaseInterfaceInputSpec,
     File,
@@ -30,9 +21,21 @@ from nipype.utils.filemanip import fname_presuffix
 from pkg_resources import resource_filename as pkgr
 from scipy.io.matlab import loadmat, savemat
 
+from ..utils.mif import create_mif, load_mif
+from ..utils.peaks import batch_peak_directions, sphere_neighbors
+from ..utils.shm import calculate_max_order, sh_to_sf_matrix
+
 LOGGER = logging.getLogger("nipype.workflow")
 ODF_COLS = 20000  # Number of columns in DSI Studio odf split
 MIN_NONZERO = 1e-6
+FIB_BLOCK_VOXELS = 500000  # Number of voxels read at a time when writing fib files
+MAT4_FLOAT32 = 10  # MOPT code of a little-endian, single precision MAT v4 matrix
+MAT4_DTYPES = {0: "f8", 1: "f4", 2: "i4", 3: "i2", 4: "u2", 5: "u1"}
+MAT4_NUMERIC = 0
+MAT4_TEXT = 1
+SH_BLOCK_VOXELS = 100000  # Number of voxels converted between SH and amplitudes at a time
+MRTRIX_DEFAULT_LMAX = 8  # The highest SH order amp2sh fits by default
+_SH_MATRICES = {}  # Cache of sh_amplitude_matrices
 
 
 class FODtoFIBGZInputSpec(BaseInterfaceInputSpec):
@@ -42,6 +45,7 @@ class FODtoFIBGZInputSpec(BaseInterfaceInputSpec):
     unit_odf = traits.Bool(False, usedefault=True)
     fib_file = File()
     output_fib_file = File()
+    num_threads = traits.Int(1, usedefault=True, nohash=True)
 
 
 class FODtoFIBGZOutputSpec(TraitedSpec):
@@ -65,25 +69,14 @@ class FODtoFIBGZ(SimpleInterface):
             )
 
         verts, faces = get_dsi_studio_ODF_geometry("odf8")
-        num_dirs, _ = verts.shape
-        hemisphere = num_dirs // 2
-        x, y, z = verts[:hemisphere].T
-        _, theta, phi = cart2sphere(x, y, -z)
-        dirs_txt = op.join(runtime.cwd, "directions.txt")
-        np.savetxt(dirs_txt, np.column_stack([phi, theta]))
-
-        odf_amplitudes_nii = op.join(runtime.cwd, "amplitudes.nii")
-        popen_run(["sh2amp", "-quiet", "-nonnegative", mif_file, dirs_txt, odf_amplitudes_nii])
-
-        if not op.exists(odf_amplitudes_nii):
-            raise FileNotFoundError("Unable to create %s", odf_amplitudes_nii)
-        amplitudes_img = nb.load(odf_amplitudes_nii)
+        amplitudes_img, _ = mif2amps(mif_file, "odf8")
 
         if isdefined(mask_file):
             mask_img = nb.load(mask_file)
         else:
-            ampl_data = amplitudes_img.get_fdata()
-            ampl_mask = ampl_data.sum(3) > 1e-6
+            ampl_mask = np.zeros(amplitudes_img.shape[:3], dtype=bool)
+            for slab, slab_amplitudes in _iter_slabs(amplitudes_img):
+                ampl_mask[:, :, slab] = slab_amplitudes.sum(3) > 1e-6
             mask_img = nb.Nifti1Image(ampl_mask.astype(float), amplitudes_img.affine)
 
         self._results["fib_file"] = output_fib_file
@@ -95,8 +88,8 @@ class FODtoFIBGZ(SimpleInterface):
             mask_img,
             num_fibers=self.inputs.num_fibers,
             unit_odf=self.inputs.unit_odf,
+            n_threads=self.inputs.num_threads,
         )
-        os.remove("amplitudes.nii")
         return runtime
 
 
@@ -128,7 +121,7 @@ class FIBGZtoFOD(SimpleInterface):
             fib_file, self.inputs.ref_image, self.inputs.subtract_iso
         )
         # convert them to MRTrix mif format
-        amplitudes_to_sh_mif(amplitudes, directions, output_mif_file, runtime.cwd)
+        amplitudes_to_sh_mif(amplitudes, directions, output_mif_file)
         self._results["mif_file"] = output_mif_file
         return runtime
 
@@ -220,18 +213,26 @@ def get_dsi_studio_ODF_geometry(odf_key):
     return odf_vertices, odf_faces
 
 
-def popen_run(arg_list):
-    cmd = subprocess.Popen(arg_list, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    out, err = cmd.communicate()
-    LOGGER.info(out)
-    LOGGER.info(err)
-
-
 def amplitudes_to_fibgz(
-    amplitudes_img, odf_dirs, odf_faces, output_file, mask_img, num_fibers=5, unit_odf=False
+    amplitudes_img,
+    odf_dirs,
+    odf_faces,
+    output_file,
+    mask_img,
+    num_fibers=5,
+    unit_odf=False,
+    n_threads=1,
+    block_size=FIB_BLOCK_VOXELS,
 ):
     """Convert a NiftiImage of ODF amplitudes to a DSI Studio fib file.
 
+    The amplitudes are read through the image's data proxy in float32 blocks
+    of whole axial slices and streamed into the output file, so memory use is
+    bounded by ``block_size`` plus the per-voxel peak arrays rather than by the
+    size of the 4D image. The variables are written in the order of the
+    original in-memory version: ``dimension``, ``voxel_size``, ``faN``/``indexN``,
+    ``odfN``, ``odf_vertices``, ``odf_faces`` and ``z0``.
+
     Parameters:
     ===========
 
@@ -245,11 +246,17 @@ def amplitudes_to_fibgz(
     odf_faces: np.ndarray
         triangles connecting the vertices in ``odf_dirs``
     output_file: str
-        Path where the output fib file will be written.
+        Path where the output fib file will be written. If it ends in
+        ``.gz`` the file is gzip-compressed as it is written.
     mask_img: nb.Nifti1Image
         3d Image that is nonzero where voxels contain brain.
     num_fibers: int
         The maximum number of fibers/fixels stored in each voxel.
+    n_threads: int
+        Number of threads used for peak detection.
+    block_size: int
+        Approximate number of voxels (masked or not) read from
+        ``amplitudes_img`` at a time.
 
     Returns:
     ========
@@ -269,63 +276,134 @@ def amplitudes_to_fibgz(
         raise ValueError("Differing grid between mask and amplitudes")
 
     # Get the flat mask
-    ampl_data = amplitudes_img.get_fdata()
-    flat_mask = mask_img.get_fdata().flatten(order="F") > 0
-    odf_array = ampl_data.reshape(-1, ampl_data.shape[3], order="F")
-    del ampl_data
-    masked_odfs = odf_array[flat_mask, :]
-    z0 = np.nanmax(masked_odfs)
-    masked_odfs = masked_odfs / z0
-    masked_odfs[masked_odfs < 0] = 0
-    masked_odfs = np.nan_to_num(masked_odfs).astype(float)
+    mask = np.asanyarray(mask_img.dataobj) > 0
+    flat_mask = mask.flatten(order="F")
+    n_odfs = int(flat_mask.sum())
+    n_amplitudes = amplitudes_img.shape[3]
 
-    if unit_odf:
-        sums = masked_odfs.sum(1)
-        sums[sums == 0] = 1
-        masked_odfs = np.masked_odfs / sums[:, np.newaxis]
-
-    n_odfs = masked_odfs.shape[0]
-    peak_indices = np.zeros((n_odfs, num_fibers))
-    peak_vals = np.zeros((n_odfs, num_fibers))
+    # First pass: find the maximum amplitude for normalization
+    z0 = np.nan
+    for odf_block in _iter_masked_odf_blocks(amplitudes_img, mask, block_size):
+        z0 = np.fmax(z0, np.nanmax(odf_block))
+    z0 = float(z0)
 
     dsi_mat = {}
     # Create matfile that can be read by dsi Studio
     dsi_mat["dimension"] = np.array(amplitudes_img.shape[:3])
     dsi_mat["voxel_size"] = np.array(amplitudes_img.header.get_zooms()[:3])
     n_voxels = int(np.prod(dsi_mat["dimension"]))
+
+    peak_indices = np.zeros((n_odfs, num_fibers), dtype=int)
+    peak_vals = np.zeros((n_odfs, num_fibers), dtype="float32")
+    neighbors = sphere_neighbors(hs)
+
+    # Second pass: normalize each block and find its peaks
     LOGGER.info("Detecting Peaks")
-    for odfnum in range(n_odfs):
-        dirs, vals, indices = peak_directions(masked_odfs[odfnum], hs)
-        for dirnum, (val, idx) in enumerate(zip(vals, indices)):
-            if dirnum == num_fibers:
-                break
-            peak_indices[odfnum, dirnum] = idx
-            peak_vals[odfnum, dirnum] = val
+    block_start = 0
+    for odf_block in _iter_masked_odf_blocks(amplitudes_img, mask, block_size):
+        odf_block = _normalize_odf_block(odf_block, z0, unit_odf)
+        block_stop = block_start + odf_block.shape[0]
+        block_vals, block_indices = batch_peak_directions(
+            odf_block, hs, num_peaks=num_fibers, neighbors=neighbors, n_threads=n_threads
+        )
+        peak_vals[block_start:block_stop] = block_vals
+        peak_indices[block_start:block_stop] = np.maximum(block_indices, 0)
+        block_start = block_stop
 
     # ensure that fa0 > 0 for all odf values
     peak_vals[np.abs(peak_vals[:, 0]) < MIN_NONZERO, 0] = MIN_NONZERO
     for nfib in range(num_fibers):
         # fill in the "fa" values
-        fa_n = np.zeros(n_voxels)
+        fa_n = np.zeros(n_voxels, dtype="float32")
         fa_n[flat_mask] = peak_vals[:, nfib]
-        dsi_mat["fa%d" % nfib] = fa_n.astype("float32")
+        dsi_mat["fa%d" % nfib] = fa_n
 
         # Fill in the index values
-        index_n = np.zeros(n_voxels)
+        index_n = np.zeros(n_voxels, dtype="int16")
         index_n[flat_mask] = peak_indices[:, nfib]
-        dsi_mat["index%d" % nfib] = index_n.astype("int16")
+        dsi_mat["index%d" % nfib] = index_n
 
-    # Add in the ODFs
-    num_odf_matrices = n_odfs // ODF_COLS
-    split_indices = (np.arange(num_odf_matrices) + 1) * ODF_COLS
-    odf_splits = np.array_split(masked_odfs, split_indices, axis=0)
-    for splitnum, odfs in enumerate(odf_splits):
-        dsi_mat["odf%d" % splitnum] = odfs.T.astype("float32")
+    file_open = gzip.open if output_file.endswith(".gz") else open
+    with file_open(output_file, "wb") as fib_file:
+        savemat(fib_file, dsi_mat, format="4")
+
+        # Third pass: stream the normalized ODFs into odfN variables
+        odf_writer = _ODFMatrixWriter(fib_file, n_odfs, n_amplitudes)
+        for odf_block in _iter_masked_odf_blocks(amplitudes_img, mask, block_size):
+            odf_writer.write(_normalize_odf_block(odf_block, z0, unit_odf))
+
+        savemat(
+            fib_file,
+            {"odf_vertices": odf_dirs.T, "odf_faces": odf_faces.T, "z0": np.array([z0])},
+            format="4",
+        )
+
+
+def _normalize_odf_block(odf_block, z0, unit_odf):
+    """Scale a block of masked ODFs by ``z0`` the way DSI Studio expects."""
+    odf_block = odf_block / z0
+    odf_block[odf_block < 0] = 0
+    odf_block = np.nan_to_num(odf_block)
+    if unit_odf:
+        sums = odf_block.sum(1)
+        sums[sums == 0] = 1
+        odf_block = odf_block / sums[:, np.newaxis]
+    return odf_block
 
-    dsi_mat["odf_vertices"] = odf_dirs.T
-    dsi_mat["odf_faces"] = odf_faces.T
-    dsi_mat["z0"] = np.array([z0])
-    savemat(output_file, dsi_mat, format="4", appendmat=False)
+
+def _iter_masked_odf_blocks(amplitudes_img, mask, block_size):
+    """Yield the masked amplitudes of whole axial slabs as float32 arrays.
+
+    Voxels are yielded in the same (Fortran) order as ``mask.flatten(order="F")``.
+    """
+    slab_thickness = max(1, block_size // (mask.shape[0] * mask.shape[1]))
+    for slab_start in range(0, mask.shape[2], slab_thickness):
+        slab = slice(slab_start, slab_start + slab_thickness)
+        slab_mask = mask[:, :, slab]
+        if not slab_mask.any():
+            continue
+        slab_data = np.asarray(amplitudes_img.dataobj[:, :, slab], dtype="float32")
+        yield slab_data.transpose(2, 1, 0, 3)[slab_mask.T]
+
+
+class _ODFMatrixWriter:
+    """Stream rows of masked ODFs into consecutive MAT v4 ``odfN`` variables.
+
+    Each ``odfN`` variable holds (up to) ``ODF_COLS`` ODFs as a float32
+    ``n_amplitudes x n_odfs`` matrix, matching what DSI Studio expects.
+    """
+
+    def __init__(self, fileobj, n_odfs, n_amplitudes):
+        self.fileobj = fileobj
+        self.n_odfs = n_odfs
+        self.n_amplitudes = n_amplitudes
+        self.n_written = 0
+        self.matrix_num = 0
+
+    def write(self, odfs):
+        odfs = np.asarray(odfs, dtype="<f4")
+        while odfs.shape[0]:
+            in_matrix = self.n_written % ODF_COLS
+            if in_matrix == 0:
+                n_cols = min(ODF_COLS, self.n_odfs - self.n_written)
+                _write_mat4_header(
+                    self.fileobj,
+                    "odf%d" % self.matrix_num,
+                    MAT4_FLOAT32,
+                    self.n_amplitudes,
+                    n_cols,
+                )
+                self.matrix_num += 1
+            n_rows = min(ODF_COLS - in_matrix, odfs.shape[0])
+            self.fileobj.write(np.ascontiguousarray(odfs[:n_rows]).tobytes())
+            self.n_written += n_rows
+            odfs = odfs[n_rows:]
+
+
+def _write_mat4_header(fileobj, name, mopt, mrows, ncols):
+    """Write a little-endian, real-valued MAT v4 variable header."""
+    fileobj.write(np.array([mopt, mrows, ncols, 0, len(name) + 1], dtype="<i4").tobytes())
+    fileobj.write(name.encode("latin1") + b"\0")
 
 
 def amico_directions_to_fibgz(
@@ -412,9 +490,114 @@ def amico_directions_to_fibgz(
     savemat(output_file, dsi_mat, format="4", appendmat=False)
 
 
-def amplitudes_to_sh_mif(amplitudes_img, odf_dirs, output_file, working_dir):
+def sh_amplitude_matrices(directions, lmax, basis="mrtrix3"):
+    """Get the matrices that map SH coefficients to amplitudes on some directions and back.
+
+    The matrices are computed once for each set of directions, SH order and basis,
+    then reused by every later conversion.
+
+    Parameters:
+    ===========
+
+    directions: np.ndarray
+        N x 3 array of the directions, in the frame of the SH coefficients.
+    lmax: int
+        The maximum SH order.
+    basis: str
+        A basis from :data:`qsirecon.utils.shm.sph_harm_lookup`.
+
+    Returns:
+    ========
+
+    sh_to_amp: np.ndarray
+        float32 (n_coefficients x N) matrix, ``amplitudes = sh @ sh_to_amp``.
+    amp_to_sh: np.ndarray
+        float32 (N x n_coefficients) least-squares inverse of ``sh_to_amp``.
+
+    """
+    directions = np.ascontiguousarray(directions, dtype=float)
+    key = (directions.tobytes(), int(lmax), basis)
+    if key not in _SH_MATRICES:
+        x, y, z = directions.T
+        sh_to_amp, amp_to_sh = sh_to_sf_matrix(Sphere(x=x, y=y, z=z), int(lmax), basis)
+        _SH_MATRICES[key] = (sh_to_amp.astype("float32"), amp_to_sh.astype("float32"))
+    return _SH_MATRICES[key]
+
+
+def _mrtrix_directions(odf_dirs):
+    """Get the first half of a DSI Studio sphere in the frame of MRtrix SH coefficients.
+
+    DSI Studio's z axis is flipped with respect to MRtrix. The SH are even, so
+    flipping x and y instead would be equivalent.
+    """
+    hemisphere = odf_dirs.shape[0] // 2
+    return odf_dirs[:hemisphere] * np.array([1.0, 1.0, -1.0])
+
+
+def _convert_voxels(data, matrix, out):
+    """Multiply the nonzero voxels of ``data`` (..., K) by ``matrix`` (K x M) into ``out``.
+
+    Voxels are converted in float32 blocks of ``SH_BLOCK_VOXELS``; the others are
+    left as they are in ``out``, which may be a view of a memory-mapped file.
+    """
+    voxels = np.nonzero(np.any(data != 0, axis=-1))
+    for start in range(0, voxels[0].size, SH_BLOCK_VOXELS):
+        block = tuple(index[start : start + SH_BLOCK_VOXELS] for index in voxels)
+        out[block] = np.asarray(data[block], dtype="float32") @ matrix
+
+
+def _iter_slabs(img, block_size=SH_BLOCK_VOXELS):
+    """Yield ``(slab, data)`` for slabs of whole axial slices of a 4D image."""
+    slab_thickness = max(1, block_size // (img.shape[0] * img.shape[1]))
+    for slab_start in range(0, img.shape[2], slab_thickness):
+        slab = slice(slab_start, slab_start + slab_thickness)
+        yield slab, np.asarray(img.dataobj[:, :, slab], dtype="float32")
+
+
+class SHAmplitudeProxy:
+    """Array proxy that samples SH coefficients on a set of directions when sliced.
+
+    Only the voxels that are sliced are converted, so an image of amplitudes
+    built on this proxy can be read in slabs without ever holding the whole
+    4D array of amplitudes in memory.
+    """
+
+    is_proxy = True
+
+    def __init__(self, sh_data, sh_to_amp, nonnegative=True):
+        self._sh_data = sh_data
+        self._sh_to_amp = sh_to_amp
+        self._nonnegative = nonnegative
+        self.shape = tuple(sh_data.shape[:3]) + (sh_to_amp.shape[1],)
+        self.ndim = 4
+        self.dtype = np.dtype("float32")
+
+    def __getitem__(self, slicer):
+        slicer = canonical_slicers(slicer, self.shape)
+        # Integer indices become length-1 slices so that no axis is dropped until the end
+        kept = tuple(
+            slice(index, index + 1) if isinstance(index, Integral) else index for index in slicer
+        )
+        dropped = tuple(0 if isinstance(index, Integral) else slice(None) for index in slicer)
+        sh_data = np.asarray(self._sh_data[kept[:3] + (slice(None),)], dtype="float32")
+        sh_to_amp = self._sh_to_amp[:, kept[3]]
+        amplitudes = np.zeros(sh_data.shape[:-1] + sh_to_amp.shape[1:], dtype="float32")
+        _convert_voxels(sh_data, sh_to_amp, amplitudes)
+        if self._nonnegative:
+            np.maximum(amplitudes, 0, out=amplitudes)
+        return amplitudes[dropped]
+
+    def __array__(self, dtype=None):
+        amplitudes = self[...]
+        return amplitudes if dtype is None else amplitudes.astype(dtype)
+
+
+def amplitudes_to_sh_mif(amplitudes_img, odf_dirs, output_file):
     """Convert an image of ODF amplitudes to a MRtrix sh mif file.
 
+    Equivalent to MRtrix's ``amp2sh``: the SH (in the MRtrix3 basis, up to
+    order 8) are the least-squares fit to the amplitudes of each voxel.
+
     Parameters:
     ============
 
@@ -429,8 +612,6 @@ def amplitudes_to_sh_mif(amplitudes_img, odf_dirs, output_file, working_dir):
         same amplitudes.
     output_file: str
         Path where the output ``.mif`` file will be written.
-    working_dir: str
-        Path where temp files will be written to
 
     Returns:
     ========
@@ -438,116 +619,227 @@ def amplitudes_to_sh_mif(amplitudes_img, odf_dirs, output_file, working_dir):
     None
 
     """
-    temp_nii = op.join(working_dir, "odf_values.nii")
-    amplitudes_img.to_filename(temp_nii)
-
-    num_dirs, _ = odf_dirs.shape
-    hemisphere = num_dirs // 2
-    x, y, z = odf_dirs[:hemisphere].T
-    _, theta, phi = cart2sphere(-x, -y, z)
-    dirs_txt = op.join(working_dir, "ras+directions.txt")
-    np.savetxt(dirs_txt, np.column_stack([phi, theta]))
-
-    popen_run(
-        ["amp2sh", "-quiet", "-force", "-directions", dirs_txt, "odf_values.nii", output_file]
+    directions = _mrtrix_directions(odf_dirs)
+    if amplitudes_img.shape[3] != directions.shape[0]:
+        raise ValueError("The amplitudes do not match the first half of the directions")
+    # The highest order the directions support, up to amp2sh's default of 8
+    lmax = min(MRTRIX_DEFAULT_LMAX, 2 * int((np.sqrt(8 * directions.shape[0] + 1) - 3) // 4))
+    _, amp_to_sh = sh_amplitude_matrices(directions, lmax)
+
+    sh_data = create_mif(
+        output_file, amplitudes_img.shape[:3] + (amp_to_sh.shape[1],), amplitudes_img.affine
     )
-    os.remove(temp_nii)
-    os.remove(dirs_txt)
+    for slab, amplitudes in _iter_slabs(amplitudes_img):
+        _convert_voxels(amplitudes, amp_to_sh, sh_data[:, :, slab])
+    sh_data.flush()
 
 
-def mif2amps(sh_mif_file, working_dir, dsi_studio_odf="odf8"):
+def mif2amps(sh_mif_file, dsi_studio_odf="odf8"):
     """Convert a MRTrix SH mif file to a NiBabel amplitudes image.
 
+    Equivalent to MRtrix's ``sh2amp -nonnegative``. The amplitudes are computed
+    from the (memory-mapped) SH coefficients whenever the image's ``dataobj``
+    is sliced.
+
     Parameters:
     ===========
 
     sh_mif_file : str
         path to the mif file with SH coefficients
+    dsi_studio_odf : str
+        The DSI Studio sphere to sample the amplitudes on.
+
+    Returns:
+    ========
+
+    amplitudes_img: nb.Nifti1Image
+        4D image of the amplitudes on the first half of the sphere.
+    directions: np.ndarray
+        The first half of the sphere's vertices, in DSI Studio's frame.
 
     """
     verts, _ = get_dsi_studio_ODF_geometry(dsi_studio_odf)
-    num_dirs, _ = verts.shape
-    hemisphere = num_dirs // 2
-    directions = verts[:hemisphere]
-    x, y, z = directions.T
-    _, theta, phi = cart2sphere(x, y, -z)
-    dirs_txt = op.join(working_dir, "directions.txt")
-    np.savetxt(dirs_txt, np.column_stack([phi, theta]))
-
-    odf_amplitudes_nii = op.join(working_dir, "amplitudes.nii")
-    popen_run(["sh2amp", "-quiet", "-nonnegative", sh_mif_file, dirs_txt, odf_amplitudes_nii])
-
-    if not op.exists(odf_amplitudes_nii):
-        raise FileNotFoundError("Unable to create %s", odf_amplitudes_nii)
-    amplitudes_img = nb.load(odf_amplitudes_nii)
+    directions = verts[: verts.shape[0] // 2]
+    sh_data, affine, _ = load_mif(sh_mif_file)
+    sh_to_amp, _ = sh_amplitude_matrices(
+        _mrtrix_directions(verts), calculate_max_order(sh_data.shape[3])
+    )
+    amplitudes = SHAmplitudeProxy(sh_data, sh_to_amp)
+    header = nb.Nifti1Header()
+    header.set_data_dtype("float32")
+    amplitudes_img = nb.Nifti1Image(amplitudes, affine, header)
     return amplitudes_img, directions
 
 
-def fast_load_fibgz(fib_file):
-    """Load a potentially gzipped fibgz file more quickly than using built-in gzip."""
-    # Try to load a non-zipped file
-    if not fib_file.endswith("gz"):
-        return loadmat(fib_file)
-
-    # Load a zipped file quickly if possible
-    def find_zcat():
-        def is_exe(fpath):
-            return os.path.exists(fpath) and os.access(fpath, os.X_OK)
-
-        for program in ["gzcat", "zcat"]:
-            for path in os.environ["PATH"].split(os.pathsep):
-                path = path.strip('"')
-                exe_file = os.path.join(path, program)
-                if is_exe(exe_file):
-                    return program
-        return None
-
-    # Check if a zcat is available on this system:
-    zcatter = find_zcat()
-    if zcatter is not None:
-        p = subprocess.Popen([zcatter, fib_file], stdout=subprocess.PIPE)
-        fh = StringIO(p.communicate()[0])
-        assert p.returncode == 0
-        return loadmat(fh)
-
-    with gzip.open(fib_file, "r") as f:
-        LOGGER.info("Loading with python gzip. To load faster install zcat or gzcat.")
-        return loadmat(f)
-
-
-def fib2amps(fib_file, ref_image, subtract_iso=True):
-    fibmat = fast_load_fibgz(fib_file)
+def fast_load_fibgz(fib_file, variables=None, mmap=True):
+    """Load variables from a (potentially gzipped) DSI Studio fib file.
+
+    The file is read in-process as a stream of MAT v4 variables. Only the
+    headers of variables that are not requested are parsed; their data is
+    skipped.
+
+    Parameters:
+    ===========
+
+    fib_file: str
+        Path to a ``.fib`` or ``.fib.gz`` file.
+    variables: list of str or None
+        Names of the variables to load. Each entry is a regular expression
+        that must match the whole variable name, e.g. ``r"odf\\d+"``.
+        If None, all variables are loaded.
+    mmap: bool
+        Memory-map the variables of uncompressed files instead of reading them.
+
+    Returns:
+    ========
+
+    fibmat: dict
+        Maps variable names to 2D arrays, as in :func:`scipy.io.loadmat`.
+
+    """
+    patterns = None if variables is None else [re.compile(var) for var in variables]
+    compressed = fib_file.endswith("gz")
+    file_open = gzip.open if compressed else open
+    fibmat = {}
+    with file_open(fib_file, "rb") as fileobj:
+        for name, dtype, shape, data_type, offset in _iter_mat4_headers(fileobj):
+            if patterns is not None and not any(pat.fullmatch(name) for pat in patterns):
+                continue
+            if data_type not in (MAT4_NUMERIC, MAT4_TEXT):
+                raise NotImplementedError("Unsupported MAT v4 variable type in %s" % name)
+            if mmap and not compressed and data_type == MAT4_NUMERIC:
+                fibmat[name] = np.memmap(
+                    fib_file, dtype=dtype, mode="r", offset=offset, shape=shape, order="F"
+                )
+                continue
+            data = np.empty(int(np.prod(shape)), dtype=dtype)
+            _read_into(fileobj, data)
+            data = data.reshape(shape, order="F")
+            if data_type == MAT4_TEXT:
+                data = np.array(["".join(map(chr, row)) for row in data.astype(int)])
+            fibmat[name] = data
+    return fibmat
+
+
+def _iter_mat4_headers(fileobj):
+    """Iterate over the variables of a MAT v4 stream.
+
+    Yields ``(name, dtype, shape, data_type, offset)`` with ``fileobj`` positioned
+    at the start of the variable's data. Whatever the caller does not read is
+    skipped before the next header is parsed.
+    """
+    while True:
+        header = fileobj.read(20)
+        if len(header) < 20:
+            return
+        mopt, mrows, ncols, imagf, namlen = np.frombuffer(header, dtype="<i4")
+        byte_order = "<"
+        if mopt < 0 or mopt > 9999:
+            byte_order = ">"
+            mopt, mrows, ncols, imagf, namlen = np.frombuffer(header, dtype=">i4")
+        if imagf:
+            raise NotImplementedError("Complex MAT v4 variables are not supported")
+        precision = (mopt // 10) % 10
+        data_type = mopt % 10
+        dtype = np.dtype(MAT4_DTYPES[precision]).newbyteorder(byte_order)
+        name = fileobj.read(namlen).rstrip(b"\0").decode("latin1")
+        offset = fileobj.tell()
+        yield name, dtype, (int(mrows), int(ncols)), data_type, offset
+        fileobj.seek(offset + int(mrows) * int(ncols) * dtype.itemsize)
+
+
+def _read_into(fileobj, array):
+    """Fill a contiguous array with bytes read from ``fileobj``."""
+    view = memoryview(array).cast("B")
+    n_read = 0
+    while n_read < len(view):
+        chunk_read = fileobj.readinto(view[n_read:])
+        if not chunk_read:
+            raise EOFError("Unexpected end of MAT v4 file")
+        n_read += chunk_read
+
+
+def fib2amps(fib_file, ref_image, subtract_iso=True, masked=False):
+    """Load the ODF amplitudes stored in a DSI Studio fib file.
+
+    Parameters:
+    ===========
+
+    fib_file: str
+        Path to a ``.fib`` or ``.fib.gz`` file.
+    ref_image: str
+        Image whose affine and header are used for the output.
+    subtract_iso: bool
+        Subtract the minimum amplitude in each direction.
+    masked: bool
+        Return only the voxels inside the fib file's mask instead of a 4D image.
+
+    Returns:
+    ========
+
+    amplitudes: nb.Nifti1Image or tuple
+        4D image of ODF amplitudes. If ``masked`` is True, a
+        ``(voxel_indices, odf_matrix)`` tuple instead, where ``voxel_indices``
+        are the (Fortran order) flat indices of the masked voxels and
+        ``odf_matrix`` is the ``n_voxels x n_amplitudes`` float32 array of their
+        amplitudes.
+    directions: np.ndarray
+        The sphere vertices from the fib file.
+
+    """
+    fibmat = fast_load_fibgz(
+        fib_file,
+        variables=["dimension", "odf_vertices", r"fa\d+", r"index\d+", r"odf\d+"],
+    )
     dims = tuple(fibmat["dimension"].squeeze().astype(int))
     directions = fibmat["odf_vertices"].T
+    flat_mask = fibmat["fa0"].squeeze().ravel(order="F") > 0
 
     odf_vars = [k for k in fibmat.keys() if re.match("odf\\d+", k)]
-    valid_odfs = []
-    flat_mask = fibmat["fa0"].squeeze().ravel(order="F") > 0
-    n_voxels = np.prod(dims)
     if odf_vars:
-        for n in range(len(odf_vars)):
-            varname = "odf%d" % n
-            odfs = fibmat[varname]
-            odf_sum = odfs.sum(0)
-            odf_sum_mask = odf_sum > 0
-            valid_odfs.append(odfs[:, odf_sum_mask].T)
-        odf_array = np.row_stack(valid_odfs)
-        if subtract_iso:
-            odf_array = odf_array - odf_array.min(0)
+        odf_blocks = [fibmat["odf%d" % n] for n in range(len(odf_vars))]
+        valid_columns = [odfs.sum(0) > 0 for odfs in odf_blocks]
+        n_amplitudes = odf_blocks[0].shape[0]
+        iso = np.zeros(n_amplitudes, dtype="float32")
+        # Blocks without any valid column do not contribute to the minimum
+        nonempty = [valid.any() for valid in valid_columns]
+        if subtract_iso and any(nonempty):
+            iso = np.min(
+                [
+                    odfs[:, valid].min(1)
+                    for odfs, valid, keep in zip(odf_blocks, valid_columns, nonempty)
+                    if keep
+                ],
+                axis=0,
+            )
     else:
-        odf_array = peaks_to_odfs(fibmat)
+        odf_blocks = [peaks_to_odfs(fibmat).T]
+        valid_columns = [slice(None)]
+        n_amplitudes = odf_blocks[0].shape[0]
+        iso = np.zeros(n_amplitudes, dtype="float32")
+
+    voxel_indices = np.flatnonzero(flat_mask)
+    if masked:
+        odf_array = np.zeros((voxel_indices.size, n_amplitudes), dtype="float32")
+        rows = np.arange(voxel_indices.size)
+    else:
+        # Allocate the output once and fill it directly from each odf block
+        odf4d = np.zeros(dims + (n_amplitudes,), dtype="float32", order="F")
+        odf_array = odf4d.reshape((-1, n_amplitudes), order="F")
+        rows = voxel_indices
+
+    start = 0
+    for odfs, valid in zip(odf_blocks, valid_columns):
+        block = odfs[:, valid]
+        stop = start + block.shape[1]
+        odf_array[rows[start:stop]] = block.T - iso
+        start = stop
 
-    # Convert each column to a 3d file, then concatenate them
-    odfs_3d = []
-    for odf_vals in odf_array.T:
-        new_data = np.zeros(n_voxels, dtype="float32")
-        new_data[flat_mask] = odf_vals
-        odfs_3d.append(new_data.reshape(dims, order="F"))
+    if masked:
+        return (voxel_indices, odf_array), directions
 
     real_img = nb.load(ref_image)
-    odf4d = np.stack(odfs_3d, -1)
     odf4d_img = nb.Nifti1Image(odf4d, real_img.affine, real_img.header)
-
     return odf4d_img, directions
 
 
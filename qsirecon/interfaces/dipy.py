@@ -9,6 +9,7 @@ Image tools interfaces
 
 """
 import shutil
+from functools import partial
 
 import nibabel as nb
 import numpy as np
@@ -17,6 +18,7 @@ from dipy.core.sphere import HemiSphere
 from dipy.io.utils import nifti1_symmat
 from dipy.reconst import dki, dti, mapmri
 from dipy.segment.mask import median_otsu
+from nibabel.volumeutils import apply_read_scaling
 from nipype import logging
 from nipype.interfaces.base import (
     BaseInterfaceInputSpec,
@@ -30,7 +32,14 @@ from nipype.utils.filemanip import fname_presuffix
 from pkg_resources import resource_filename as pkgr
 
 from ..interfaces.mrtrix import _convert_fsl_to_mrtrix
-from ..utils.brainsuite_shore import BrainSuiteShoreModel, brainsuite_shore_basis
+from ..utils.blockfit import fit_voxel_blocks
+from ..utils.brainsuite_shore import (
+    L1_WARM_START_VOXELS,
+    BrainSuiteShoreFit,
+    BrainSuiteShoreModel,
+    brainsuite_shore_basis,
+)
+from ..utils.mapmri_metrics import MapmriMetrics
 from .converters import (
     amplitudes_to_fibgz,
     amplitudes_to_sh_mif,
@@ -41,6 +50,20 @@ LOGGER = logging.getLogger("nipype.interface")
 TAU_DEFAULT = 1.0 / (4 * np.pi**2)
 
 
+def _unmask(values, mask_array):
+    """Put the values of the voxels in a mask back into a volume, with zeros elsewhere."""
+    volume = np.zeros(mask_array.shape + values.shape[1:], dtype=values.dtype)
+    volume[mask_array] = values
+    return volume
+
+
+def _odf8_hemisphere():
+    """Get DSI Studio's odf8 sphere and the half of it that ODFs are sampled on."""
+    verts, faces = get_dsi_studio_ODF_geometry("odf8")
+    x, y, z = verts[: verts.shape[0] // 2].T
+    return verts, faces, HemiSphere(x=x, y=y, z=z)
+
+
 class DipyReconInputSpec(BaseInterfaceInputSpec):
     bval_file = File(exists=True, mandatory=True)
     bvec_file = File(exists=True, mandatory=True)
@@ -50,6 +73,7 @@ class DipyReconInputSpec(BaseInterfaceInputSpec):
     big_delta = traits.Either(None, traits.Float(), usedefault=True)
     little_delta = traits.Either(None, traits.Float(), usedefault=True)
     b0_threshold = traits.CFloat(50, usedefault=True)
+    num_threads = traits.Int(1, usedefault=True, nohash=True)
     # Outputs
     write_fibgz = traits.Bool(True)
     write_mif = traits.Bool(True)
@@ -104,20 +128,88 @@ class DipyReconInterface(SimpleInterface):
             mask_array = mask_img.get_fdata() > 0
         return mask_img, mask_array
 
-    def _save_scalar(self, data, suffix, runtime, ref_img):
+    def _load_dwi(self):
+        """Load the DWI series without reading its data.
+
+        Uncompressed files are memory-mapped. The file is kept open, so the volumes
+        of compressed files are decompressed in a single pass when read in order.
+        """
+        return nb.load(self.inputs.dwi_file, mmap=True, keep_file_open=True)
+
+    def _get_masked_data(self, dwi_img, mask_array, b0s_mask=None):
+        """Read the signal of the voxels in a mask, one volume at a time.
+
+        Parameters
+        ----------
+        dwi_img : :obj:`nibabel.Nifti1Image`
+            The DWI series, see :meth:`_load_dwi`.
+        mask_array : :obj:`numpy.ndarray`
+            Boolean mask of the voxels to read.
+        b0s_mask : :obj:`numpy.ndarray`, optional
+            If given, the volumes where it is True are averaged into the first
+            column, followed by the other volumes.
+
+        Returns
+        -------
+        data : :obj:`numpy.ndarray`
+            A float32 array with one row per voxel in the mask (in the order of
+            ``volume[mask_array]``) and one column per measurement.
+        """
+        dataobj = dwi_img.dataobj
+        n_volumes = dwi_img.shape[3]
+        if b0s_mask is None:
+            columns = np.arange(n_volumes)
+            n_columns = n_volumes
+        else:
+            b0s_mask = np.asarray(b0s_mask, dtype=bool)
+            columns = np.where(b0s_mask, 0, np.cumsum(~b0s_mask))
+            n_columns = 1 + np.count_nonzero(~b0s_mask)
+
+        slope = inter = None
+        if nb.is_proxy(dataobj):
+            is_scaled = (dataobj.slope, dataobj.inter) != (1, 0)
+            if is_scaled or not self.inputs.dwi_file.endswith(".gz"):
+                # Get the stored values: memory-mapped for uncompressed files, and in
+                # their on-disk (integer) type for scaled, compressed files
+                slope = np.asanyarray(dataobj.slope)
+                inter = np.asanyarray(dataobj.inter)
+                dataobj = dataobj.get_unscaled()
+                # Scale in float32 when possible, like get_fdata(dtype="float32")
+                if np.can_cast(slope, np.float32):
+                    slope = slope.astype(np.float32)
+                if np.can_cast(inter, np.float32):
+                    inter = inter.astype(np.float32)
+
+        data = np.zeros((np.count_nonzero(mask_array), n_columns), dtype=np.float32)
+        for volume_index, column in enumerate(columns):
+            volume = np.asanyarray(dataobj[..., volume_index])
+            if slope is not None:
+                volume = apply_read_scaling(volume, slope, inter)
+            data[:, column] += volume[mask_array]
+        if b0s_mask is not None:
+            data[:, 0] /= np.count_nonzero(b0s_mask)
+        return data
+
+    def _save_scalar(self, data, suffix, runtime, ref_img, mask_array=None):
+        """Save a scalar map, given as the values of the voxels in ``mask_array`` if given."""
+        if mask_array is not None:
+            data = _unmask(data, mask_array)
         output_fname = fname_presuffix(self.inputs.dwi_file, suffix=suffix, newpath=runtime.cwd)
         nb.Nifti1Image(data, ref_img.affine, ref_img.header).to_filename(output_fname)
         return output_fname
 
-    def _write_external_formats(self, runtime, fit_obj, mask_img, suffix):
+    def _write_external_formats(self, runtime, odfs, mask_img, suffix, mask_array=None):
+        """Write ODFs sampled on :func:`_odf8_hemisphere` for other software.
+
+        If ``mask_array`` is given, ``odfs`` holds the voxels of the mask only.
+        """
 
         # Convert to amplitudes for other software
-        verts, faces = get_dsi_studio_ODF_geometry("odf8")
-        num_dirs, _ = verts.shape
-        hemisphere = num_dirs // 2
-        x, y, z = verts[:hemisphere].T
-        hs = HemiSphere(x=x, y=y, z=z)
-        odf_amplitudes = nb.Nifti1Image(fit_obj.odf(hs), mask_img.affine, mask_img.header)
+        verts, faces, _ = _odf8_hemisphere()
+        hemisphere = verts.shape[0] // 2
+        if mask_array is not None:
+            odfs = _unmask(odfs, mask_array)
+        odf_amplitudes = nb.Nifti1Image(odfs, mask_img.affine, mask_img.header)
         output_amps_file = fname_presuffix(
             self.inputs.dwi_file, suffix=suffix + "_amp.nii.gz", newpath=runtime.cwd, use_ext=False
         )
@@ -135,7 +227,13 @@ class DipyReconInterface(SimpleInterface):
             )
             LOGGER.info("Writing DSI Studio fib file %s", output_fib_file)
             amplitudes_to_fibgz(
-                odf_amplitudes, verts, faces, output_fib_file, mask_img, num_fibers=5
+                odf_amplitudes,
+                verts,
+                faces,
+                output_fib_file,
+                mask_img,
+                num_fibers=5,
+                n_threads=self.inputs.num_threads,
             )
             self._results["fibgz"] = output_fib_file
 
@@ -144,7 +242,7 @@ class DipyReconInterface(SimpleInterface):
                 self.inputs.dwi_file, suffix=suffix + ".mif", newpath=runtime.cwd, use_ext=False
             )
             LOGGER.info("Writing sh mif file %s", output_mif_file)
-            amplitudes_to_sh_mif(odf_amplitudes, verts, output_mif_file, runtime.cwd)
+            amplitudes_to_sh_mif(odf_amplitudes, verts, output_mif_file)
             self._results["fod_sh_mif"] = output_mif_file
 
     def _extrapolate_scheme(self, scheme_name, runtime, fit_obj, mask_img):
@@ -187,6 +285,20 @@ class DipyReconInterface(SimpleInterface):
         self._results["extrapolated_dwi"] = output_dwi_file
 
 
+# The maps written by MAPMRIReconstruction, with the metric and suffix of each
+MAPMRI_METRICS = {
+    "rtop": ("rtop", "_rtop"),
+    "lapnorm": ("norm_of_laplacian_signal", "_lapnorm"),
+    "msd": ("msd", "_msd"),
+    "qiv": ("qiv", "_qiv"),
+    "rtap": ("rtap", "_rtap"),
+    "rtpp": ("rtpp", "_rtpp"),
+    "ng": ("ng", "_ng"),
+    "perng": ("ng_perpendicular", "_perng"),
+    "parng": ("ng_parallel", "_parng"),
+}
+
+
 class MAPMRIInputSpec(DipyReconInputSpec):
     radial_order = traits.Int(6, usedefault=True)
     laplacian_regularization = traits.Bool(True, usedefault=True)
@@ -202,6 +314,10 @@ class MAPMRIInputSpec(DipyReconInputSpec):
     dti_scale_estimation = traits.Bool(True, usedefault=True)
     static_diffusivity = traits.Float(0.7e-3, usedefault=True)
     cvxpy_solver = traits.Str()
+    metrics = traits.List(
+        traits.Enum(*MAPMRI_METRICS),
+        desc="The maps to write. All of them are written if unset.",
+    )
 
 
 class MAPMRIOutputSpec(DipyReconOutputSpec):
@@ -223,89 +339,59 @@ class MAPMRIReconstruction(DipyReconInterface):
 
     def _run_interface(self, runtime):
         gtab = self._get_gtab()
-        dwi_img = nb.load(self.inputs.dwi_file)
-        data = dwi_img.get_fdata(dtype="float32")
+        dwi_img = self._load_dwi()
         mask_img, mask_array = self._get_mask(dwi_img, gtab)
+        data = self._get_masked_data(dwi_img, mask_array)
         weighting = (
             "GCV" if self.inputs.laplacian_weighting == "GCV" else self.inputs.laplacian_weighting
         )
 
-        if self.inputs.laplacian_regularization and self.inputs.positivity_constraint:
-            map_model_aniso = mapmri.MapmriModel(
-                gtab,
-                radial_order=self.inputs.radial_order,
-                laplacian_regularization=True,
-                laplacian_weighting=weighting,
-                positivity_constraint=True,
-                bval_threshold=self.inputs.b0_threshold,
-                anisotropic_scaling=self.inputs.anisotropic_scaling,
-            )
-
-        elif self.inputs.positivity_constraint:
-            map_model_aniso = mapmri.MapmriModel(
-                gtab,
-                radial_order=self.inputs.radial_order,
-                laplacian_regularization=False,
-                positivity_constraint=True,
-                bval_threshold=self.inputs.b0_threshold,
-                anisotropic_scaling=self.inputs.anisotropic_scaling,
-            )
-
-        elif self.inputs.laplacian_regularization:
-            map_model_aniso = mapmri.MapmriModel(
-                gtab,
-                radial_order=self.inputs.radial_order,
-                laplacian_regularization=True,
-                laplacian_weighting=weighting,
-                bval_threshold=self.inputs.b0_threshold,
-                anisotropic_scaling=self.inputs.anisotropic_scaling,
-            )
-
-        else:
-            map_model_aniso = mapmri.MapmriModel(
-                gtab,
-                radial_order=self.inputs.radial_order,
-                laplacian_regularization=False,
-                positivity_constraint=False,
-                bval_threshold=self.inputs.b0_threshold,
-                anisotropic_scaling=self.inputs.anisotropic_scaling,
-            )
+        model_kwargs = {
+            "radial_order": self.inputs.radial_order,
+            "laplacian_regularization": self.inputs.laplacian_regularization,
+            "positivity_constraint": self.inputs.positivity_constraint,
+            "bval_threshold": self.inputs.b0_threshold,
+            "anisotropic_scaling": self.inputs.anisotropic_scaling,
+        }
+        if self.inputs.laplacian_regularization:
+            model_kwargs["laplacian_weighting"] = weighting
+
+        metrics = self.inputs.metrics if isdefined(self.inputs.metrics) else list(MAPMRI_METRICS)
+        if not self.inputs.anisotropic_scaling:
+            # The non-Gaussianities are only defined with anisotropic scaling
+            metrics = [name for name in metrics if name not in ("ng", "perng", "parng")]
 
         LOGGER.info("Fitting MAPMRI Model.")
-        mapfit_aniso = map_model_aniso.fit(data, mask=mask_array)
-        rtop = mapfit_aniso.rtop()
-        self._results["rtop"] = self._save_scalar(rtop, "_rtop", runtime, dwi_img)
-
-        ll = mapfit_aniso.norm_of_laplacian_signal()
-        self._results["lapnorm"] = self._save_scalar(ll, "_lapnorm", runtime, dwi_img)
-
-        m = mapfit_aniso.msd()
-        self._results["msd"] = self._save_scalar(m, "_msd", runtime, dwi_img)
-
-        q = mapfit_aniso.qiv()
-        self._results["qiv"] = self._save_scalar(q, "_qiv", runtime, dwi_img)
-
-        rtap = mapfit_aniso.rtap()
-        self._results["rtap"] = self._save_scalar(rtap, "_rtap", runtime, dwi_img)
-
-        rtpp = mapfit_aniso.rtpp()
-        self._results["rtpp"] = self._save_scalar(rtpp, "_rtpp", runtime, dwi_img)
-
-        coeffs = mapfit_aniso.mapmri_coeff
-        self._results["mapmri_coeffs"] = self._save_scalar(coeffs, "_mapcoeffs", runtime, dwi_img)
-
-        if self.inputs.anisotropic_scaling:
-            ng = mapfit_aniso.ng()
-            self._results["ng"] = self._save_scalar(ng, "_ng", runtime, dwi_img)
-
-            perng = mapfit_aniso.ng_perpendicular()
-            self._results["perng"] = self._save_scalar(perng, "_perng", runtime, dwi_img)
+        make_model = partial(mapmri.MapmriModel, gtab, **model_kwargs)
+        fitted = fit_voxel_blocks(
+            make_model,
+            data,
+            {"coef": "mapmri_coeff", "mu": "mapmri_mu", "R": "mapmri_R"},
+            n_jobs=self.inputs.num_threads,
+        )
+        del data
+        self._results["mapmri_coeffs"] = self._save_scalar(
+            fitted["coef"], "_mapcoeffs", runtime, dwi_img, mask_array
+        )
 
-            parng = mapfit_aniso.ng_parallel()
-            self._results["parng"] = self._save_scalar(parng, "_parng", runtime, dwi_img)
+        _, _, hs = _odf8_hemisphere()
+        map_metrics = MapmriMetrics(make_model(), sphere=hs)
+        values = map_metrics.compute(
+            [MAPMRI_METRICS[name][0] for name in metrics] + ["odf"],
+            fitted["coef"],
+            fitted["mu"],
+            fitted["R"],
+        )
+        for name in metrics:
+            metric, suffix = MAPMRI_METRICS[name]
+            self._results[name] = self._save_scalar(
+                values[metric], suffix, runtime, dwi_img, mask_array
+            )
 
         # Write DSI Studio or MRtrix
-        self._write_external_formats(runtime, mapfit_aniso, mask_img, "_MAPMRI")
+        self._write_external_formats(
+            runtime, values["odf"], mask_img, "_MAPMRI", mask_array=mask_array
+        )
 
         return runtime
 
@@ -393,17 +479,13 @@ class BrainSuiteShoreReconstruction(DipyReconInterface):
         gtab = self._get_gtab()
         b0s_mask = gtab.b0s_mask
         dwis_mask = np.logical_not(b0s_mask)
-        dwi_img = nb.load(self.inputs.dwi_file)
-        dwi_data = dwi_img.get_fdata(dtype="float32")
-        b0_images = dwi_data[..., b0s_mask]
-        b0_mean = b0_images.mean(3)
-        dwi_images = dwi_data[..., dwis_mask]
-
+        dwi_img = self._load_dwi()
         mask_img, mask_array = self._get_mask(dwi_img, gtab)
 
+        # The mean b=0 signal is the first measurement
+        final_data = self._get_masked_data(dwi_img, mask_array, b0s_mask=b0s_mask)
         final_bvals = np.concatenate([np.array([0]), gtab.bvals[dwis_mask]])
         final_bvecs = np.row_stack([np.array([0.0, 0.0, 0.0]), gtab.bvecs[dwis_mask]])
-        final_data = np.concatenate([b0_mean[..., np.newaxis], dwi_images], 3)
         final_grads = gradient_table(
             bvals=final_bvals,
             bvecs=final_bvecs,
@@ -412,12 +494,8 @@ class BrainSuiteShoreReconstruction(DipyReconInterface):
             small_delta=self.inputs.little_delta,
         )
 
-        # Cleanup
-        del dwi_images
-        del b0_images
-        del dwi_data
-
-        bss_model = BrainSuiteShoreModel(
+        make_model = partial(
+            BrainSuiteShoreModel,
             final_grads,
             regularization=self.inputs.regularization,
             radial_order=self.inputs.radial_order,
@@ -436,7 +514,29 @@ class BrainSuiteShoreReconstruction(DipyReconInterface):
             # For EAP
             pos_grid=self.inputs.pos_grid,
         )
-        bss_fit = bss_model.fit(final_data, mask=mask_array)
+        fitted = fit_voxel_blocks(
+            make_model,
+            final_data,
+            {
+                "shore_coeff": "shore_coeff",
+                "regularization": "regularization",
+                "alpha": "alpha",
+                "r2": "r2",
+                "cnr": "cnr",
+            },
+            n_jobs=self.inputs.num_threads,
+            block_multiple=L1_WARM_START_VOXELS,
+        )
+        del final_data
+        bss_fit = BrainSuiteShoreFit(
+            make_model(),
+            _unmask(fitted["shore_coeff"], mask_array),
+            regularization=_unmask(fitted["regularization"], mask_array),
+            alpha=_unmask(fitted["alpha"], mask_array),
+            r2=_unmask(fitted["r2"], mask_array),
+            cnr=_unmask(fitted["cnr"], mask_array),
+            mask=mask_array,
+        )
         rtop = bss_fit.rtop_signal()
         coeffs = bss_fit.shore_coeff
 
@@ -467,7 +567,8 @@ class BrainSuiteShoreReconstruction(DipyReconInterface):
         self._results["regularization_image"] = regl_file
 
         # Write DSI Studio or MRtrix
-        self._write_external_formats(runtime, bss_fit, mask_img, "_BS3dSHORE")
+        _, _, hs = _odf8_hemisphere()
+        self._write_external_formats(runtime, bss_fit.odf(hs), mask_img, "_BS3dSHORE")
         # Make HARDIs if desired
         extrapolate = self.inputs.extrapolate_scheme
         if isdefined(extrapolate):
@@ -494,14 +595,14 @@ class TensorReconstruction(DipyReconInterface):
 
     def _run_interface(self, runtime):
         gtab = self._get_gtab()
-        dwi_img = nb.load(self.inputs.dwi_file)
-        dwi_data = dwi_img.get_fdata(dtype="float32")
+        dwi_img = self._load_dwi()
         mask_img, mask_array = self._get_mask(dwi_img, gtab)
+        dwi_data = self._get_masked_data(dwi_img, mask_array)
 
         # Fit it
         tenmodel = dti.TensorModel(gtab)
-        ten_fit = tenmodel.fit(dwi_data, mask_array)
-        lower_triangular = ten_fit.lower_triangular()
+        ten_fit = tenmodel.fit(dwi_data)
+        lower_triangular = _unmask(ten_fit.lower_triangular(), mask_array)
         tensor_img = nifti1_symmat(lower_triangular, dwi_img.affine)
         output_tensor_file = fname_presuffix(
             self.inputs.dwi_file, suffix="tensor", newpath=runtime.cwd, use_ext=True
@@ -510,7 +611,7 @@ class TensorReconstruction(DipyReconInterface):
 
         # FA MD RD and AD
         for metric in ["fa", "md", "rd", "ad", "color_fa"]:
-            data = getattr(ten_fit, metric).astype("float32")
+            data = _unmask(getattr(ten_fit, metric).astype("float32"), mask_array)
             out_name = fname_presuffix(
                 self.inputs.dwi_file, suffix=metric, newpath=runtime.cwd, use_ext=True
             )
@@ -545,14 +646,34 @@ class KurtosisReconstruction(DipyReconInterface):
 
     def _run_interface(self, runtime):
         gtab = self._get_gtab()
-        dwi_img = nb.load(self.inputs.dwi_file)
-        dwi_data = dwi_img.get_fdata(dtype="float32")
+        dwi_img = self._load_dwi()
         mask_img, mask_array = self._get_mask(dwi_img, gtab)
+        dwi_data = self._get_masked_data(dwi_img, mask_array)
 
         # Fit it
-        dkimodel = dki.DiffusionKurtosisModel(gtab)
-        dkifit = dkimodel.fit(dwi_data, mask_array)
-        lower_triangular = dkifit.lower_triangular()
+        clip_range = (
+            float(self.inputs.kurtosis_clip_min),
+            float(self.inputs.kurtosis_clip_max),
+        )
+        outputs = {
+            "lower_triangular": "lower_triangular",
+            "fa": "fa",
+            "md": "md",
+            "rd": "rd",
+            "ad": "ad",
+            "colorFA": "color_fa",
+            "kfa": "kfa",
+        }
+        # The kurtosis metrics are methods, called with the clipping range
+        outputs.update({metric: (metric,) + clip_range for metric in ["mk", "ak", "rk", "mkt"]})
+        fitted = fit_voxel_blocks(
+            partial(dki.DiffusionKurtosisModel, gtab),
+            dwi_data,
+            outputs,
+            n_jobs=self.inputs.num_threads,
+        )
+        del dwi_data
+        lower_triangular = _unmask(fitted["lower_triangular"], mask_array)
         tensor_img = nifti1_symmat(lower_triangular, dwi_img.affine)
         output_tensor_file = fname_presuffix(
             self.inputs.dwi_file, suffix="DKItensor", newpath=runtime.cwd, use_ext=True
@@ -562,8 +683,7 @@ class KurtosisReconstruction(DipyReconInterface):
 
         # FA MD RD and AD
         for metric in ["fa", "md", "rd", "ad", "colorFA", "kfa"]:
-            metric_attr = metric if metric != "colorFA" else "color_fa"
-            data = np.nan_to_num(getattr(dkifit, metric_attr).astype("float32"), 0)
+            data = _unmask(np.nan_to_num(fitted[metric].astype("float32"), 0), mask_array)
             out_name = fname_presuffix(
                 self.inputs.dwi_file, suffix="DKI" + metric, newpath=runtime.cwd, use_ext=True
             )
@@ -572,12 +692,7 @@ class KurtosisReconstruction(DipyReconInterface):
 
         # Get the kurtosis metrics
         for metric in ["mk", "ak", "rk", "mkt"]:
-            data = np.nan_to_num(
-                getattr(dkifit, metric)(
-                    float(self.inputs.kurtosis_clip_min), float(self.inputs.kurtosis_clip_max)
-                ),
-                0,
-            )
+            data = _unmask(np.nan_to_num(fitted[metric], 0), mask_array)
             out_name = fname_presuffix(
                 self.inputs.dwi_file, suffix="DKI" + metric, newpath=runtime.cwd, use_ext=True
             )
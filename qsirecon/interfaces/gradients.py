@@ -14,6 +14,7 @@ from nipype.interfaces.base import (
     traits,
 )
 from nipype.utils.filemanip import fname_presuffix
+from scipy.spatial import cKDTree
 
 LOGGER = logging.getLogger("nipype.interface")
 
@@ -48,26 +49,7 @@ class RemoveDuplicates(SimpleInterface):
         cutoff = self.inputs.distance_cutoff
 
         scaled_bvecs = bvals[:, np.newaxis] * bvecs
-        ok_vecs = []
-        seen_vecs = []
-
-        def is_unique_sample(vec):
-            if len(seen_vecs) == 0:
-                return True
-            vec_array = np.row_stack(seen_vecs)
-            distances = np.linalg.norm(vec_array - vec, axis=1)
-            distances_flip = np.linalg.norm(vec_array + vec, axis=1)
-            return np.all(distances > cutoff) and np.all(distances_flip > cutoff)
-
-        for vec_num, vec in enumerate(scaled_bvecs):
-            magnitude = np.linalg.norm(vec)
-            # Is it a b0?
-            if magnitude < cutoff:
-                ok_vecs.append(vec_num)
-            else:
-                if is_unique_sample(vec):
-                    ok_vecs.append(vec_num)
-                    seen_vecs.append(vec)
+        ok_vecs, seen_vecs = unique_sample_indices(scaled_bvecs, cutoff)
 
         # If an expected number of directions was specified, check that it's there
         expected = self.inputs.expected_directions
@@ -95,7 +77,7 @@ class RemoveDuplicates(SimpleInterface):
         np.savetxt(output_bval, unique_bvals, fmt="%d", newline=" ")
         unique_bvecs = bvecs[unique_indices]
         np.savetxt(output_bvec, unique_bvecs.T, fmt="%.8f")
-        unique_data = original_image.get_fdata()[..., unique_indices]
+        unique_data = read_volumes(original_image, unique_indices)
         nb.Nifti1Image(unique_data, original_image.affine, original_image.header).to_filename(
             output_nii
         )
@@ -153,6 +135,68 @@ class ExtractB0s(SimpleInterface):
         return runtime
 
 
+def unique_sample_indices(scaled_bvecs, cutoff):
+    """Find the q-space samples that are not repeats of an earlier sample.
+
+    Samples within ``cutoff`` of the origin are treated as b=0 and always kept.
+    Any other sample is dropped if it, or its antipode, is within ``cutoff``
+    of an earlier sample that was kept.
+
+    Parameters
+    ----------
+    scaled_bvecs : (N, 3) ndarray
+        Gradient directions scaled by the (normalized) q-space radius.
+    cutoff : float
+        Samples closer than this distance are considered duplicates.
+
+    Returns
+    -------
+    ok_indices : ndarray
+        Indices of all the samples to keep, b=0 included.
+    unique_indices : ndarray
+        Indices of the kept samples that are not b=0.
+    """
+    is_b0 = np.linalg.norm(scaled_bvecs, axis=1) < cutoff
+    candidates = np.flatnonzero(~is_b0)
+    n_candidates = len(candidates)
+
+    # Find all close pairs, including antipodal ones, in a single query
+    points = scaled_bvecs[candidates]
+    tree = cKDTree(np.concatenate([points, -points]))
+    pairs = tree.query_pairs(cutoff, output_type="ndarray") % n_candidates
+    pairs = np.sort(pairs[pairs[:, 0] != pairs[:, 1]], axis=1)
+    pairs = pairs[np.lexsort((pairs[:, 0], pairs[:, 1]))]
+
+    # A sample is a duplicate only if it is close to an earlier sample that was kept.
+    # Pairs are sorted by their later sample, so earlier samples are already resolved.
+    keep = np.ones(n_candidates, dtype=bool)
+    for earlier, later in pairs:
+        if keep[earlier]:
+            keep[later] = False
+
+    is_b0[candidates[keep]] = True
+    return np.flatnonzero(is_b0), candidates[keep]
+
+
+def read_volumes(img, volume_indices):
+    """Read a subset of the volumes of a 4D image through its proxy.
+
+    Consecutive volumes are read together and the data keeps the dtype that
+    ``img.dataobj`` returns, so integer images are not promoted to float64.
+    """
+    volume_indices = np.asarray(volume_indices)
+    runs = np.split(volume_indices, np.flatnonzero(np.diff(volume_indices) != 1) + 1)
+    volumes = None
+    offset = 0
+    for run in runs:
+        chunk = np.asanyarray(img.dataobj[..., run[0] : run[-1] + 1])
+        if volumes is None:
+            volumes = np.empty(img.shape[:3] + (len(volume_indices),), dtype=chunk.dtype)
+        volumes[..., offset : offset + len(run)] = chunk
+        offset += len(run)
+    return volumes
+
+
 def concatenate_bvals(bval_list, out_file):
     """Create an FSL-style bvals file from split bval files."""
     collected_vals = []
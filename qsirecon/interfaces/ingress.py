@@ -19,9 +19,10 @@ Disable warnings:
 
 """
 
+import os
 import os.path as op
 import shutil
-from glob import glob
+from fnmatch import fnmatch
 from pathlib import Path
 
 import nibabel as nb
@@ -31,6 +32,7 @@ from nipype.interfaces.base import (
     File,
     SimpleInterface,
     TraitedSpec,
+    isdefined,
     traits,
 )
 from nipype.utils.filemanip import split_filename
@@ -50,6 +52,10 @@ class QSIPrepDWIIngressInputSpec(BaseInterfaceInputSpec):
     bvec_file = File(exists=True)
     b_file = File(exists=True)
     atlas_names = traits.List()
+    associated_files = traits.Dict(
+        desc="files that go with dwi_file, as returned by get_dwi_associations. "
+        "If not provided, they are found by listing the directory of dwi_file"
+    )
 
 
 class QSIPrepDWIIngressOutputSpec(TraitedSpec):
@@ -88,19 +94,13 @@ class QSIPrepDWIIngress(SimpleInterface):
         out_root, fname, _ = split_filename(self.inputs.dwi_file)
         self._results["bval_file"] = op.join(out_root, fname + ".bval")
         self._results["bvec_file"] = op.join(out_root, fname + ".bvec")
-        self._get_if_exists("confounds_file", op.join(out_root, "*confounds.tsv"))
-        self._get_if_exists("local_bvec_file", op.join(out_root, fname[:-3] + "bvec.nii*"))
-        self._get_if_exists("b_file", op.join(out_root, fname + ".b"))
-        self._get_if_exists("mask_file", op.join(out_root, fname[:-11] + "brain_mask.nii*"))
-        self._get_if_exists("dwi_ref", op.join(out_root, fname[:-16] + "dwiref.nii*"))
+        if isdefined(self.inputs.associated_files):
+            associated_files = self.inputs.associated_files
+        else:
+            associated_files = get_dwi_associations(self.inputs.dwi_file)
+        self._results.update(associated_files)
         self._results["dwi_file"] = self.inputs.dwi_file
 
-        # Image QC doesn't include space
-        self._get_if_exists("qc_file", self._get_qc_filename(out_root, params, "ImageQC", "csv"))
-        self._get_if_exists(
-            "slice_qc_file", self._get_qc_filename(out_root, params, "SliceQC", "json")
-        )
-
         # Get the anatomical data
         path_parts = out_root.split(op.sep)[:-1]  # remove "dwi"
         # Anat is above ses
@@ -108,17 +108,53 @@ class QSIPrepDWIIngress(SimpleInterface):
             path_parts.pop()
         return runtime
 
-    def _get_if_exists(self, name, pattern, multi_ok=False):
-        files = glob(pattern)
-        if len(files) == 1:
-            self._results[name] = files[0]
-        if len(files) > 1 and multi_ok:
-            self._results[name] = files[0]
-
-    def _get_qc_filename(self, out_root, params, desc, suffix):
-        used_keys = ["subject_id", "session_id", "acq_id", "dir_id", "run_id"]
-        fname = "_".join([params[key] for key in used_keys if params[key]])
-        return out_root + "/" + fname + "_desc-%s_dwi.%s" % (desc, suffix)
+
+def get_dwi_associations(dwi_file, candidate_files=None):
+    """Find the files that go with a QSIPrep-preprocessed DWI file.
+
+    Parameters
+    ----------
+    dwi_file : :obj:`str`
+        Path to the preprocessed DWI file.
+    candidate_files : :obj:`list` of :obj:`str`, optional
+        Paths of the files to choose from, such as the files of a subject in a BIDS
+        index. If not provided, the directory of ``dwi_file`` is listed.
+
+    Returns
+    -------
+    associated_files : :obj:`dict`
+        Maps QSIPrepDWIIngress output names to the files that were found.
+        Outputs with no file, or with more than one matching file, are left out.
+    """
+    out_root, fname, _ = split_filename(dwi_file)
+    if candidate_files is None:
+        names = os.listdir(out_root)
+    else:
+        names = [op.basename(path) for path in candidate_files if op.dirname(path) == out_root]
+
+    # Image QC doesn't include space
+    params = get_bids_params(dwi_file)
+    patterns = {
+        "confounds_file": "*confounds.tsv",
+        "local_bvec_file": fname[:-3] + "bvec.nii*",
+        "b_file": fname + ".b",
+        "mask_file": fname[:-11] + "brain_mask.nii*",
+        "dwi_ref": fname[:-16] + "dwiref.nii*",
+        "qc_file": _get_qc_filename(params, "ImageQC", "csv"),
+        "slice_qc_file": _get_qc_filename(params, "SliceQC", "json"),
+    }
+    associated_files = {}
+    for output_name, pattern in patterns.items():
+        matches = [name for name in names if fnmatch(name, pattern)]
+        if len(matches) == 1:
+            associated_files[output_name] = op.join(out_root, matches[0])
+    return associated_files
+
+
+def _get_qc_filename(params, desc, suffix):
+    used_keys = ["subject_id", "session_id", "acq_id", "dir_id", "run_id"]
+    fname = "_".join([params[key] for key in used_keys if params[key]])
+    return fname + "_desc-%s_dwi.%s" % (desc, suffix)
 
 
 class _UKBioBankDWIIngressInputSpec(QSIPrepDWIIngressInputSpec):
@@ -13,6 +13,7 @@ import os.path as op
 import zipfile
 from copy import deepcopy
 
+import nibabel as nb
 import nipype.interfaces.utility as niu
 import nipype.pipeline.engine as pe
 import numpy as np
@@ -29,7 +30,7 @@ from nipype.interfaces.base import (
     isdefined,
     traits,
 )
-from nipype.interfaces.mrtrix3 import Generate5tt, MRConvert, ResponseSD
+from nipype.interfaces.mrtrix3 import Generate5tt, ResponseSD
 from nipype.interfaces.mrtrix3.base import MRTrix3Base, MRTrix3BaseInputSpec
 from nipype.interfaces.mrtrix3.preprocess import ResponseSDInputSpec
 from nipype.interfaces.mrtrix3.tracking import Tractography, TractographyInputSpec
@@ -37,6 +38,8 @@ from nipype.interfaces.mrtrix3.utils import Generate5ttInputSpec
 from nipype.utils.filemanip import fname_presuffix, split_filename, which
 from scipy.io.matlab import loadmat, savemat
 
+from ..utils.mif import load_image, save_mif
+
 LOGGER = logging.getLogger("nipype.interface")
 RC3_ROOT = which("average_response")  # Only exists in RC3
 if RC3_ROOT is not None:
@@ -116,6 +119,12 @@ class MRTrixIngressOutputSpec(TraitedSpec):
 
 
 class MRTrixIngress(SimpleInterface):
+    """Write a DWI series to a ``.mif`` file with its gradient table in the header.
+
+    This is what ``mrconvert -grad`` (or ``-fslgrad``) does, written in-process
+    and streamed from the input image.
+    """
+
     input_spec = MRTrixIngressInputSpec
     output_spec = MRTrixIngressOutputSpec
 
@@ -126,25 +135,53 @@ class MRTrixIngress(SimpleInterface):
             newpath=runtime.cwd,
             use_ext=False,
         )
+        dwi_img = nb.load(self.inputs.dwi_file)
         if isdefined(self.inputs.b_file):
-            convert = MRConvert(
-                in_file=self.inputs.dwi_file, grad_file=self.inputs.b_file, out_file=output_mif
-            )
+            dw_scheme = np.loadtxt(self.inputs.b_file, ndmin=2)
         elif isdefined(self.inputs.bval_file) and isdefined(self.inputs.bvec_file):
-            convert = MRConvert(
-                in_file=self.inputs.dwi_file,
-                in_bval=self.inputs.bval_file,
-                in_bvec=self.inputs.bvec_file,
-                out_file=output_mif,
+            dw_scheme = _fsl_to_dw_scheme(
+                self.inputs.bval_file, self.inputs.bvec_file, dwi_img.affine
             )
         else:
             raise Exception("No valid mrtrix gradient files or fsl bval/bvec files specified")
-        convert_run = convert.run()
-        self._results["mif_file"] = convert_run.outputs.out_file
+        if dw_scheme.shape != (dwi_img.shape[3], 4):
+            raise ValueError("The gradient table does not match the number of volumes")
+
+        # Keep the stored data type unless the image has to be scaled
+        dtype = dwi_img.get_data_dtype()
+        slope = getattr(dwi_img.dataobj, "slope", 1.0)
+        inter = getattr(dwi_img.dataobj, "inter", 0.0)
+        if slope != 1.0 or inter != 0.0:
+            dtype = np.dtype("float32")
+        save_mif(
+            output_mif,
+            dwi_img.dataobj,
+            dwi_img.affine,
+            zooms=dwi_img.header.get_zooms(),
+            dtype=dtype,
+            extra={"dw_scheme": [",".join("%.10g" % val for val in row) for row in dw_scheme]},
+        )
+        self._results["mif_file"] = output_mif
 
         return runtime
 
 
+def _fsl_to_dw_scheme(bval_file, bvec_file, affine):
+    """Get the gradient table ``mrconvert -fslgrad`` stores for an image with ``affine``.
+
+    FSL bvecs are in the voxel frame, with x flipped if the image's transform
+    has a positive determinant. The table is in scanner coordinates.
+    """
+    bvecs = np.loadtxt(bvec_file, ndmin=2)
+    if bvecs.shape[0] != 3:
+        bvecs = bvecs.T
+    bvals = np.loadtxt(bval_file, ndmin=1).ravel()
+    rotation = affine[:3, :3] / nb.affines.voxel_sizes(affine)
+    if np.linalg.det(rotation) > 0:
+        bvecs = bvecs * np.array([[-1.0], [1.0], [1.0]])
+    return np.column_stack([(rotation @ bvecs).T, bvals])
+
+
 class GenerateMasked5ttInputSpec(Generate5ttInputSpec):
     algorithm = traits.Enum(
         "fsl",
@@ -1094,23 +1131,51 @@ class ITKTransformConvert(CommandLine):
     output_spec = _ITKTransformConvertOutputSpec
 
 
-class _TransformHeaderInputSpec(CommandLineInputSpec):
-    transform_file = traits.File(exists=True, position=0, mandatory=True, argstr="-linear %s")
-    in_image = traits.File(exists=True, mandatory=True, position=1, argstr="%s")
-    out_image = traits.File(
-        argstr="%s",
-        name_source="in_image",
-        name_template="%s_hdrxform.nii.gz",
-        keep_extension=False,
-        position=-1,
+class _TransformHeaderInputSpec(BaseInterfaceInputSpec):
+    transform_file = File(
+        exists=True, desc="MRtrix linear transform. If not given, the image is only converted."
     )
+    in_image = File(exists=True, mandatory=True, desc="NIfTI, MGH or MRtrix image")
+    out_image = File(desc="output NIfTI image (default: <in_image>_hdrxform.nii.gz)")
 
 
 class _TransformHeaderOutputSpec(TraitedSpec):
     out_image = File(exists=True)
 
 
-class TransformHeader(CommandLine):
+class TransformHeader(SimpleInterface):
+    """Apply a linear transform to the header of an image, without resampling it.
+
+    This is what ``mrtransform -strides -1,-2,3 -linear`` does. The transform
+    maps points from the output to the input image, MRtrix's "reverse"
+    convention, so the output's affine is its inverse times the input's.
+    The output is a NIfTI image stored in LPS+ orientation.
+    """
+
     input_spec = _TransformHeaderInputSpec
     output_spec = _TransformHeaderOutputSpec
-    _cmd = "mrtransform -strides -1,-2,3"
+
+    def _run_interface(self, runtime):
+        from .images import to_lps
+
+        if isdefined(self.inputs.out_image):
+            out_image = op.abspath(self.inputs.out_image)
+        else:
+            _, in_base, _ = split_filename(self.inputs.in_image)
+            out_image = op.join(runtime.cwd, in_base.replace(".mif", "") + "_hdrxform.nii.gz")
+
+        lps_img = to_lps(load_image(self.inputs.in_image))
+        affine = lps_img.affine
+        if isdefined(self.inputs.transform_file):
+            transform = np.loadtxt(self.inputs.transform_file, comments="#", ndmin=2)
+            if transform.shape == (3, 4):
+                transform = np.vstack([transform, [0.0, 0.0, 0.0, 1.0]])
+            affine = np.linalg.inv(transform) @ affine
+
+        out_img = nb.Nifti1Image(np.asanyarray(lps_img.dataobj), affine)
+        out_img.set_data_dtype(lps_img.get_data_dtype())
+        out_img.set_qform(affine, 1)
+        out_img.set_sform(affine, 1)
+        out_img.to_filename(out_image)
+        self._results["out_image"] = out_image
+        return runtime
@@ -132,19 +132,25 @@ class ReconScalarsTableSplitterDataSink(SimpleInterface):
 
     def _run_interface(self, runtime):
         summary_df = pd.read_table(self.inputs.summary_tsv)
-        for qsirecon_suffix, group_df in summary_df.groupby("qsirecon_suffix"):
+        # Atlas summaries get one file per atlas
+        group_columns = ["qsirecon_suffix"]
+        if "atlas" in summary_df.columns:
+            group_columns.append("atlas")
+        for _, group_df in summary_df.groupby(group_columns):
             # reset the index for this df
-            group_df.reset_index(drop=True, inplace=True)
+            group_df = group_df.reset_index(drop=True)
+            output_bids_entities = {"suffix": self.inputs.suffix}
+            if "bundle_source" in group_df.columns:
+                output_bids_entities["bundles"] = group_df.loc[0, "bundle_source"]
+            if "atlas" in group_df.columns:
+                output_bids_entities["atlas"] = group_df.loc[0, "atlas"]
 
             qsirecon_suffixed_tsv = get_recon_output_name(
                 base_dir=self.inputs.base_directory,
                 source_file=group_df.loc[0, "source_file"],
                 derivative_file=self.inputs.summary_tsv,
-                output_bids_entities={
-                    "suffix": self.inputs.suffix,
-                    "bundles": group_df.loc[0, "bundle_source"],
-                },
-                qsirecon_suffix=qsirecon_suffix,
+                output_bids_entities=output_bids_entities,
+                qsirecon_suffix=group_df.loc[0, "qsirecon_suffix"],
                 dismiss_entities=self.inputs.dismiss_entities,
             )
             output_dir = op.dirname(qsirecon_suffixed_tsv)
@@ -271,6 +271,13 @@ class _ReconPeaksReportInputSpec(CommandLineInputSpec):
         argstr="--subtract-iso",
         desc="subtract isotropic component from ODFs",
     )
+    nthreads = traits.Int(
+        1, usedefault=True, nohash=True, argstr="--nthreads %d", desc="number of threads"
+    )
+    tile_size = traits.Int(argstr="--tile_size %d", desc="size in pixels of each rendered slice")
+    sloppy = traits.Bool(
+        False, usedefault=True, argstr="--sloppy", desc="render small tiles to minimize run time"
+    )
 
 
 class _ReconPeaksReportOutputSpec(TraitedSpec):
@@ -5,11 +5,12 @@
 import logging
 import os.path as op
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 
+import nibabel as nb
 import nilearn.image as nim
 import numpy as np
 import pandas as pd
-from nilearn.maskers import NiftiMasker
 from nipype.interfaces import ants
 from nipype.interfaces.base import (
     BaseInterfaceInputSpec,
@@ -98,50 +99,70 @@ class BundleMapper(ScalarMapper):
     output_spec = _BundleMapperOutputSpec
 
     def _do_mapping(self, runtime):
-        self._load_scalars()
-        bundle_dfs = []
-        tdi_dfs = []
         source_suffix = self.inputs.mapping_metadata.get("qsirecon_suffix", "QSIRecon")
-        for tck_name, tck_file in zip(self.inputs.bundle_names, self.inputs.tck_files):
+        bundles = list(zip(self.inputs.bundle_names, self.inputs.tck_files))
+        bundle_names = [bundle_name for bundle_name, _ in bundles]
+        # The TDIs are created on the grid of the dwiref image
+        ref_img = nim.load_img(self.inputs.dwiref_image)
+
+        # Find the voxels and streamline counts of every bundle once
+        voxel_indices = []
+        tdi_values = []
+        for _, tck_file in bundles:
             output_tdi_file = fname_presuffix(
                 tck_file, suffix="_tdi.nii", newpath=runtime.cwd, use_ext=False
             )
 
             # Create a TDI, where streamline count is mapped to voxels
             tdi_img = _get_tdi_img(self.inputs.dwiref_image, tck_file, output_tdi_file)
-
-            # Create a Masker from all voxels containing streamlines
-            msk_img = nim.math_img("a>0", a=tdi_img)
-            bundle_masker = NiftiMasker(msk_img)
-
-            # Get a weighting vector from the TDI
-            tdi_weights = bundle_masker.fit_transform(tdi_img).squeeze()
-            tdi_weights = tdi_weights / tdi_weights.sum()
-
-            # Start gathering stats with the TDI first
-            tdi_dfs.append(
+            tdi_data = _flat_scalar_data(tdi_img, ref_img)
+
+            # Keep all voxels containing streamlines
+            voxel_index = np.flatnonzero(tdi_data > 0)
+            voxel_indices.append(voxel_index)
+            tdi_values.append(tdi_data[voxel_index])
+
+        # Stack the bundles so all of them are summarized in one pass
+        segment_ids = np.repeat(np.arange(len(voxel_indices)), [len(idx) for idx in voxel_indices])
+        voxel_index = np.concatenate(voxel_indices) if voxel_indices else np.zeros(0, dtype=int)
+        tdi_values = np.concatenate(tdi_values) if tdi_values else np.zeros(0, dtype=np.float32)
+
+        # Get a weighting vector from the TDI
+        with np.errstate(invalid="ignore", divide="ignore"):
+            tdi_weights = tdi_values / np.bincount(segment_ids, weights=tdi_values)[segment_ids]
+
+        # Start gathering stats with the TDI first
+        tdi_dfs = calculate_mask_stats(
+            tdi_values,
+            segment_ids,
+            bundle_names,
+            "bundle",
+            {
+                "variable_name": "tdi",
+                # Check that this is ok:
+                "source_file": self.inputs.recon_scalars[0]["source_file"],
+                "qsirecon_suffix": source_suffix,
+                "desc": "Streamline counts per voxel",
+            },
+        )
+
+        # Then get the same stats for the scalars, loading each scalar only once
+        scalar_stats = []
+        for recon_scalar in self.inputs.recon_scalars:
+            scalar_data = _flat_scalar_data(nim.load_img(recon_scalar["path"]), ref_img)
+            scalar_stats.append(
                 calculate_mask_stats(
-                    bundle_masker,
-                    tck_name,
+                    scalar_data[voxel_index],
+                    segment_ids,
+                    bundle_names,
                     "bundle",
-                    {
-                        "image": tdi_img,
-                        "variable_name": "tdi",
-                        # Check that this is ok:
-                        "source_file": self.inputs.recon_scalars[0]["source_file"],
-                        "qsirecon_suffix": source_suffix,
-                        "desc": "Streamline counts per voxel",
-                    },
+                    recon_scalar,
+                    tdi_weights,
                 )
             )
-
-            # Then get the same stats for the scalars
-            for recon_scalar in self.inputs.recon_scalars:
-                bundle_dfs.append(
-                    calculate_mask_stats(
-                        bundle_masker, tck_name, "bundle", recon_scalar, tdi_weights
-                    )
-                )
+        bundle_dfs = [
+            rows[bundle_num] for bundle_num in range(len(bundle_names)) for rows in scalar_stats
+        ]
 
         # Write the scalar summary df
         self._update_with_bids_info(bundle_dfs)
@@ -167,48 +188,171 @@ class BundleMapper(ScalarMapper):
 
 
 # For mapping to atlases
+class _AtlasMapperInputSpec(ScalarMapperInputSpec):
+    atlas_configs = traits.Dict(mandatory=True, desc="atlases resampled to the DWI, by name")
+
+
+class _AtlasMapperOutputSpec(ScalarMapperOutputSpec):
+    atlas_summary = File(exists=True)
+
+
+class AtlasMapper(ScalarMapper):
+    input_spec = _AtlasMapperInputSpec
+    output_spec = _AtlasMapperOutputSpec
+
+    def _do_mapping(self, runtime):
+        if not self.inputs.atlas_configs:
+            raise Exception("Atlas mapping requires atlases in the recon spec")
+        ref_img = nim.load_img(self.inputs.dwiref_image)
+
+        # Find the voxels and region of every atlas once. The regions of all the
+        # atlases are numbered consecutively, so they are all summarized in one pass.
+        atlas_names = sorted(self.inputs.atlas_configs)
+        voxel_indices = []
+        segment_ids = []
+        region_atlases = []
+        region_names = []
+        for atlas_name in atlas_names:
+            atlas_config = self.inputs.atlas_configs[atlas_name]
+            voxel_index, region_index = _atlas_regions(
+                atlas_config["dwi_resolution_file"], atlas_config["node_ids"], ref_img
+            )
+            voxel_indices.append(voxel_index)
+            segment_ids.append(region_index + len(region_names))
+            region_atlases.extend([atlas_name] * len(atlas_config["node_ids"]))
+            region_names.extend(atlas_config["node_names"])
+        voxel_index = np.concatenate(voxel_indices)
+        segment_ids = np.concatenate(segment_ids)
+
+        # Summarize each scalar in every region, loading each scalar only once
+        scalar_stats = []
+        for recon_scalar in self.inputs.recon_scalars:
+            if recon_scalar.get("reorient_on_resample", False):
+                continue
+            scalar_data = _flat_scalar_data(nim.load_img(recon_scalar["path"]), ref_img)
+            scalar_stats.append(
+                calculate_mask_stats(
+                    scalar_data[voxel_index], segment_ids, region_names, "region", recon_scalar
+                )
+            )
+        atlas_dfs = []
+        for region_num, atlas_name in enumerate(region_atlases):
+            for rows in scalar_stats:
+                rows[region_num]["atlas"] = atlas_name
+                atlas_dfs.append(rows[region_num])
+
+        self._update_with_bids_info(atlas_dfs)
+        summary_file = op.join(runtime.cwd, "atlas_stats.tsv")
+        pd.DataFrame(atlas_dfs).to_csv(summary_file, index=False, sep="\t")
+        self._results["atlas_summary"] = summary_file
+
+
+def _atlas_regions(atlas_file, node_ids, ref_img):
+    """Find the voxels of an atlas that are in a region, and the position of their region."""
+    atlas_img = nim.load_img(atlas_file)
+    if atlas_img.shape[:3] != ref_img.shape[:3] or not np.allclose(
+        atlas_img.affine, ref_img.affine
+    ):
+        atlas_img = nim.resample_to_img(atlas_img, ref_img, interpolation="nearest")
+    labels = np.asanyarray(atlas_img.dataobj).reshape(-1).astype(np.int64)
+
+    # Look up the position of each voxel's label in node_ids, with -1 for unknown labels
+    node_ids = np.asarray(node_ids, dtype=np.int64)
+    order = np.argsort(node_ids)
+    positions = np.searchsorted(node_ids[order], labels).clip(max=len(node_ids) - 1)
+    region_index = np.where(node_ids[order][positions] == labels, order[positions], -1)
+
+    voxel_index = np.flatnonzero(region_index >= 0)
+    return voxel_index, region_index[voxel_index]
+
+
+def _flat_scalar_data(img, ref_img):
+    """Load a 3D image as a flat float32 array on the voxel grid of ``ref_img``."""
+    if img.shape[:3] != ref_img.shape[:3] or not np.allclose(img.affine, ref_img.affine):
+        img = nim.resample_to_img(img, ref_img)
+    data = np.asarray(img.get_fdata(dtype=np.float32)).reshape(-1)
+    # Non-finite values are treated as zeros, as NiftiMasker does
+    data[~np.isfinite(data)] = 0
+    return data
+
+
+def _segment_median(values, segment_ids, n_segments):
+    """Median of ``values`` within each segment, NaN for empty segments."""
+    order = np.lexsort((values, segment_ids))
+    sorted_values = values[order]
+    counts = np.bincount(segment_ids, minlength=n_segments)
+    starts = np.cumsum(counts) - counts
+    medians = np.full(n_segments, np.nan)
+    nonempty = counts > 0
+    low = (starts + (counts - 1) // 2)[nonempty]
+    high = (starts + counts // 2)[nonempty]
+    medians[nonempty] = (sorted_values[low].astype(float) + sorted_values[high]) / 2
+    return medians
 
 
 def calculate_mask_stats(
-    masker, mask_name, mask_variable_name, recon_scalar, weighting_vector=None
+    values, segment_ids, mask_names, mask_variable_name, recon_scalar, weighting_vector=None
 ):
+    """Summarize a scalar within several, possibly overlapping, masks at once.
+
+    ``values`` holds the scalar at every voxel of every mask and ``segment_ids``
+    the position in ``mask_names`` of the mask each value belongs to. If given,
+    ``weighting_vector`` holds per-value weights that sum to one within each mask.
+    Returns one summary row per mask.
+    """
+    n_masks = len(mask_names)
+    values = np.asarray(values)
+
+    def per_mask_sum(weights):
+        return np.bincount(segment_ids, weights=weights, minlength=n_masks)
 
-    # Get the scalar data in the masked region
-    voxel_data = masker.fit_transform(recon_scalar["image"]).squeeze()
     # Find out how much of this scalar is finite
-    nz_voxel_data = voxel_data.copy()
-    nz_voxel_data[nz_voxel_data == 0] = np.nan
-    nz_voxel_data[~np.isfinite(voxel_data)] = np.nan
+    nonzero = np.isfinite(values) & (values != 0)
+    nz_values = np.where(nonzero, values, 0)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        counts = np.bincount(segment_ids, minlength=n_masks)
+        nz_counts = per_mask_sum(nonzero)
+        mean = per_mask_sum(values) / counts
+        stdev = np.sqrt(per_mask_sum((values - mean[segment_ids]) ** 2) / counts)
+        masked_mean = per_mask_sum(nz_values) / nz_counts
+        masked_stdev = np.sqrt(
+            per_mask_sum(np.where(nonzero, values - masked_mean[segment_ids], 0) ** 2) / nz_counts
+        )
+        zero_proportion = (counts - nz_counts) / counts
+
+        median = _segment_median(values, segment_ids, n_masks)
+        median[per_mask_sum(np.isnan(values)) > 0] = np.nan
+        masked_median = _segment_median(values[nonzero], segment_ids[nonzero], n_masks)
+
+        if weighting_vector is not None:
+            weighted_mean = per_mask_sum(values * weighting_vector)
+            nz_weights = per_mask_sum(np.where(nonzero, weighting_vector, 0))
+            masked_weighted_mean = per_mask_sum(nz_values * weighting_vector) / nz_weights
+            masked_weighted_mean[nz_weights == 0] = 0
 
     # Make a prettier variable name
     variable_name = recon_scalar["variable_name"].replace("_image", "").replace("_file", "")
 
-    results = {
-        mask_variable_name: mask_name,
-        "variable_name": variable_name,
-        "qsirecon_suffix": recon_scalar["qsirecon_suffix"],
-        "source_file": recon_scalar["source_file"],
-        "zero_proportion": np.sum(np.isnan(nz_voxel_data)) / voxel_data.shape[0],
-        "mean": np.mean(voxel_data),
-        "stdev": np.std(voxel_data),
-        "median": np.median(voxel_data),
-        "masked_mean": np.nanmean(nz_voxel_data),
-        "masked_median": np.nanmedian(nz_voxel_data),
-        "masked_stdev": np.nanstd(nz_voxel_data),
-    }
-
-    if weighting_vector is not None:
-        results["weighted_mean"] = np.sum(voxel_data * weighting_vector)
-        nz_weighting_vector = weighting_vector.copy()
-        try:
-            nz_weighting_vector[np.isnan(nz_voxel_data)] = np.nan
-            nz_weighting_vector = nz_weighting_vector / np.nansum(nz_weighting_vector)
-            results["masked_weighted_mean"] = np.nansum(nz_voxel_data * nz_weighting_vector)
-        except Exception as exc:
-            LOGGER.warn(
-                f"Error calculating weighted mean of {variable_name} in {mask_name}\n{exc}"
-            )
-            results["masked_weighted_mean"] = np.nan
+    results = []
+    for mask_num, mask_name in enumerate(mask_names):
+        mask_results = {
+            mask_variable_name: mask_name,
+            "variable_name": variable_name,
+            "qsirecon_suffix": recon_scalar["qsirecon_suffix"],
+            "source_file": recon_scalar["source_file"],
+            "zero_proportion": zero_proportion[mask_num],
+            "mean": mean[mask_num],
+            "stdev": stdev[mask_num],
+            "median": median[mask_num],
+            "masked_mean": masked_mean[mask_num],
+            "masked_median": masked_median[mask_num],
+            "masked_stdev": masked_stdev[mask_num],
+        }
+        if weighting_vector is not None:
+            mask_results["weighted_mean"] = weighted_mean[mask_num]
+            mask_results["masked_weighted_mean"] = masked_weighted_mean[mask_num]
+        results.append(mask_results)
 
     return results
 
@@ -217,6 +361,12 @@ class _TemplateMapperInputSpec(ScalarMapperInputSpec):
     template_reference_image = File(exists=True, mandatory=True)
     to_template_transform = File(exists=True, mandatory=True)
     interpolation = traits.Str("NearestNeighbor", usedefault=True)
+    max_stack_size = traits.Int(
+        16,
+        usedefault=True,
+        desc="Maximum number of scalars stacked into a single 4D image for resampling",
+    )
+    num_threads = traits.Int(1, usedefault=True, nohash=True)
 
 
 class _TemplateMapperOutputSpec(ScalarMapperOutputSpec):
@@ -230,6 +380,7 @@ class TemplateMapper(ScalarMapper):
     output_spec = _TemplateMapperOutputSpec
 
     def _do_mapping(self, runtime):
+        input_images = []
         resampled_images = []
         resampled_image_metadata = []
         # Then get the same stats for the scalars
@@ -237,21 +388,11 @@ class TemplateMapper(ScalarMapper):
             if recon_scalar.get("reorient_on_resample", False):
                 # LOGGER.info(f"Skipping {recon_scalar}")
                 continue
+            input_images.append(nb.load(recon_scalar["path"]))
             new_metadata = recon_scalar.copy()
             output_fname = op.split(recon_scalar["path"])[1]
             output_fname = output_fname.replace("_space-T1w_", "_transformed_")
             output_fname = op.join(runtime.cwd, output_fname)
-            transform = ants.ApplyTransforms(
-                input_image=recon_scalar["path"],
-                dimension=3,
-                transforms=[self.inputs.to_template_transform],
-                reference_image=self.inputs.template_reference_image,
-                output_image=output_fname,
-                interpolation=self.inputs.interpolation,
-            )
-            transform.terminal_output = "allatonce"
-            transform.resource_monitor = False
-            transform.run()
             resampled_images.append(output_fname)
 
             # Create new metadata for the resampled image
@@ -261,6 +402,80 @@ class TemplateMapper(ScalarMapper):
             new_metadata["bids"]["space"] = "MNI152NLin2009cAsym"
             resampled_image_metadata.append(new_metadata)
 
+        # Scalars on the same voxel grid are stacked and resampled in a single call
+        grids = {}
+        for scalar_num, img in enumerate(input_images):
+            grid = (img.shape[:3], img.affine.round(6).tobytes())
+            grids.setdefault(grid, []).append(scalar_num)
+        stacks = [
+            scalar_nums[start : start + self.inputs.max_stack_size]
+            for scalar_nums in grids.values()
+            for start in range(0, len(scalar_nums), self.inputs.max_stack_size)
+        ]
+
+        # Compose the transform into a displacement field once if it is used more than once
+        transform = self.inputs.to_template_transform
+        if len(stacks) > 1:
+            warp_file = op.join(runtime.cwd, "to_template_warp.nii")
+            _run_apply_transforms(
+                input_image=self.inputs.template_reference_image,
+                dimension=3,
+                transforms=[transform],
+                reference_image=self.inputs.template_reference_image,
+                output_image=warp_file,
+                print_out_composite_warp_file=True,
+                num_threads=self.inputs.num_threads,
+            )
+            transform = warp_file
+
+        with ThreadPoolExecutor(max_workers=self.inputs.num_threads) as executor:
+            for stack_num, scalar_nums in enumerate(stacks):
+                stack_file = op.join(runtime.cwd, "scalar_stack%03d.nii" % stack_num)
+                resampled_stack_file = op.join(runtime.cwd, "resampled_stack%03d.nii" % stack_num)
+                _stack_images([input_images[scalar_num] for scalar_num in scalar_nums], stack_file)
+                _run_apply_transforms(
+                    input_image=stack_file,
+                    input_image_type=3,
+                    dimension=3,
+                    transforms=[transform],
+                    reference_image=self.inputs.template_reference_image,
+                    output_image=resampled_stack_file,
+                    interpolation=self.inputs.interpolation,
+                    float=True,
+                    num_threads=self.inputs.num_threads,
+                )
+
+                # Split the resampled stack back into one file per scalar
+                resampled_stack = nb.load(resampled_stack_file)
+                list(
+                    executor.map(
+                        _save_volume,
+                        [resampled_stack] * len(scalar_nums),
+                        range(len(scalar_nums)),
+                        [resampled_images[scalar_num] for scalar_num in scalar_nums],
+                    )
+                )
+
         self._results["template_space_scalars"] = resampled_images
         self._results["template_space_scalar_info"] = resampled_image_metadata
         self._results["template_space"] = "MNI152NLin2009cAsym"
+
+
+def _run_apply_transforms(**kwargs):
+    transform = ants.ApplyTransforms(**kwargs)
+    transform.terminal_output = "allatonce"
+    transform.resource_monitor = False
+    transform.run()
+
+
+def _stack_images(images, out_file):
+    """Write a list of 3D images on the same grid as a single float32 4D image."""
+    stacked = np.stack([img.get_fdata(dtype=np.float32) for img in images], axis=-1)
+    header = images[0].header.copy()
+    header.set_data_dtype(np.float32)
+    nb.Nifti1Image(stacked, images[0].affine, header).to_filename(out_file)
+
+
+def _save_volume(img, volume_num, out_file):
+    volume = np.asanyarray(img.dataobj[..., volume_num])
+    nb.Nifti1Image(volume, img.affine, img.header).to_filename(out_file)
@@ -8,12 +8,18 @@ Miscellaneous utilities
 
 """
 
+import json
 import os
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
 
+import nibabel as nb
+import numpy as np
 from nipype import logging
 from nipype.interfaces import ants
 from nipype.interfaces.base import (
     BaseInterfaceInputSpec,
+    Directory,
     File,
     SimpleInterface,
     TraitedSpec,
@@ -23,6 +29,8 @@ from nipype.interfaces.base import (
 from nipype.utils.filemanip import fname_presuffix
 
 from ..utils.atlases import get_atlases
+from ..utils.file_cache import FileCache, file_hash, grid_hash
+from ..utils.mif import save_mif
 
 IFLOGGER = logging.getLogger("nipype.interfaces")
 
@@ -32,6 +40,13 @@ class GetConnectivityAtlasesInputSpec(BaseInterfaceInputSpec):
     forward_transform = File(exists=True, desc="transform to get atlas into T1w space if desired")
     reference_image = File(exists=True, desc="")
     space = traits.Str("T1w", usedefault=True)
+    cache_dir = Directory(
+        nohash=True, desc="directory for caching resampled atlases across runs and sessions"
+    )
+    cache_size_gb = traits.Float(
+        2.0, usedefault=True, nohash=True, desc="maximum size of the atlas cache in GB"
+    )
+    num_threads = traits.Int(1, usedefault=True, nohash=True)
 
 
 class GetConnectivityAtlasesOutputSpec(TraitedSpec):
@@ -55,9 +70,33 @@ class GetConnectivityAtlases(SimpleInterface):
         else:
             transform = "identity"
 
+        # The transform is collapsed into a single displacement field on the DWI grid the
+        # first time an atlas needs it, so the other atlases don't read and compose it again
+        collapsed = {}
+        collapse_lock = Lock()
+
+        def _get_transform():
+            if transform == "identity":
+                return transform
+            with collapse_lock:
+                if not collapsed:
+                    warp_file = os.path.join(runtime.cwd, "template_to_dwi_warp.nii.gz")
+                    collapsed["command"] = _collapse_transform(
+                        transform, self.inputs.reference_image, warp_file
+                    )
+                    collapsed["transform"] = warp_file
+            return collapsed["transform"]
+
+        # Resampled atlases are cached based on the contents of all the inputs
+        cache = None
+        if isdefined(self.inputs.cache_dir):
+            cache = FileCache(self.inputs.cache_dir, self.inputs.cache_size_gb)
+            transform_hash = "identity" if transform == "identity" else file_hash(transform)
+            reference_hash = grid_hash(self.inputs.reference_image)
+
         # Transform atlases to match the DWI data
-        resample_commands = []
-        for atlas_name, atlas_config in atlas_configs.items():
+        def _get_atlas(atlas_name):
+            atlas_config = atlas_configs[atlas_name]
             output_name = fname_presuffix(
                 atlas_config["file"], newpath=runtime.cwd, suffix="_to_dwi"
             )
@@ -74,21 +113,54 @@ class GetConnectivityAtlases(SimpleInterface):
                 atlas_config["file"], newpath=runtime.cwd, suffix="_origlabels.txt", use_ext=False
             )
 
-            atlas_configs[atlas_name]["dwi_resolution_file"] = output_name
-            atlas_configs[atlas_name]["dwi_resolution_mif"] = output_mif
-            atlas_configs[atlas_name]["orig_lut"] = output_mif_txt
-            atlas_configs[atlas_name]["mrtrix_lut"] = output_orig_txt
-            resample_commands.append(
-                _resample_atlas(
+            atlas_config["dwi_resolution_file"] = output_name
+            atlas_config["dwi_resolution_mif"] = output_mif
+            atlas_config["orig_lut"] = output_mif_txt
+            atlas_config["mrtrix_lut"] = output_orig_txt
+            write_label_tables(output_orig_txt, output_mif_txt, atlas_config)
+
+            def _resample():
+                command = _resample_atlas(
                     input_atlas=atlas_config["file"],
                     output_atlas=output_name,
-                    transform=transform,
+                    transform=_get_transform(),
                     ref_image=self.inputs.reference_image,
                 )
+                label_convert(output_name, output_mif, output_orig_txt, output_mif_txt)
+                return {"command": command}
+
+            if cache is None:
+                return _resample()["command"]
+
+            key = cache.key(
+                file_hash(atlas_config["file"]),
+                transform_hash,
+                reference_hash,
+                json.dumps([atlas_config["node_ids"], atlas_config["node_names"]]),
+                "MultiLabel",
+            )
+            out_files = {"dwi_resolution_file": output_name, "dwi_resolution_mif": output_mif}
+            created = {}
+
+            def _create():
+                created.update(_resample())
+                return created
+
+            cache.get_or_create(key, out_files, _create)
+            if created:
+                return created["command"]
+            # The cached command refers to the paths of the node that created the entry
+            return "# %s was copied from the atlas cache entry %s" % (
+                output_name,
+                os.path.join(cache.cache_dir, key),
             )
-            label_convert(output_name, output_mif, output_orig_txt, output_mif_txt, atlas_config)
+
+        with ThreadPoolExecutor(max_workers=self.inputs.num_threads) as executor:
+            resample_commands = list(executor.map(_get_atlas, atlas_configs))
 
         self._results["atlas_configs"] = atlas_configs
+        if "command" in collapsed:
+            resample_commands.insert(0, collapsed["command"])
         commands_file = os.path.join(runtime.cwd, "transform_commands.txt")
         with open(commands_file, "w") as f:
             f.write("\n".join(resample_commands))
@@ -97,6 +169,58 @@ class GetConnectivityAtlases(SimpleInterface):
         return runtime
 
 
+class _ResampleROIsInputSpec(BaseInterfaceInputSpec):
+    input_image = File(exists=True, mandatory=True, desc="label image in template space")
+    transform = File(exists=True, mandatory=True, desc="transform from template to T1w space")
+    reference_image = File(exists=True, mandatory=True, desc="image defining the output grid")
+    cache_dir = Directory(
+        nohash=True, desc="directory for caching resampled images across runs and sessions"
+    )
+    cache_size_gb = traits.Float(
+        2.0, usedefault=True, nohash=True, desc="maximum size of the cache in GB"
+    )
+
+
+class _ResampleROIsOutputSpec(TraitedSpec):
+    output_image = File(exists=True)
+
+
+class ResampleROIs(SimpleInterface):
+    """Resample a label image into DWI space, reusing the result of other runs on the same grid."""
+
+    input_spec = _ResampleROIsInputSpec
+    output_spec = _ResampleROIsOutputSpec
+
+    def _run_interface(self, runtime):
+        output_image = fname_presuffix(
+            self.inputs.input_image, newpath=runtime.cwd, suffix="_trans"
+        )
+
+        def _resample():
+            command = _resample_atlas(
+                input_atlas=self.inputs.input_image,
+                output_atlas=output_image,
+                transform=self.inputs.transform,
+                ref_image=self.inputs.reference_image,
+            )
+            return {"command": command}
+
+        if isdefined(self.inputs.cache_dir):
+            cache = FileCache(self.inputs.cache_dir, self.inputs.cache_size_gb)
+            key = cache.key(
+                file_hash(self.inputs.input_image),
+                file_hash(self.inputs.transform),
+                grid_hash(self.inputs.reference_image),
+                "MultiLabel",
+            )
+            cache.get_or_create(key, {"output_image": output_image}, _resample)
+        else:
+            _resample()
+
+        self._results["output_image"] = output_image
+        return runtime
+
+
 class _GetUniqueInputSpec(BaseInterfaceInputSpec):
     inlist = traits.List(mandatory=True, desc="list of things")
 
@@ -116,6 +240,20 @@ class GetUnique(SimpleInterface):
         return runtime
 
 
+def _collapse_transform(transform, ref_image, warp_file):
+    """Write a transform as a displacement field sampled on the grid of ``ref_image``."""
+    xform = ants.ApplyTransforms(
+        transforms=[transform],
+        reference_image=ref_image,
+        input_image=ref_image,
+        output_image=warp_file,
+        print_out_composite_warp_file=True,
+    )
+    result = xform.run()
+
+    return result.runtime.cmdline
+
+
 def _resample_atlas(input_atlas, output_atlas, transform, ref_image):
     xform = ants.ApplyTransforms(
         transforms=[transform],
@@ -129,8 +267,8 @@ def _resample_atlas(input_atlas, output_atlas, transform, ref_image):
     return result.runtime.cmdline
 
 
-def label_convert(original_atlas, output_mif, orig_txt, mrtrix_txt, metadata):
-    """Create a mrtrix label file from an atlas."""
+def write_label_tables(orig_txt, mrtrix_txt, metadata):
+    """Write the original and mrtrix label lookup tables of an atlas."""
 
     with open(mrtrix_txt, "w") as mrtrix_f:
         with open(orig_txt, "w") as orig_f:
@@ -139,5 +277,34 @@ def label_convert(original_atlas, output_mif, orig_txt, mrtrix_txt, metadata):
             ):
                 orig_f.write("{}\t{}\n".format(roi_num, roi_name))
                 mrtrix_f.write("{}\t{}\n".format(row_num + 1, roi_name))
-    cmd = ["labelconvert", original_atlas, orig_txt, mrtrix_txt, output_mif]
-    os.system(" ".join(cmd))
+
+
+def _read_label_table(lut_file):
+    """Read a lookup table written by :func:`write_label_tables` as {index: name}."""
+    with open(lut_file) as lut_f:
+        rows = [line.rstrip("\n").split("\t", 1) for line in lut_f if line.strip()]
+    return {int(index): name for index, name in rows}
+
+
+def label_convert(original_atlas, output_mif, orig_txt, mrtrix_txt):
+    """Create a mrtrix label file from an atlas and its lookup tables.
+
+    Like MRtrix's ``labelconvert``, each label is mapped to the index that its
+    name has in ``mrtrix_txt``. Labels that are not in both tables become 0.
+    """
+    orig_names = _read_label_table(orig_txt)
+    mrtrix_indices = {name: index for index, name in _read_label_table(mrtrix_txt).items()}
+
+    atlas_img = nb.load(original_atlas)
+    labels, voxel_labels = np.unique(
+        np.asanyarray(atlas_img.dataobj).astype(np.int64), return_inverse=True
+    )
+    new_labels = np.array(
+        [mrtrix_indices.get(orig_names.get(label), 0) for label in labels], dtype=np.uint32
+    )
+    save_mif(
+        output_mif,
+        new_labels[voxel_labels].reshape(atlas_img.shape),
+        atlas_img.affine,
+        zooms=atlas_img.header.get_zooms(),
+    )
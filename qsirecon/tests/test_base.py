@@ -0,0 +1,89 @@
+"""Tests for building the subject-level workflows."""
+
+import json
+
+import nibabel as nb
+import numpy as np
+
+from qsirecon.cli.parser import parse_args
+
+
+def _make_ukb_session(ukb_dir, subject_id="1234567", session="2"):
+    """Write the diffusion files of a small UKB session directory."""
+    dmri_dir = ukb_dir / f"{subject_id}_{session}_0" / "DTI" / "dMRI" / "dMRI"
+    dmri_dir.mkdir(parents=True)
+    affine = np.diag([2.0, 2.0, 2.0, 1.0])
+    nb.Nifti1Image(np.zeros((5, 5, 5, 4), dtype=np.float32), affine).to_filename(
+        dmri_dir / "data_ud.nii.gz"
+    )
+    nb.Nifti1Image(np.zeros((5, 5, 5), dtype=np.float32), affine).to_filename(
+        dmri_dir / "dti_FA.nii.gz"
+    )
+    (dmri_dir / "bvals").write_text("0 1000 1000 1000\n")
+    (dmri_dir / "bvecs").write_text("0 1 0 0\n0 0 1 0\n0 0 0 1\n")
+    with open(ukb_dir / "dataset_description.json", "w") as fobj:
+        json.dump({"Name": "UKB", "BIDSVersion": "1.0.2"}, fobj)
+    return subject_id
+
+
+def test_ukb_subject_workflow(tmp_path):
+    """Build the workflow of a UKB subject, whose BIDS dwi file does not exist."""
+    from qsirecon.workflows.base import init_single_subject_recon_wf
+
+    ukb_dir = tmp_path / "ukb"
+    subject_id = _make_ukb_session(ukb_dir)
+    parse_args(
+        [
+            str(ukb_dir),
+            str(tmp_path / "out"),
+            "participant",
+            f"-w={tmp_path / 'work'}",
+            "--input-type=ukb",
+            "--recon-spec=dipy_dki",
+            "--notrack",
+        ]
+    )
+
+    workflow = init_single_subject_recon_wf(subject_id)
+
+    # The memory estimates come from the UKB series
+    dki_nodes = [
+        workflow.get_node(name)
+        for name in workflow.list_node_names()
+        if name.endswith("recon_dki")
+    ]
+    assert dki_nodes
+    assert all(node.mem_gb > 0.2 for node in dki_nodes)
+
+
+def test_template_grid_is_shared_by_runs(tmp_path):
+    """A single template grid node feeds the output grid of every run of a subject."""
+    from qsirecon.workflows.base import init_single_subject_recon_wf
+
+    ukb_dir = tmp_path / "ukb"
+    subject_id = _make_ukb_session(ukb_dir, session="2")
+    _make_ukb_session(ukb_dir, session="3")
+    parse_args(
+        [
+            str(ukb_dir),
+            str(tmp_path / "out"),
+            "participant",
+            f"-w={tmp_path / 'work'}",
+            "--input-type=ukb",
+            "--recon-spec=dipy_dki",
+            "--notrack",
+        ]
+    )
+
+    workflow = init_single_subject_recon_wf(subject_id)
+    node_names = workflow.list_node_names()
+    assert [name for name in node_names if name.endswith("template_grid")] == ["template_grid"]
+    assert len([name for name in node_names if name.endswith("resample_to_voxel_size")]) == 2
+
+    template_grid = workflow.get_node("template_grid")
+    anat_wfs = [
+        target
+        for _, target, data in workflow._graph.out_edges(template_grid, data=True)
+        if ("grid_image", "inputnode.template_image") in data["connect"]
+    ]
+    assert len(anat_wfs) == 2
@@ -0,0 +1,23 @@
+"""Tests for fitting models to blocks of voxels in parallel."""
+
+from functools import partial
+
+import numpy as np
+from dipy.reconst.dti import TensorModel
+
+from qsirecon.tests.utils import simulate_multishell
+from qsirecon.utils.blockfit import fit_voxel_blocks
+
+
+def test_fit_voxel_blocks_matches_single_fit():
+    """Fitting blocks in several processes gives the maps of a single fit."""
+    gtab, data = simulate_multishell()
+    make_model = partial(TensorModel, gtab)
+    expected = make_model().fit(data)
+
+    results = fit_voxel_blocks(
+        make_model, data, {"fa": "fa", "evecs": "evecs"}, n_jobs=2, block_size=7
+    )
+    assert results["fa"].shape == (data.shape[0],)
+    np.testing.assert_allclose(results["fa"], expected.fa)
+    np.testing.assert_allclose(np.abs(results["evecs"]), np.abs(expected.evecs), atol=1e-8)
@@ -0,0 +1,90 @@
+"""Tests for the 3dSHORE model fits."""
+
+from functools import partial
+
+import numpy as np
+from sklearn.linear_model import Lasso
+
+from qsirecon.tests.utils import simulate_multishell
+from qsirecon.utils.blockfit import fit_voxel_blocks
+from qsirecon.utils.brainsuite_shore import (
+    L1_WARM_START_VOXELS,
+    BrainSuiteShoreFit,
+    BrainSuiteShoreModel,
+)
+
+L1_KWARGS = {
+    "regularization": "L1",
+    "regularization_weighting": "fixed",
+    "l1_alpha": 1e-5,
+    "radial_order": 6,
+    "zeta": 700,
+    "tau": 1 / (4 * np.pi**2),
+}
+
+
+def test_l1_fit_does_not_depend_on_blocks():
+    """Warm-started L1 fits give the same coefficients for any number of processes."""
+    gtab, data = simulate_multishell(n_voxels=L1_WARM_START_VOXELS + 20)
+    model = BrainSuiteShoreModel(gtab, **L1_KWARGS)
+    expected = model.fit(data).shore_coeff
+
+    for n_jobs in (2, 3):
+        blocks = fit_voxel_blocks(
+            partial(BrainSuiteShoreModel, gtab, **L1_KWARGS),
+            data,
+            {"coeffs": "shore_coeff"},
+            n_jobs=n_jobs,
+            block_size=7,
+            block_multiple=L1_WARM_START_VOXELS,
+        )
+        np.testing.assert_array_equal(blocks["coeffs"], expected)
+
+    # Each voxel converges to the solution of a fit from scratch
+    shore_matrix, _ = model._shore_matrices()
+    cold = np.array(
+        [
+            Lasso(fit_intercept=False, alpha=1e-5, max_iter=model.l1_maxiter)
+            .fit(shore_matrix, voxel_data)
+            .coef_
+            for voxel_data in data
+        ]
+    )
+    np.testing.assert_array_equal(expected[0], cold[0])
+    np.testing.assert_allclose(expected @ shore_matrix.T, cold @ shore_matrix.T, atol=1e-3)
+
+
+def test_l2_fit_matches_single_voxels():
+    """The batched L2 solve gives each voxel the coefficients of its own fit."""
+    gtab, data = simulate_multishell(n_voxels=10)
+    model = BrainSuiteShoreModel(gtab, regularization="L2", radial_order=6, zeta=700)
+    shore_matrix, _ = model._shore_matrices()
+    regularization = model.lambdaN * model.Nshore + model.lambdaL * model.Lshore
+    pseudo_inverse = np.linalg.solve(
+        shore_matrix.T @ shore_matrix + regularization, shore_matrix.T
+    )
+    expected = [np.dot(pseudo_inverse, signal) for signal in data]
+
+    fit = model.fit(data.reshape((2, 5, -1)))
+    np.testing.assert_allclose(fit.shore_coeff.reshape((10, -1)), expected, rtol=1e-6)
+
+
+def test_scalar_maps_are_clipped_per_voxel():
+    """Negative values are set to zero in each voxel, and other voxels do not matter."""
+    gtab, data = simulate_multishell(n_voxels=3)
+    fit = BrainSuiteShoreModel(gtab, regularization="L2", radial_order=6, zeta=700).fit(data)
+    coef = fit.shore_coeff
+    # The maps are linear in the coefficients, so flipping a voxel flips its sign
+    flipped = BrainSuiteShoreFit(fit.model, np.concatenate([coef, -coef[:1], 1000 * coef[1:2]]))
+
+    for metric in ("rtop_signal", "rtop_pdf", "msd"):
+        expected = getattr(fit, metric)()
+        assert np.all(expected > 0), metric
+        values = getattr(flipped, metric)()
+        np.testing.assert_allclose(values[:3], expected, err_msg=metric)
+        assert values[3] == 0, metric
+
+    r_points = np.array([[0.0, 0, 0], [0.005, 0, 0], [0, 0.01, 0]])
+    eap = flipped.pdf(r_points)
+    np.testing.assert_allclose(eap[:3], np.maximum(fit.pdf(r_points), 0))
+    np.testing.assert_array_equal(eap[3], np.maximum(-fit.pdf(r_points)[0], 0))
@@ -0,0 +1,87 @@
+"""Tests for the block-parallel gzip writer."""
+
+import gzip
+import os
+import struct
+import zlib
+
+import numpy as np
+import pytest
+
+from qsirecon.interfaces.bids import _copy_any
+from qsirecon.utils.compression import parallel_gzip
+
+
+def _content(seed=0):
+    rng = np.random.default_rng(seed)
+    # Half random and half repeated bytes, so the blocks compress differently
+    return rng.integers(0, 256, size=50000, dtype=np.uint8).tobytes() + b"qsirecon" * 6000
+
+
+def _read_single_member(gz_bytes):
+    """Check that a gzip file is one member, and return its header's extra flags and data."""
+    assert gz_bytes[:4] == b"\037\213\010\000"
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    data = decompressor.decompress(gz_bytes[10:])
+    assert decompressor.eof
+    # Only the CRC and size of the uncompressed data follow the deflate stream
+    assert decompressor.unused_data == struct.pack("<LL", zlib.crc32(data), len(data) & 0xFFFFFFFF)
+    return gz_bytes[8], data
+
+
+@pytest.mark.parametrize("n_threads", [1, 4])
+def test_parallel_gzip_round_trip(tmp_path, n_threads):
+    """The blocks concatenate into a gzip file that decompresses to the input."""
+    content = _content()
+    in_file = tmp_path / "data.nii"
+    in_file.write_bytes(content)
+    out_file = tmp_path / "data.nii.gz"
+
+    parallel_gzip(
+        str(in_file), str(out_file), compresslevel=9, n_threads=n_threads, block_size=7919
+    )
+    with gzip.open(out_file, "rb") as fobj:
+        assert fobj.read() == content
+
+    # A single block compresses as well as gzip does
+    parallel_gzip(str(in_file), str(out_file), compresslevel=9, block_size=len(content))
+    assert abs(os.path.getsize(out_file) - len(gzip.compress(content, 9))) < 32
+
+
+@pytest.mark.parametrize("compresslevel,xfl", [(1, 4), (6, 0), (9, 2)])
+def test_parallel_gzip_member(tmp_path, compresslevel, xfl):
+    """The blocks form a single valid member whose header records the level, as gzip's does."""
+    content = _content()
+    in_file = tmp_path / "data.nii"
+    in_file.write_bytes(content)
+    out_file = tmp_path / "data.nii.gz"
+
+    parallel_gzip(
+        str(in_file), str(out_file), compresslevel=compresslevel, n_threads=3, block_size=4096
+    )
+    gz_bytes = out_file.read_bytes()
+    header_xfl, data = _read_single_member(gz_bytes)
+    assert data == content
+    assert header_xfl == xfl == gzip.compress(content, compresslevel)[8]
+
+    # Higher levels give smaller files
+    parallel_gzip(str(in_file), str(out_file), compresslevel=1, block_size=4096)
+    if compresslevel > 1:
+        assert len(gz_bytes) < os.path.getsize(out_file)
+
+
+def test_copy_any(tmp_path):
+    """Uncompressed sources are gzipped and compressed sources decompressed."""
+    content = _content()
+    in_file = tmp_path / "data.nii"
+    in_file.write_bytes(content)
+
+    assert _copy_any(str(in_file), str(tmp_path / "out.nii.gz"), n_threads=2)
+    _, data = _read_single_member((tmp_path / "out.nii.gz").read_bytes())
+    assert data == content
+
+    assert _copy_any(str(tmp_path / "out.nii.gz"), str(tmp_path / "copy.nii"))
+    assert (tmp_path / "copy.nii").read_bytes() == content
+
+    assert not _copy_any(str(in_file), str(tmp_path / "same.nii"))
+    assert (tmp_path / "same.nii").read_bytes() == content
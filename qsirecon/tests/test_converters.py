@@ -0,0 +1,87 @@
+"""Tests for the DSI Studio fib file conversions."""
+
+import gzip
+import re
+
+import nibabel as nb
+import numpy as np
+import pytest
+from scipy.io import loadmat
+
+from qsirecon.interfaces.converters import (
+    _iter_mat4_headers,
+    amplitudes_to_fibgz,
+    fast_load_fibgz,
+    fib2amps,
+    get_dsi_studio_ODF_geometry,
+)
+
+
+def _write_fib(tmp_path, extension=".fib.gz", shape=(4, 3, 5)):
+    """Write random ODFs on the odf8 sphere, and a mask with an empty slice, to a fib file."""
+    rng = np.random.default_rng(0)
+    vertices, faces = get_dsi_studio_ODF_geometry("odf8")
+    affine = np.diag([2.0, 2.0, 2.0, 1.0])
+    # ODFs are sampled on the first half of the sphere, as in DipyReconInterface
+    n_amplitudes = vertices.shape[0] // 2
+    amplitudes = rng.uniform(0.1, 1, size=shape + (n_amplitudes,)).astype(np.float32)
+    mask = rng.random(shape) > 0.3
+    mask[:, :, 2] = False
+    amplitudes_img = nb.Nifti1Image(amplitudes, affine)
+    mask_img = nb.Nifti1Image(mask.astype(np.uint8), affine)
+    ref_file = str(tmp_path / "ref.nii")
+    mask_img.to_filename(ref_file)
+
+    fib_file = str(tmp_path / ("odfs" + extension))
+    amplitudes_to_fibgz(amplitudes_img, vertices, faces, fib_file, mask_img, block_size=10)
+    return fib_file, ref_file, amplitudes, mask
+
+
+def test_fib2amps_masked(tmp_path):
+    """The masked voxels and their amplitudes are those of the 4D image."""
+    fib_file, ref_file, _, mask = _write_fib(tmp_path)
+    odf_img, directions = fib2amps(fib_file, ref_file)
+    (voxel_indices, odf_matrix), masked_directions = fib2amps(fib_file, ref_file, masked=True)
+
+    np.testing.assert_array_equal(masked_directions, directions)
+    np.testing.assert_array_equal(voxel_indices, np.flatnonzero(mask.ravel(order="F")))
+    assert odf_matrix.dtype == np.float32
+    odf_4d = np.asanyarray(odf_img.dataobj)
+    np.testing.assert_array_equal(
+        odf_matrix, odf_4d.reshape((-1, odf_4d.shape[3]), order="F")[voxel_indices]
+    )
+    assert not odf_4d[~mask].any()
+
+
+@pytest.mark.parametrize("extension", [".fib", ".fib.gz"])
+def test_amplitudes_to_fibgz_round_trip(tmp_path, extension):
+    """The streamed fib file holds the normalized ODFs in the original variable order."""
+    fib_file, _, amplitudes, mask = _write_fib(tmp_path, extension)
+    with (gzip.open if extension.endswith(".gz") else open)(fib_file, "rb") as fobj:
+        names = [header[0] for header in _iter_mat4_headers(fobj)]
+        fobj.seek(0)
+        expected = loadmat(fobj)
+
+    odf_names = [name for name in names if re.fullmatch(r"odf\d+", name)]
+    peak_names = ["%s%d" % (var, nfib) for nfib in range(5) for var in ("fa", "index")]
+    assert names == (
+        ["dimension", "voxel_size"] + peak_names + odf_names + ["odf_vertices", "odf_faces", "z0"]
+    )
+    # The small blocks of the test still fill a single odfN variable
+    assert odf_names == ["odf0"]
+
+    fibmat = fast_load_fibgz(fib_file)
+    assert set(fibmat) == set(names)
+    for name in names:
+        np.testing.assert_array_equal(fibmat[name], expected[name], err_msg=name)
+
+    masked_odfs = amplitudes.reshape((-1, amplitudes.shape[3]), order="F")[mask.ravel(order="F")]
+    z0 = fibmat["z0"].item()
+    assert z0 == amplitudes[mask].max()
+    np.testing.assert_allclose(fibmat["odf0"], masked_odfs.T / z0, rtol=1e-6)
+    assert np.all(fibmat["fa0"].ravel(order="F")[mask.ravel(order="F")] > 0)
+    assert not fibmat["fa0"].ravel(order="F")[~mask.ravel(order="F")].any()
+
+    # Only the requested variables are loaded
+    partial = fast_load_fibgz(fib_file, variables=["dimension", r"index\d+"])
+    assert sorted(partial) == ["dimension"] + ["index%d" % nfib for nfib in range(5)]
@@ -0,0 +1,43 @@
+"""Tests for the on-disk cache of derived files."""
+
+import os
+from functools import partial
+
+from qsirecon.utils.file_cache import FileCache
+
+
+def test_file_cache(tmp_path):
+    """Entries are created once, copied afterwards, and evicted oldest first."""
+    cache = FileCache(str(tmp_path / "cache"), max_size_gb=1500 / 1024**3)
+    calls = []
+
+    def _create(out_file, content):
+        calls.append(out_file)
+        with open(out_file, "wb") as fobj:
+            fobj.write(content)
+        return {"command": "create %s" % out_file}
+
+    key_a = cache.key("atlas_a", "identity")
+    first = str(tmp_path / "first.nii")
+    metadata = cache.get_or_create(
+        key_a, {"atlas.nii": first}, partial(_create, first, b"a" * 1000)
+    )
+    second = str(tmp_path / "second.nii")
+    cached = cache.get_or_create(key_a, {"atlas.nii": second}, partial(_create, second, b"x"))
+    assert calls == [first]
+    assert cached == metadata == {"command": "create %s" % first}
+    with open(second, "rb") as fobj:
+        assert fobj.read() == b"a" * 1000
+
+    # Only one entry fits, so the least recently used one is removed
+    os.utime(os.path.join(cache.cache_dir, key_a), (0, 0))
+    key_b = cache.key("atlas_b", "identity")
+    third = str(tmp_path / "third.nii")
+    cache.get_or_create(key_b, {"atlas.nii": third}, partial(_create, third, b"b" * 1000))
+    assert not os.path.exists(os.path.join(cache.cache_dir, key_a))
+    assert os.path.isdir(os.path.join(cache.cache_dir, key_b))
+
+    # Nothing is cached when the outputs are not written
+    key_c = cache.key("atlas_c", "identity")
+    cache.get_or_create(key_c, {"atlas.nii": str(tmp_path / "missing.nii")}, dict)
+    assert not os.path.exists(os.path.join(cache.cache_dir, key_c))
@@ -0,0 +1,51 @@
+"""Tests for the gradient table interfaces."""
+
+import numpy as np
+import pytest
+
+from qsirecon.interfaces.gradients import unique_sample_indices
+
+
+def _unique_sample_indices_loop(scaled_bvecs, cutoff):
+    """Compare each sample to all the samples kept before it, as RemoveDuplicates did."""
+    ok_vecs = []
+    seen_vecs = []
+    seen_indices = []
+    for vec_num, vec in enumerate(scaled_bvecs):
+        if np.linalg.norm(vec) < cutoff:
+            ok_vecs.append(vec_num)
+            continue
+        if seen_vecs:
+            vec_array = np.vstack(seen_vecs)
+            distances = np.linalg.norm(vec_array - vec, axis=1)
+            distances_flip = np.linalg.norm(vec_array + vec, axis=1)
+            if not (np.all(distances > cutoff) and np.all(distances_flip > cutoff)):
+                continue
+        ok_vecs.append(vec_num)
+        seen_vecs.append(vec)
+        seen_indices.append(vec_num)
+    return np.array(ok_vecs), np.array(seen_indices)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_unique_sample_indices(seed):
+    """Repeated and antipodal samples are dropped as they were by the original loop."""
+    rng = np.random.default_rng(seed)
+    bvecs = rng.normal(size=(80, 3))
+    bvecs /= np.linalg.norm(bvecs, axis=1)[:, None]
+    bvals = rng.choice([0.0, 1000.0, 2000.0, 3000.0], size=80)
+    # Repeat some samples, some flipped and with a little noise
+    repeats = rng.integers(0, 80, size=30)
+    signs = rng.choice([-1, 1], size=(30, 1))
+    bvecs = np.concatenate([bvecs, signs * bvecs[repeats] + rng.normal(0, 0.01, (30, 3))])
+    bvals = np.concatenate([bvals, bvals[repeats]])
+    order = rng.permutation(len(bvals))
+    bvecs, bvals = bvecs[order], bvals[order]
+
+    bvals = np.sqrt(bvals - bvals.min())
+    scaled_bvecs = (bvals / bvals.max() * 100)[:, None] * bvecs
+
+    ok_indices, unique_indices = unique_sample_indices(scaled_bvecs, 5.0)
+    expected_ok, expected_unique = _unique_sample_indices_loop(scaled_bvecs, 5.0)
+    np.testing.assert_array_equal(ok_indices, expected_ok)
+    np.testing.assert_array_equal(unique_indices, expected_unique)
@@ -0,0 +1,69 @@
+"""Tests for the index of UKB directories."""
+
+import os
+import sqlite3
+
+from qsirecon.utils.ingress import UKBIndex
+
+UKB_FILES = ("bvals", "bvecs", "data_ud.nii.gz", "dti_FA.nii.gz")
+
+
+def _make_ukb_dir(ukb_dir, name, files=UKB_FILES):
+    """Write empty diffusion files in a UKB directory, and return its dMRI directory."""
+    dmri_dir = ukb_dir / name / "DTI" / "dMRI" / "dMRI"
+    dmri_dir.mkdir(parents=True)
+    for fname in files:
+        (dmri_dir / fname).touch()
+    return dmri_dir
+
+
+def _bump_mtime(path, seconds):
+    """Move the mtime of a path forward, so that coarse file system clocks see a change."""
+    mtime = os.stat(path).st_mtime + seconds
+    os.utime(path, (mtime, mtime))
+
+
+def test_ukb_index_refresh(tmp_path, monkeypatch):
+    """Only new and incomplete directories are checked, before the database is locked."""
+    ukb_dir = tmp_path / "ukb"
+    index_file = tmp_path / "work" / "ukb_index.sqlite"
+    _make_ukb_dir(ukb_dir, "1000001_2_0")
+    incomplete_dir = _make_ukb_dir(ukb_dir, "1000002_2_0", files=UKB_FILES[:3])
+    (ukb_dir / "not_a_subject").mkdir()
+
+    checked = []
+    check_dir = UKBIndex._check_dir
+
+    def spy_check_dir(self, name, stored_mtime):
+        checked.append(name)
+        # Another process can still write to the index while directories are checked
+        with sqlite3.connect(str(index_file), timeout=0) as other:
+            other.execute("BEGIN IMMEDIATE")
+        return check_dir(self, name, stored_mtime)
+
+    monkeypatch.setattr(UKBIndex, "_check_dir", spy_check_dir)
+
+    ukb_index = UKBIndex(ukb_dir, index_file=index_file)
+    ukb_index.refresh(n_threads=2)
+    assert sorted(checked) == ["1000001_2_0", "1000002_2_0"]
+    layout = ukb_index.query()
+    assert [entry["subject"] for entry in layout] == ["1000001"]
+    assert layout[0]["session"] == "0200"
+    assert layout[0]["path"] == ukb_dir.absolute() / "1000001_2_0"
+
+    # Nothing changed, so the complete directory is not checked again
+    checked.clear()
+    ukb_index.refresh()
+    assert checked == ["1000002_2_0"]
+
+    # Completing a directory and adding one are picked up by a new process
+    (incomplete_dir / UKB_FILES[3]).touch()
+    _bump_mtime(incomplete_dir, 10)
+    _make_ukb_dir(ukb_dir, "1000003_3_0")
+    _bump_mtime(ukb_dir, 10)
+    checked.clear()
+    ukb_index = UKBIndex(ukb_dir, index_file=index_file)
+    ukb_index.refresh()
+    assert sorted(checked) == ["1000002_2_0", "1000003_3_0"]
+    assert [entry["subject"] for entry in ukb_index.query()] == ["1000001", "1000002", "1000003"]
+    assert [entry["session"] for entry in ukb_index.query("1000003")] == ["0300"]
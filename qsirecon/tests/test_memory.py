@@ -0,0 +1,80 @@
+"""Tests for the memory estimates of the reconstruction nodes."""
+
+import json
+
+import pytest
+
+from qsirecon import config
+from qsirecon.interfaces.dipy import MAPMRIReconstruction
+from qsirecon.interfaces.reports import CLIReconPeaksReport
+from qsirecon.utils.memory import (
+    GB,
+    MEMORY_MODEL_FILE,
+    MEMORY_MODELS,
+    MIN_MEM_GB,
+    estimate_node_mem_gb,
+    record_node_features,
+)
+
+# A 100x100x60 series with 100 volumes, half of it brain
+PROFILE = {"n_voxels": 600_000, "n_volumes": 100, "mask_fraction": 0.5}
+
+
+def test_estimate_node_mem_gb():
+    """The estimate follows the interface's parameters and is capped."""
+    # 50 MAPMRI coefficients for radial order 6
+    interface = MAPMRIReconstruction(radial_order=6)
+    model = MEMORY_MODELS["MAPMRIReconstruction"]
+    expected = (
+        model["constant"]
+        + model["masked_dwi_gb"] * 300_000 * 100 * 8 / GB
+        + model["masked_model_gb"] * 300_000 * 50 * 8 / GB
+    )
+    assert estimate_node_mem_gb(interface, PROFILE) == pytest.approx(expected)
+    assert estimate_node_mem_gb(MAPMRIReconstruction(radial_order=8), PROFILE) > expected
+    assert estimate_node_mem_gb(interface, PROFILE, max_mem_gb=1.0) == 1.0
+
+    # Without a profile or a model, nodes keep nipype's default
+    assert estimate_node_mem_gb(interface, None) == MIN_MEM_GB
+    assert estimate_node_mem_gb(interface, PROFILE, models={}) == MIN_MEM_GB
+
+
+def test_nodes_are_built_with_mem_gb(tmp_path, monkeypatch):
+    """The recon workflows pass the estimates to their nodes, using calibrated models."""
+    from qsirecon.workflows.recon.dipy import init_dipy_mapmri_recon_wf
+
+    monkeypatch.setattr(config.execution, "work_dir", tmp_path)
+    monkeypatch.setattr(config.execution, "output_dir", tmp_path)
+    monkeypatch.setattr(config.nipype, "memory_gb", None)
+    monkeypatch.setattr(config.nipype, "omp_nthreads", 1)
+    monkeypatch.setattr(config.execution, "sloppy", False)
+    calibrated = {"MAPMRIReconstruction": {"constant": 3.0, "masked_model_gb": 2.0}}
+    (tmp_path / MEMORY_MODEL_FILE).write_text(json.dumps(calibrated))
+
+    workflow = init_dipy_mapmri_recon_wf(
+        available_anatomical_data={"has_qsiprep_t1w_transforms": False},
+        name="mapmri",
+        params={"radial_order": 6},
+        dwi_profile=PROFILE,
+    )
+    models = {**MEMORY_MODELS, **calibrated}
+    recon_map = workflow.get_node("recon_map")
+    assert recon_map.mem_gb == pytest.approx(
+        estimate_node_mem_gb(MAPMRIReconstruction(radial_order=6), PROFILE, models)
+    )
+    assert workflow.get_node("plot_peaks").mem_gb == pytest.approx(
+        estimate_node_mem_gb(CLIReconPeaksReport(), PROFILE)
+    )
+
+    # The features of the modeled nodes are kept for calibration
+    recorded = record_node_features(workflow, PROFILE, models)
+    assert recorded["mapmri.recon_map"]["interface"] == "MAPMRIReconstruction"
+    assert recorded["mapmri.recon_map"]["features"]["masked_model_gb"] == pytest.approx(
+        300_000 * 50 * 8 / GB
+    )
+
+    # Without a profile, the nodes keep nipype's default
+    workflow = init_dipy_mapmri_recon_wf(
+        available_anatomical_data={"has_qsiprep_t1w_transforms": False}, name="mapmri"
+    )
+    assert workflow.get_node("recon_map").mem_gb == MIN_MEM_GB
@@ -0,0 +1,113 @@
+"""Tests for reading and writing MRtrix images."""
+
+import nibabel as nb
+import numpy as np
+import pytest
+
+from qsirecon.interfaces.anatomical import CalculateSOP, calculate_steinhardt, get_l_m
+from qsirecon.utils.mif import MifImage, load_mif, save_mif
+
+
+def _write_mif(filename, header_lines, raw):
+    """Write a .mif file by hand, with the data after a header padded to 1024 bytes."""
+    text = "\n".join(["mrtrix image"] + header_lines + ["file: . 1024", "END"]) + "\n"
+    with open(filename, "wb") as fobj:
+        fobj.write(text.encode("latin1").ljust(1024, b"\0"))
+        fobj.write(raw.tobytes())
+
+
+def test_load_mif_volume_contiguous(tmp_path):
+    """Volumes stored fastest, as written by dwi2fod, are indexed like a NIfTI image."""
+    shape = (3, 4, 2, 5)
+    raw = np.arange(np.prod(shape), dtype="<f4")
+    mif_file = str(tmp_path / "fod.mif")
+    _write_mif(
+        mif_file,
+        [
+            "dim: 3,4,2,5",
+            "vox: 2,2,2.5,nan",
+            "layout: +1,+2,+3,+0",
+            "datatype: Float32LE",
+            "transform: 1,0,0,-10",
+            "transform: 0,1,0,-20",
+            "transform: 0,0,1,-30",
+        ],
+        raw,
+    )
+
+    data, affine, _ = load_mif(mif_file)
+    expected = raw.reshape((5, 3, 4, 2), order="F").transpose(1, 2, 3, 0)
+    np.testing.assert_array_equal(data, expected)
+    np.testing.assert_allclose(
+        affine, [[2, 0, 0, -10], [0, 2, 0, -20], [0, 0, 2.5, -30], [0, 0, 0, 1]]
+    )
+
+
+def test_load_mif_flipped_axes(tmp_path):
+    """Axes stored in reverse keep their storage order, and the affine accounts for it."""
+    shape = (3, 4, 2)
+    raw = np.arange(np.prod(shape), dtype="<i2")
+    mif_file = str(tmp_path / "labels.mif")
+    _write_mif(
+        mif_file,
+        [
+            "dim: 3,4,2",
+            "vox: 1,1,1",
+            "layout: -0,+1,+2",
+            "datatype: Int16LE",
+            "transform: 1,0,0,0",
+            "transform: 0,1,0,0",
+            "transform: 0,0,1,0",
+            "scaling: 1,0.5",
+        ],
+        raw,
+    )
+
+    data, affine, _ = load_mif(mif_file)
+    np.testing.assert_allclose(data, raw.reshape(shape, order="F") * 0.5 + 1)
+    # The first stored voxel is the last one along the header's first axis
+    np.testing.assert_allclose(affine @ [0, 0, 0, 1], [2, 0, 0, 1])
+    np.testing.assert_allclose(affine @ [2, 3, 1, 1], [0, 3, 1, 1])
+
+
+@pytest.mark.parametrize("extension", [".mif", ".mif.gz"])
+def test_mif_round_trip(tmp_path, extension):
+    """Images saved as .mif or .mif.gz load with the same data, affine and entries."""
+    rng = np.random.default_rng(0)
+    data = rng.normal(size=(5, 6, 7, 4)).astype(np.float32)
+    affine = np.array([[-2.0, 0, 0, 10], [0, 2, 0, -12], [0, 0, 2.5, 3], [0, 0, 0, 1]])
+    dw_scheme = ["0,0,1,0", "1,0,0,1000", "0,1,0,1000", "0,0,1,1000"]
+    mif_file = str(tmp_path / ("dwi" + extension))
+
+    save_mif(mif_file, data, affine, extra={"dw_scheme": dw_scheme})
+    loaded, loaded_affine, header = load_mif(mif_file)
+    np.testing.assert_array_equal(loaded, data)
+    np.testing.assert_allclose(loaded_affine, affine)
+    assert header["dw_scheme"] == dw_scheme
+
+    img = MifImage.from_filename(mif_file)
+    img.to_filename(str(tmp_path / ("copy" + extension)))
+    copy = MifImage.from_filename(str(tmp_path / ("copy" + extension)))
+    np.testing.assert_array_equal(np.asanyarray(copy.dataobj), data)
+    np.testing.assert_allclose(copy.affine, affine)
+    assert copy.extra["dw_scheme"] == dw_scheme
+
+
+def test_calculate_sop_from_mif(tmp_path):
+    """SH coefficients read from a .mif give LPS+ order parameter maps, as from NIfTI."""
+    rng = np.random.default_rng(0)
+    data = rng.normal(size=(4, 5, 3, 15)).astype(np.float32)
+    data[..., 0] = rng.uniform(1, 2, size=data.shape[:3])
+    affine = np.array([[2.0, 0, 0, -4], [0, 2, 0, -5], [0, 0, 2, -3], [0, 0, 0, 1]])
+    mif_file = str(tmp_path / "fod.mif")
+    save_mif(mif_file, data, affine)
+
+    result = CalculateSOP(sh_nifti=mif_file, order=4).run(cwd=str(tmp_path)).outputs
+    sh_l, _ = get_l_m(4)
+    normalized = data / data[..., :1]
+    for order, out_file in ((2, result.q2_file), (4, result.q4_file)):
+        img = nb.load(out_file)
+        assert nb.aff2axcodes(img.affine) == ("L", "P", "S")
+        np.testing.assert_allclose(img.affine @ [3, 4, 0, 1], affine @ [0, 0, 0, 1])
+        expected = calculate_steinhardt(sh_l, None, normalized, order)[::-1, ::-1]
+        np.testing.assert_allclose(img.get_fdata(), expected, rtol=1e-5)
@@ -0,0 +1,81 @@
+"""Tests for the batched ODF peak detection."""
+
+import numpy as np
+import pytest
+from dipy.data import default_sphere
+from dipy.direction import peak_directions
+
+from qsirecon.interfaces.dipy import _odf8_hemisphere
+from qsirecon.utils.peaks import batch_peak_directions, sphere_neighbors
+
+
+def _random_odfs(n_odfs, vertices, seed=0, lobe_directions=None):
+    """Sums of a few sharp lobes plus noise, sampled on ``vertices``."""
+    rng = np.random.default_rng(seed)
+    if lobe_directions is None:
+        lobe_directions = vertices
+    odfs = rng.uniform(0, 0.05, size=(n_odfs, len(vertices)))
+    for odf in odfs:
+        for _ in range(rng.integers(1, 4)):
+            direction = lobe_directions[rng.integers(len(lobe_directions))]
+            odf += rng.uniform(0.5, 1) * np.abs(vertices @ direction) ** 20
+    return odfs
+
+
+def _check_dipy_peaks(odfs, sphere, values, indices, **kwargs):
+    """Check each ODF's peaks against those of dipy's peak_directions."""
+    num_peaks = values.shape[1]
+    for odf, odf_values, odf_indices in zip(odfs, values, indices):
+        _, expected_values, expected_indices = peak_directions(
+            odf, sphere, is_symmetric=True, **kwargs
+        )
+        expected_values = expected_values[:num_peaks]
+        n_found = len(expected_values)
+        np.testing.assert_array_equal(odf_indices[:n_found], expected_indices[:num_peaks])
+        np.testing.assert_allclose(odf_values[:n_found], expected_values)
+        assert np.all(odf_indices[n_found:] == -1)
+        assert np.all(odf_values[n_found:] == 0)
+
+
+@pytest.mark.parametrize("n_threads", [1, 3])
+def test_batch_peak_directions_matches_dipy(n_threads):
+    """The peaks of each ODF are those of dipy's peak_directions."""
+    odfs = _random_odfs(50, default_sphere.vertices)
+    values, indices = batch_peak_directions(
+        odfs,
+        default_sphere,
+        num_peaks=3,
+        relative_peak_threshold=0.25,
+        min_separation_angle=25,
+        chunk_size=8,
+        n_threads=n_threads,
+    )
+    _check_dipy_peaks(
+        odfs,
+        default_sphere,
+        values,
+        indices,
+        relative_peak_threshold=0.25,
+        min_separation_angle=25,
+    )
+
+
+def test_batch_peak_directions_odf8_hemisphere():
+    """Peaks on the equator of the odf8 hemisphere use its antipodal neighbors, as in dipy."""
+    _, _, hemisphere = _odf8_hemisphere()
+    neighbors = sphere_neighbors(hemisphere)
+    vertices = hemisphere.vertices
+    # Vertices near the equator are adjacent to the antipodes of some of their neighbors
+    equator = np.abs(vertices[:, 2]) < 0.2
+    through_antipode = np.einsum("ij,ikj->ik", vertices, vertices[neighbors]) < 0
+    assert through_antipode.any()
+    assert through_antipode[equator].any(1).mean() > 0.5
+    assert not through_antipode[~equator].any()
+
+    odfs = _random_odfs(100, vertices, seed=1, lobe_directions=vertices[equator])
+    # The parameters used when writing fib files
+    values, indices = batch_peak_directions(odfs, hemisphere, num_peaks=5, neighbors=neighbors)
+    _check_dipy_peaks(
+        odfs, hemisphere, values, indices, relative_peak_threshold=0.5, min_separation_angle=25
+    )
+    assert (vertices[indices[indices >= 0], 2] < 0.2).all()
@@ -0,0 +1,237 @@
+"""Tests for the scalar mapping statistics, checked against their original loops."""
+
+import nibabel as nb
+import nilearn.image as nim
+import numpy as np
+import pandas as pd
+import pytest
+
+from qsirecon.interfaces import scalar_mapping
+from qsirecon.interfaces.scalar_mapping import (
+    AtlasMapper,
+    TemplateMapper,
+    _atlas_regions,
+    _segment_median,
+    calculate_mask_stats,
+)
+
+
+def test_segment_median():
+    """Each segment gets the median of its values, and empty segments NaN."""
+    rng = np.random.default_rng(0)
+    segment_ids = rng.integers(0, 6, size=101)
+    segment_ids[segment_ids == 4] = 5
+    values = rng.normal(size=101).astype(np.float32)
+
+    medians = _segment_median(values, segment_ids, 7)
+    for segment in range(7):
+        if segment in (4, 6):
+            assert np.isnan(medians[segment])
+        else:
+            np.testing.assert_allclose(
+                medians[segment], np.median(values[segment_ids == segment]), rtol=1e-6
+            )
+
+
+def _mask_stats_loop(voxel_data, weighting_vector=None):
+    """The statistics of one mask, computed as calculate_mask_stats did with a masker."""
+    nz_voxel_data = voxel_data.copy()
+    nz_voxel_data[nz_voxel_data == 0] = np.nan
+    nz_voxel_data[~np.isfinite(voxel_data)] = np.nan
+    results = {
+        "zero_proportion": np.sum(np.isnan(nz_voxel_data)) / voxel_data.shape[0],
+        "mean": np.mean(voxel_data),
+        "stdev": np.std(voxel_data),
+        "median": np.median(voxel_data),
+        "masked_mean": np.nanmean(nz_voxel_data),
+        "masked_median": np.nanmedian(nz_voxel_data),
+        "masked_stdev": np.nanstd(nz_voxel_data),
+    }
+    if weighting_vector is not None:
+        results["weighted_mean"] = np.sum(voxel_data * weighting_vector)
+        nz_weighting_vector = weighting_vector.copy()
+        nz_weighting_vector[np.isnan(nz_voxel_data)] = np.nan
+        nz_weighting_vector = nz_weighting_vector / np.nansum(nz_weighting_vector)
+        results["masked_weighted_mean"] = np.nansum(nz_voxel_data * nz_weighting_vector)
+    return results
+
+
+@pytest.mark.filterwarnings("ignore::RuntimeWarning")
+@pytest.mark.parametrize("weighted", [False, True])
+def test_calculate_mask_stats(weighted):
+    """The statistics of overlapping masks match those computed one mask at a time."""
+    rng = np.random.default_rng(0)
+    scalar = rng.normal(1, 0.5, size=200)
+    scalar[rng.random(200) < 0.2] = 0
+    scalar[7] = np.nan
+    masks = [
+        np.arange(0, 120),
+        np.arange(100, 200),
+        np.arange(5, 10),  # contains the NaN
+        np.flatnonzero(scalar == 0)[:10],  # all zeros
+    ]
+    weights = [rng.random(len(mask)) for mask in masks]
+    weights = [weight / weight.sum() for weight in weights]
+
+    values = np.concatenate([scalar[mask] for mask in masks])
+    segment_ids = np.concatenate([np.full(len(mask), i_mask) for i_mask, mask in enumerate(masks)])
+    recon_scalar = {
+        "variable_name": "fa_file",
+        "qsirecon_suffix": "DIPYDKI",
+        "source_file": "sub-1_dwi.nii.gz",
+    }
+    mask_names = ["a", "b", "nan", "zeros"]
+    results = calculate_mask_stats(
+        values,
+        segment_ids,
+        mask_names,
+        "bundle",
+        recon_scalar,
+        weighting_vector=np.concatenate(weights) if weighted else None,
+    )
+
+    assert [result["bundle"] for result in results] == mask_names
+    for result, mask, weight in zip(results, masks, weights):
+        assert result["variable_name"] == "fa"
+        expected = _mask_stats_loop(scalar[mask], weight if weighted else None)
+        assert set(expected) <= set(result)
+        for stat, value in expected.items():
+            np.testing.assert_allclose(result[stat], value, rtol=1e-10, err_msg=stat)
+
+
+def test_atlas_regions():
+    """Each labeled voxel gets the position of its label in node_ids."""
+    rng = np.random.default_rng(0)
+    labels = rng.choice([0, 1, 2, 3, 99], size=(6, 5, 4))
+    ref_img = nb.Nifti1Image(np.zeros(labels.shape, dtype=np.float32), np.eye(4))
+    atlas_img = nb.Nifti1Image(labels.astype(np.int16), np.eye(4))
+
+    # Unsorted node ids, and a label (99) that is not a node
+    node_ids = [3, 1, 2]
+    voxel_index, region_index = _atlas_regions(atlas_img, node_ids, ref_img)
+    flat_labels = labels.reshape(-1)
+    np.testing.assert_array_equal(voxel_index, np.flatnonzero(np.isin(flat_labels, node_ids)))
+    np.testing.assert_array_equal(np.take(node_ids, region_index), flat_labels[voxel_index])
+
+    # Atlases on another grid are resampled to the reference with nearest neighbors
+    fine_img = nb.Nifti1Image(np.zeros((12, 10, 8), dtype=np.float32), np.diag([0.5] * 3 + [1]))
+    voxel_index, region_index = _atlas_regions(atlas_img, node_ids, fine_img)
+    fine_labels = np.asanyarray(
+        nim.resample_to_img(atlas_img, fine_img, interpolation="nearest").dataobj
+    ).reshape(-1)
+    np.testing.assert_array_equal(voxel_index, np.flatnonzero(np.isin(fine_labels, node_ids)))
+    np.testing.assert_array_equal(np.take(node_ids, region_index), fine_labels[voxel_index])
+
+
+def test_atlas_mapper(tmp_path, monkeypatch):
+    """Every region of every atlas is summarized, as with one mask per region."""
+    monkeypatch.chdir(tmp_path)
+    rng = np.random.default_rng(0)
+    shape = (6, 5, 4)
+    dwiref_file = str(tmp_path / "sub-1_ses-2_space-T1w_dwiref.nii.gz")
+    nb.Nifti1Image(np.zeros(shape, dtype=np.float32), np.eye(4)).to_filename(dwiref_file)
+
+    atlases = {"first": rng.integers(0, 4, size=shape), "second": rng.integers(0, 3, size=shape)}
+    atlas_configs = {}
+    for atlas_name, labels in atlases.items():
+        atlas_file = str(tmp_path / f"{atlas_name}.nii.gz")
+        nb.Nifti1Image(labels.astype(np.int16), np.eye(4)).to_filename(atlas_file)
+        node_ids = sorted(set(np.unique(labels)) - {0})
+        atlas_configs[atlas_name] = {
+            "dwi_resolution_file": atlas_file,
+            "node_ids": node_ids,
+            "node_names": [f"{atlas_name}{node_id}" for node_id in node_ids],
+        }
+
+    scalars = {"fa": rng.random(shape), "md": rng.random(shape)}
+    recon_scalars = []
+    for scalar_name, data in scalars.items():
+        scalar_file = str(tmp_path / f"{scalar_name}.nii.gz")
+        nb.Nifti1Image(data.astype(np.float32), np.eye(4)).to_filename(scalar_file)
+        recon_scalars.append(
+            {
+                "path": scalar_file,
+                "variable_name": f"{scalar_name}_file",
+                "qsirecon_suffix": "DIPYDTI",
+                "source_file": scalar_file,
+            }
+        )
+    # Orientation-dependent scalars are not summarized
+    recon_scalars.append({**recon_scalars[0], "reorient_on_resample": True})
+
+    result = AtlasMapper(
+        atlas_configs=atlas_configs, recon_scalars=recon_scalars, dwiref_image=dwiref_file
+    ).run()
+    summary = pd.read_csv(result.outputs.atlas_summary, sep="\t")
+
+    n_regions = sum(len(atlas_config["node_ids"]) for atlas_config in atlas_configs.values())
+    assert len(summary) == n_regions * len(scalars)
+    assert set(summary["subject_id"]) == {"sub-1"}
+    for row in summary.itertuples():
+        atlas_config = atlas_configs[row.atlas]
+        node_id = atlas_config["node_ids"][atlas_config["node_names"].index(row.region)]
+        values = scalars[row.variable_name][atlases[row.atlas] == node_id].astype(np.float32)
+        np.testing.assert_allclose(row.mean, values.mean(), rtol=1e-5)
+        np.testing.assert_allclose(row.median, np.median(values), rtol=1e-5)
+
+
+def test_template_mapper_stacks(tmp_path, monkeypatch):
+    """Scalars on the same grid are resampled together, and split back in order."""
+    monkeypatch.chdir(tmp_path)
+    calls = []
+
+    def fake_apply_transforms(**kwargs):
+        # An identity transform: the stack is copied as float32
+        calls.append(kwargs)
+        if kwargs.get("print_out_composite_warp_file"):
+            open(kwargs["output_image"], "w").close()
+            return
+        img = nb.load(kwargs["input_image"])
+        assert img.get_data_dtype() == np.float32
+        nb.Nifti1Image(img.get_fdata(dtype=np.float32), img.affine).to_filename(
+            kwargs["output_image"]
+        )
+
+    monkeypatch.setattr(scalar_mapping, "_run_apply_transforms", fake_apply_transforms)
+
+    rng = np.random.default_rng(0)
+    template_file = str(tmp_path / "template.nii.gz")
+    nb.Nifti1Image(np.zeros((4, 4, 4), dtype=np.float32), np.eye(4)).to_filename(template_file)
+    transform_file = tmp_path / "to_template.h5"
+    transform_file.touch()
+
+    # Three scalars on the DWI grid and one on a coarser grid
+    grids = [np.eye(4)] * 3 + [np.diag([2.0, 2.0, 2.0, 1.0])]
+    scalars = []
+    recon_scalars = []
+    for scalar_num, affine in enumerate(grids):
+        data = rng.random((5, 6, 7)).astype(np.float32)
+        scalar_file = str(tmp_path / f"sub-1_space-T1w_desc-scalar{scalar_num}_dwimap.nii.gz")
+        nb.Nifti1Image(data, affine).to_filename(scalar_file)
+        scalars.append(data)
+        recon_scalars.append({"path": scalar_file, "bids": {"desc": f"scalar{scalar_num}"}})
+    recon_scalars.append({**recon_scalars[0], "reorient_on_resample": True})
+
+    result = TemplateMapper(
+        recon_scalars=recon_scalars,
+        template_reference_image=template_file,
+        to_template_transform=str(transform_file),
+        max_stack_size=2,
+    ).run()
+
+    # The transform is composed once, then each grid is resampled in stacks of two
+    warp_file = calls[0]["output_image"]
+    assert calls[0]["print_out_composite_warp_file"]
+    stack_sizes = [nb.load(call["input_image"]).shape[3] for call in calls[1:]]
+    assert stack_sizes == [2, 1, 1]
+    assert all(call["transforms"] == [warp_file] for call in calls[1:])
+
+    outputs = result.outputs
+    assert len(outputs.template_space_scalars) == len(scalars)
+    for scalar_num, (out_file, info) in enumerate(
+        zip(outputs.template_space_scalars, outputs.template_space_scalar_info)
+    ):
+        assert "_transformed_" in out_file
+        assert info["path"] == out_file
+        assert info["bids"] == {"desc": f"scalar{scalar_num}", "space": "MNI152NLin2009cAsym"}
+        np.testing.assert_array_equal(nb.load(out_file).get_fdata(), scalars[scalar_num])
@@ -132,3 +132,19 @@ def reorder_expected_outputs():
 
         with open(expected_output_file, "w") as fo:
             fo.writelines(file_contents)
+
+
+def simulate_multishell(n_voxels=40, seed=0):
+    """Make a two-shell gradient table and noisy signals with random diffusivities."""
+    import numpy as np
+    from dipy.core.gradients import gradient_table
+
+    rng = np.random.default_rng(seed)
+    bvecs = rng.normal(size=(40, 3))
+    bvecs /= np.linalg.norm(bvecs, axis=1)[:, None]
+    bvecs[:4] = 0
+    bvals = np.r_[np.zeros(4), np.full(18, 1000.0), np.full(18, 3000.0)]
+    gtab = gradient_table(bvals, bvecs, big_delta=0.04, small_delta=0.02)
+    diffusivities = rng.uniform(0.3e-3, 1.5e-3, size=(n_voxels, 1))
+    data = np.exp(-bvals * diffusivities) + rng.normal(0, 0.02, size=(n_voxels, 40))
+    return gtab, data
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Fitting reconstruction models to blocks of voxels in parallel
+^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^
+
+The signal of the voxels in the brain mask is split into contiguous blocks
+that are fit by a pool of processes. The signal is placed in shared memory
+once, so workers only receive the bounds of their blocks. Each worker also
+computes the maps requested from its fit, so the parent process only
+concatenates them and never holds (or pickles) the fit objects.
+
+Any model whose ``fit`` accepts a 2D array of voxels by measurements works,
+e.g. :class:`~dipy.reconst.mapmri.MapmriModel`,
+:class:`~dipy.reconst.dki.DiffusionKurtosisModel` and
+:class:`~qsirecon.utils.brainsuite_shore.BrainSuiteShoreModel`.
+
+"""
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+# The state of a worker process, set up once by _init_worker
+_WORKER = {}
+
+
+def _output_specs(outputs):
+    """Turn each output into a (attribute name, arguments) pair."""
+    specs = {}
+    for name, spec in outputs.items():
+        if isinstance(spec, str):
+            spec = (spec,)
+        specs[name] = (spec[0], tuple(spec[1:]))
+    return specs
+
+
+def _fit_outputs(model, voxel_data, specs, fit_kwargs):
+    """Fit a model to some voxels and get the requested outputs from the fit."""
+    fit = model.fit(voxel_data, **fit_kwargs)
+    results = {}
+    for name, (attribute, args) in specs.items():
+        value = getattr(fit, attribute)
+        if callable(value):
+            value = value(*args)
+        results[name] = np.asarray(value)
+    return results
+
+
+def _init_worker(shm_name, shape, dtype, make_model, specs, fit_kwargs):
+    shm = SharedMemory(name=shm_name)
+    _WORKER["shm"] = shm
+    _WORKER["data"] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    _WORKER["model"] = make_model()
+    _WORKER["specs"] = specs
+    _WORKER["fit_kwargs"] = fit_kwargs
+
+
+def _fit_block(bounds):
+    start, stop = bounds
+    # The fit may keep references to its data, so it gets a private copy
+    voxel_data = np.array(_WORKER["data"][start:stop])
+    return _fit_outputs(_WORKER["model"], voxel_data, _WORKER["specs"], _WORKER["fit_kwargs"])
+
+
+def fit_voxel_blocks(
+    make_model, voxel_data, outputs, n_jobs=1, block_size=None, block_multiple=1, fit_kwargs=None
+):
+    """Fit a model to blocks of voxels in parallel and assemble the maps from the fits.
+
+    Parameters
+    ----------
+    make_model : callable
+        Creates the model, e.g. a :func:`functools.partial` of the model's class
+        and arguments. It is called once in each worker, so it must be picklable.
+    voxel_data : :obj:`numpy.ndarray`
+        The signal of the voxels to fit, with shape (n_voxels, n_measurements).
+    outputs : :obj:`dict`
+        Maps the name of each output to the attribute of the fit it is read from.
+        Methods are called, with the arguments given after their name in a tuple,
+        e.g. ``{"coeffs": "mapmri_coeff", "odf": ("odf", sphere)}``.
+    n_jobs : :obj:`int`
+        Number of processes. With 1, the voxels are fit in this process.
+    block_size : :obj:`int`, optional
+        Number of voxels in a block. By default, the voxels are split into four
+        blocks per process so that slow blocks are balanced out.
+    block_multiple : :obj:`int`
+        The block size is rounded up to a multiple of this. Models whose fit of a
+        voxel depends on its position in the block, such as the warm-started L1
+        fits of :class:`~qsirecon.utils.brainsuite_shore.BrainSuiteShoreModel`,
+        then give the same results for any number of processes.
+    fit_kwargs : :obj:`dict`, optional
+        Extra arguments for the model's ``fit``.
+
+    Returns
+    -------
+    results : :obj:`dict`
+        Each output, as an array whose first axis has one entry per voxel.
+    """
+    specs = _output_specs(outputs)
+    fit_kwargs = fit_kwargs or {}
+    n_voxels = voxel_data.shape[0]
+    n_jobs = max(1, int(n_jobs))
+    if block_size is None:
+        block_size = int(np.ceil(n_voxels / (4 * n_jobs)))
+    block_multiple = max(1, int(block_multiple))
+    block_size = -(-max(1, block_size) // block_multiple) * block_multiple
+    blocks = [
+        (start, min(start + block_size, n_voxels)) for start in range(0, n_voxels, block_size)
+    ]
+
+    if n_jobs == 1 or len(blocks) < 2:
+        return _fit_outputs(make_model(), voxel_data, specs, fit_kwargs)
+
+    voxel_data = np.ascontiguousarray(voxel_data)
+    shm = SharedMemory(create=True, size=max(1, voxel_data.nbytes))
+    try:
+        shared = np.ndarray(voxel_data.shape, dtype=voxel_data.dtype, buffer=shm.buf)
+        shared[:] = voxel_data
+        del shared
+        with ProcessPoolExecutor(
+            max_workers=min(n_jobs, len(blocks)),
+            initializer=_init_worker,
+            initargs=(
+                shm.name,
+                voxel_data.shape,
+                voxel_data.dtype,
+                make_model,
+                specs,
+                fit_kwargs,
+            ),
+        ) as executor:
+            block_results = list(executor.map(_fit_block, blocks))
+    finally:
+        shm.close()
+        shm.unlink()
+
+    return {name: np.concatenate([result[name] for result in block_results]) for name in specs}
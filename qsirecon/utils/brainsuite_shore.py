@@ -6,17 +6,21 @@ from math import factorial
 import numpy as np
 from dipy.core.geometry import cart2sphere
 from dipy.reconst.cache import Cache
-from dipy.reconst.multi_voxel import multi_voxel_fit
 from dipy.utils.optpkg import optional_package
 from scipy.special import gamma, genlaguerre, hyp2f1
+from sklearn.base import clone
 from sklearn.exceptions import ConvergenceWarning
 from sklearn.linear_model import Lasso, LassoCV
-from sklearn.metrics import r2_score
 
 from .shm import real_sym_sh_brainsuite
 
 cvxpy, have_cvxpy, _ = optional_package("cvxpy")
 
+# Fixed-alpha L1 fits start from the solution of the previous voxel, in runs of
+# this many voxels. Runs always start at multiples of it, so blocks of voxels that
+# are multiples of it are fit the same way however the voxels are split up.
+L1_WARM_START_VOXELS = 64
+
 
 class BrainSuiteShoreModel(Cache):
     r"""Simple Harmonic Oscillator based Reconstruction and Estimation
@@ -186,10 +190,8 @@ class BrainSuiteShoreModel(Cache):
         ell = self.ind_mat[:, 1]
         return np.diag((ell * (ell + 1)) ** 2)
 
-    @multi_voxel_fit
-    def fit(self, data):
-
-        # Generate the SHORE basis
+    def _shore_matrices(self):
+        """Get the (cached) SHORE basis and its regularized pseudoinverse."""
         M = self.cache_get("shore_matrix", key=self.gtab)
         if M is None:
             M = brainsuite_shore_basis(self.radial_order, self.zeta, self.gtab, self.tau)
@@ -200,67 +202,151 @@ class BrainSuiteShoreModel(Cache):
                 np.dot(M.T, M) + self.lambdaN * self.Nshore + self.lambdaL * self.Lshore, M.T
             )
             self.cache_set("shore_matrix_reg_pinv", self.gtab, MpseudoInv)
+        return M, MpseudoInv
+
+    def _make_lasso(self):
+        """Create an unfitted estimator for the L1 fits."""
+        if self.regularization_weighting == "CV":
+            return LassoCV(
+                fit_intercept=False,
+                cv=self.l1_cv,
+                positive=self.l1_positive_constraint,
+                max_iter=self.l1_maxiter,
+                verbose=self.l1_verbose,
+            )
+        return Lasso(
+            fit_intercept=False,
+            alpha=self.l1_alpha,
+            positive=self.l1_positive_constraint,
+            max_iter=self.l1_maxiter,
+            warm_start=True,
+        )
+
+    def fit(self, data, mask=None):
+        """Fit the SHORE model to every voxel in ``data`` where ``mask`` is True.
+
+        L2 fits are solved for all voxels at once, L1 fits voxel by voxel.
+        Either way a single :class:`BrainSuiteShoreFit` whose attributes are
+        volumes is returned. Use :func:`~qsirecon.utils.blockfit.fit_voxel_blocks`
+        with ``block_multiple=L1_WARM_START_VOXELS`` to fit blocks of voxels in
+        parallel.
 
-        # Compute the signal coefficients in SHORE basis
-        l2_fallback = False
-        if self.regularization == "L1":
-            regularization = 1
-            if self.regularization_weighting == "CV":
-                lasso = LassoCV(
-                    fit_intercept=False,
-                    cv=self.l1_cv,
-                    positive=self.l1_positive_constraint,
-                    max_iter=self.l1_maxiter,
-                    verbose=self.l1_verbose,
-                )
-            else:
-                lasso = Lasso(
-                    fit_intercept=False,
-                    alpha=self.l1_alpha,
-                    positive=self.l1_positive_constraint,
-                    max_iter=self.l1_maxiter,
-                )
-
-            # Try the L1 fit
-            with warnings.catch_warnings():
-                warnings.filterwarnings("error", category=ConvergenceWarning)
+        Parameters
+        ----------
+        data : ndarray
+            diffusion signal. The last axis holds the measurements.
+        mask : ndarray, optional
+            boolean array with the shape of ``data.shape[:-1]``
+        """
+        data = np.asarray(data)
+        if mask is None:
+            mask = np.ones(data.shape[:-1], dtype=bool)
+        elif mask.shape != data.shape[:-1]:
+            raise ValueError("mask and data shape do not match")
+        mask = np.asarray(mask, dtype=bool)
+        return self.fit_voxels(data[mask], mask)
 
-                try:
-                    lasso_fit = lasso.fit(M, data)
-                    coef = lasso_fit.coef_
-                    alpha = lasso_fit.alpha_
-                    fitted = lasso_fit.predict(M)
+    def fit_voxels(self, voxel_data, mask):
+        """Fit the SHORE model to the signal of the voxels in a mask.
 
-                except Warning as this_warning:
-                    if isinstance(this_warning, ConvergenceWarning):
-                        l2_fallback = True
-                    else:
-                        raise this_warning
+        Same as :meth:`fit`, for data that was already extracted from the mask.
 
-        if self.regularization == "L2" or l2_fallback:
-            regularization = 2
-            coef = np.dot(MpseudoInv, data)
-            fitted = np.dot(M, coef)
-            alpha = 0
+        Parameters
+        ----------
+        voxel_data : ndarray
+            diffusion signal of the voxels where ``mask`` is True, in the order
+            of ``data[mask]``. The last axis holds the measurements.
+        mask : ndarray
+            boolean array with the shape of the fitted volume
+        """
+        mask = np.asarray(mask, dtype=bool)
+        if voxel_data.shape[0] != np.count_nonzero(mask):
+            raise ValueError("voxel_data must have one row per voxel in the mask")
 
-        r2 = r2_score(data, fitted)
-        cnr = np.nan_to_num(np.var(fitted) / np.var(fitted - data))
-        return BrainSuiteShoreFit(self, coef, regularization, alpha, r2, cnr)
+        M, MpseudoInv = self._shore_matrices()
+        if self.regularization == "L1":
+            coef, alpha, regularization = _fit_l1_voxels(
+                self._make_lasso(), M, MpseudoInv, voxel_data
+            )
+        else:
+            coef = np.dot(voxel_data, MpseudoInv.T)
+            alpha = np.zeros(voxel_data.shape[0])
+            regularization = np.full(voxel_data.shape[0], 2)
+
+        fitted = np.dot(coef, M.T)
+        r2 = _batched_r2_score(voxel_data, fitted)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            cnr = np.nan_to_num(fitted.var(axis=1) / (fitted - voxel_data).var(axis=1))
+
+        shore_coef = np.zeros(mask.shape + (self.n_coefs,))
+        shore_coef[mask] = coef
+        regularization_map = np.zeros(mask.shape, dtype=int)
+        regularization_map[mask] = regularization
+        alpha_map = np.zeros(mask.shape)
+        alpha_map[mask] = alpha
+        r2_map = np.zeros(mask.shape)
+        r2_map[mask] = r2
+        cnr_map = np.zeros(mask.shape)
+        cnr_map[mask] = cnr
+
+        return BrainSuiteShoreFit(
+            self,
+            shore_coef,
+            regularization=regularization_map,
+            alpha=alpha_map,
+            r2=r2_map,
+            cnr=cnr_map,
+            mask=mask,
+        )
+
+
+def _fit_l1_voxels(lasso, M, MpseudoInv, voxel_data):
+    """Fit voxels one at a time with L1 regularization.
+
+    With a fixed alpha, each voxel starts from the coefficients of the previous
+    one, except at the start of each run of ``L1_WARM_START_VOXELS`` voxels.
+    Voxels that do not converge fall back to the L2 solution, and the next voxel
+    starts from scratch.
+    """
+    n_voxels = voxel_data.shape[0]
+    coef = np.zeros((n_voxels, M.shape[1]))
+    alpha = np.zeros(n_voxels)
+    regularization = np.ones(n_voxels, dtype=int)
+    estimator = None
+    for voxel_num, signal in enumerate(voxel_data):
+        if estimator is None or voxel_num % L1_WARM_START_VOXELS == 0:
+            estimator = clone(lasso)
+        with warnings.catch_warnings():
+            warnings.filterwarnings("error", category=ConvergenceWarning)
+            try:
+                estimator.fit(M, signal)
+            except ConvergenceWarning:
+                coef[voxel_num] = np.dot(MpseudoInv, signal)
+                regularization[voxel_num] = 2
+                estimator = None
+                continue
+        coef[voxel_num] = estimator.coef_
+        alpha[voxel_num] = estimator.alpha_ if isinstance(estimator, LassoCV) else estimator.alpha
+    return coef, alpha, regularization
 
 
 class BrainSuiteShoreFit:
-    def __init__(self, model, shore_coef, regularization=0, alpha=0.0, r2=0.0, cnr=0.0):
-        """Calculates diffusion properties for a single voxel
+    def __init__(self, model, shore_coef, regularization=0, alpha=0.0, r2=0.0, cnr=0.0, mask=None):
+        """Calculates diffusion properties for a single voxel or an array of voxels
 
         Parameters
         ----------
         model : object,
             AnalyticalModel
-        shore_coef : 1d ndarray,
-            shore coefficients
+        shore_coef : ndarray,
+            shore coefficients. The last axis holds the coefficients, any
+            leading axes are voxels.
+        mask : ndarray, optional
+            boolean array of the voxels that were fit
         """
 
         self.model = model
+        self.mask = mask
         self._shore_coef = shore_coef
         self._alpha = alpha
         self._r2 = r2
@@ -285,7 +371,8 @@ class BrainSuiteShoreFit:
         Returns
         -------
         eap : ndarray
-            the ensemble average propagator in the 3D grid
+            the ensemble average propagator in the 3D grid of each voxel, with
+            shape ``voxel shape + (gridsize, gridsize, gridsize)``
 
         """
         # Create the grid in which to compute the pdf
@@ -297,12 +384,13 @@ class BrainSuiteShoreFit:
 
         psi = self.model.cache_get("shore_matrix_pdf", key=(gridsize, radius_max))
         if psi is None:
-            psi = shore_matrix_pdf(self.radial_order, self.zeta, rtab)
+            psi = brainsuite_shore_matrix_pdf(self.radial_order, self.zeta, rtab)
             self.model.cache_set("shore_matrix_pdf", (gridsize, radius_max), psi)
 
-        propagator = np.dot(psi, self._shore_coef)
-        eap = np.empty((gridsize, gridsize, gridsize), dtype=float)
-        eap[tuple(rgrid.astype(int).T)] = propagator
+        propagator = np.dot(self._shore_coef, psi.T)
+        voxel_shape = self._shore_coef.shape[:-1]
+        eap = np.empty(voxel_shape + (gridsize, gridsize, gridsize), dtype=float)
+        eap[(Ellipsis,) + tuple(rgrid.astype(int).T)] = propagator
         eap *= (2 * radius_max / (gridsize - 1)) ** 3
 
         return eap
@@ -321,9 +409,9 @@ class BrainSuiteShoreFit:
             if not r_points.flags.writeable:
                 self.model.cache_set("shore_matrix_pdf", hash(r_points.data), psi)
 
-        eap = np.dot(psi, self._shore_coef)
+        eap = np.dot(self._shore_coef, psi.T)
 
-        return np.clip(eap, 0, eap.max())
+        return np.maximum(eap, 0)
 
     def odf_sh(self):
         r"""Calculates the real analytical ODF in terms of Spherical
@@ -333,7 +421,7 @@ class BrainSuiteShoreFit:
         J = (self.radial_order + 1) * (self.radial_order + 2) // 2
 
         # Compute the Spherical Harmonics Coefficients
-        c_sh = np.zeros(J)
+        c_sh = np.zeros(self._shore_coef.shape[:-1] + (J,))
         counter = 0
 
         for n in range(self.radial_order + 1):
@@ -362,7 +450,7 @@ class BrainSuiteShoreFit:
                     )
                     Fnl = hyp2f1(-n + ell, ell / 2 + 3.0 / 2.0, ell + 3.0 / 2.0, 2.0)
 
-                    c_sh[j] += self._shore_coef[counter] * Cnl * Gnl * Fnl
+                    c_sh[..., j] += self._shore_coef[..., counter] * Cnl * Gnl * Fnl
                     counter += 1
 
         return c_sh
@@ -374,7 +462,7 @@ class BrainSuiteShoreFit:
             upsilon = shore_matrix_odf(self.radial_order, self.zeta, sphere.vertices)
             self.model.cache_set("shore_matrix_odf", sphere, upsilon)
 
-        odf = np.dot(upsilon, self._shore_coef)
+        odf = np.dot(self._shore_coef, upsilon.T)
         return odf
 
     def rtop_signal(self):
@@ -392,12 +480,12 @@ class BrainSuiteShoreFit:
 
         for n in range(int(self.radial_order / 2) + 1):
             rtop += (
-                c[n]
+                c[..., n]
                 * (-1) ** n
                 * ((16 * np.pi * self.zeta**1.5 * gamma(n + 1.5)) / (factorial(n))) ** 0.5
             )
 
-        return np.clip(rtop, 0, rtop.max())
+        return np.maximum(rtop, 0)
 
     def rtop_pdf(self):
         r"""Calculates the analytical return to origin probability (RTOP)
@@ -413,13 +501,13 @@ class BrainSuiteShoreFit:
         c = self._shore_coef
         for n in range(int(self.radial_order / 2) + 1):
             rtop += (
-                c[n]
+                c[..., n]
                 * (-1) ** n
                 * ((4 * np.pi**2 * self.zeta**1.5 * factorial(n)) / (gamma(n + 1.5))) ** 0.5
                 * genlaguerre(n, 0.5)(0)
             )
 
-        return np.clip(rtop, 0, rtop.max())
+        return np.maximum(rtop, 0)
 
     def msd(self):
         r"""Calculates the analytical mean squared displacement (MSD) [1]_
@@ -445,25 +533,28 @@ class BrainSuiteShoreFit:
 
         for n in range(int(self.radial_order / 2) + 1):
             msd += (
-                c[n]
+                c[..., n]
                 * (-1) ** n
                 * (9 * (gamma(n + 1.5)) / (8 * np.pi**6 * self.zeta**3.5 * factorial(n))) ** 0.5
                 * hyp2f1(-n, 2.5, 1.5, 2)
             )
 
-        return np.clip(msd, 0, msd.max())
+        return np.maximum(msd, 0)
 
     def fitted_signal(self):
         """The fitted signal."""
         phi = self.model.cache_get("shore_matrix", key=self.model.gtab)
-        return np.dot(phi, self._shore_coef)
+        return np.dot(self._shore_coef, phi.T)
 
     def predict(self, gtab, S0=100.0):
         r"""Recovers the reconstructed signal for any qvalue array or
         gradient table.
         """
         M = brainsuite_shore_basis(self.radial_order, self.zeta, gtab, self.model.tau)
-        E = S0 * np.dot(M, self._shore_coef)
+        S0 = np.asarray(S0)
+        if S0.ndim:
+            S0 = S0[..., np.newaxis]
+        E = S0 * np.dot(self._shore_coef, M.T)
         return E
 
     @property
@@ -492,6 +583,17 @@ class BrainSuiteShoreFit:
         return self._r2
 
 
+def _batched_r2_score(data, fitted):
+    """Row-wise equivalent of :func:`sklearn.metrics.r2_score` for 1D inputs."""
+    ss_res = ((data - fitted) ** 2).sum(axis=1)
+    ss_tot = ((data - data.mean(axis=1, keepdims=True)) ** 2).sum(axis=1)
+    r2 = np.ones(data.shape[0])
+    nonzero_tot = ss_tot != 0
+    r2[nonzero_tot] = 1 - ss_res[nonzero_tot] / ss_tot[nonzero_tot]
+    r2[~nonzero_tot & (ss_res != 0)] = 0.0
+    return r2
+
+
 def _kappa(zeta, n, ell):
     return np.sqrt((2 * factorial(n - ell)) / (zeta**1.5 * gamma(n + 1.5)))
 
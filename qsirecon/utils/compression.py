@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Parallel gzip compression
+^^^^^^^^^^^^^^^^^^^^^^^^^
+
+"""
+import os
+import struct
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+GZIP_BLOCK_SIZE = 1 << 24
+
+
+def _deflate_block(data, compresslevel, last):
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS)
+    # A full flush ends the block on a byte boundary, so the raw deflate
+    # streams of consecutive blocks can be concatenated
+    flush_mode = zlib.Z_FINISH if last else zlib.Z_FULL_FLUSH
+    return compressor.compress(data) + compressor.flush(flush_mode)
+
+
+def _gzip_header(compresslevel, mtime):
+    if compresslevel == zlib.Z_BEST_COMPRESSION:
+        xfl = 2
+    elif compresslevel == zlib.Z_BEST_SPEED:
+        xfl = 4
+    else:
+        xfl = 0
+    # Magic number, deflate, no flags, mtime, extra flags, unknown OS
+    return b"\037\213\010\000" + struct.pack("<L", int(mtime)) + bytes([xfl, 255])
+
+
+def parallel_gzip(in_file, out_file, compresslevel=6, n_threads=1, block_size=GZIP_BLOCK_SIZE):
+    """Compress a file into a standard single-member gzip file using several threads.
+
+    The input is split into blocks that are deflated independently, as ``pigz`` does.
+    The output can be read by :mod:`gzip`, ``zcat`` and nibabel like any gzip file.
+
+    Parameters
+    ----------
+    in_file : :obj:`str`
+        The uncompressed file to read.
+    out_file : :obj:`str`
+        The gzip file to write.
+    compresslevel : :obj:`int`
+        The zlib compression level, from 1 (fastest) to 9 (smallest).
+    n_threads : :obj:`int`
+        Number of blocks compressed at the same time.
+    block_size : :obj:`int`
+        Size of each block in bytes. Larger blocks compress slightly better.
+    """
+    file_size = os.path.getsize(in_file)
+    n_blocks = max(1, -(-file_size // block_size))
+    n_threads = max(1, n_threads)
+    crc = 0
+    with open(in_file, "rb") as f_in, open(out_file, "wb") as f_out:
+        f_out.write(_gzip_header(compresslevel, os.path.getmtime(in_file)))
+        # zlib releases the GIL while compressing, so blocks are deflated in parallel
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            pending = deque()
+            for block_index in range(n_blocks):
+                data = f_in.read(block_size)
+                crc = zlib.crc32(data, crc)
+                last = block_index == n_blocks - 1
+                pending.append(executor.submit(_deflate_block, data, compresslevel, last))
+                # Bound the number of blocks held in memory
+                while pending and (last or len(pending) > 2 * n_threads):
+                    f_out.write(pending.popleft().result())
+        f_out.write(struct.pack("<LL", crc, file_size & 0xFFFFFFFF))
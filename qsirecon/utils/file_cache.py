@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Caching derived files across runs
+^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^
+
+"""
+import hashlib
+import json
+import os
+import shutil
+from uuid import uuid4
+
+import nibabel as nb
+import numpy as np
+from filelock import FileLock, Timeout
+
+HASH_CHUNK_SIZE = 1 << 20
+METADATA_FILE = "metadata.json"
+
+
+def file_hash(path):
+    """Compute the SHA256 hash of a file's contents."""
+    sha = hashlib.sha256()
+    with open(path, "rb") as fobj:
+        for chunk in iter(lambda: fobj.read(HASH_CHUNK_SIZE), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def grid_hash(image_file):
+    """Compute a hash of the voxel grid (shape and affine) of an image."""
+    img = nb.load(image_file)
+    sha = hashlib.sha256()
+    sha.update(np.asarray(img.shape[:3], dtype=np.int64).tobytes())
+    sha.update(np.round(img.affine, 6).astype(np.float64).tobytes())
+    return sha.hexdigest()
+
+
+class FileCache:
+    """A content-addressed on-disk cache of derived files, such as resampled atlases.
+
+    Each entry is a directory named after the hash of everything that determines
+    its contents. Entries are created atomically and protected by per-entry lock
+    files, so parallel workers can share one cache. The least recently used
+    entries are removed when the cache grows beyond ``max_size_gb``.
+
+    Parameters
+    ----------
+    cache_dir : :obj:`str`
+        Directory where the cache entries are stored.
+    max_size_gb : :obj:`float`
+        Maximum total size of the cache entries, in GB.
+    """
+
+    def __init__(self, cache_dir, max_size_gb=2.0):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_size = int(max_size_gb * 1024**3)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(*parts):
+        """Build a cache key from strings, such as file or grid hashes."""
+        return hashlib.sha256("\n".join(parts).encode()).hexdigest()
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def _lock(self, key):
+        return FileLock(os.path.join(self.cache_dir, key + ".lock"))
+
+    def get_or_create(self, key, out_files, create):
+        """Copy the files of a cache entry, creating the entry first if needed.
+
+        Parameters
+        ----------
+        key : :obj:`str`
+            The cache key, see :meth:`key`.
+        out_files : :obj:`dict`
+            Maps the name of each file in the entry to the path it is copied to.
+        create : callable
+            Called on a cache miss. It should write all the paths in ``out_files``
+            and return a JSON-serializable dictionary of metadata. If any of the
+            files is missing afterwards, nothing is cached.
+
+        Returns
+        -------
+        metadata : :obj:`dict`
+            The metadata returned by ``create`` when the entry was created.
+        """
+        entry_dir = self._entry_dir(key)
+        with self._lock(key):
+            if os.path.isdir(entry_dir):
+                for name, out_file in out_files.items():
+                    shutil.copyfile(os.path.join(entry_dir, name), out_file)
+                with open(os.path.join(entry_dir, METADATA_FILE)) as fobj:
+                    metadata = json.load(fobj)
+                # Mark the entry as recently used
+                os.utime(entry_dir)
+            else:
+                metadata = create()
+                # Incomplete results are not cached
+                if all(os.path.exists(out_file) for out_file in out_files.values()):
+                    tmp_dir = "%s.tmp-%s" % (entry_dir, uuid4().hex)
+                    os.makedirs(tmp_dir)
+                    for name, out_file in out_files.items():
+                        shutil.copyfile(out_file, os.path.join(tmp_dir, name))
+                    with open(os.path.join(tmp_dir, METADATA_FILE), "w") as fobj:
+                        json.dump(metadata, fobj)
+                    os.rename(tmp_dir, entry_dir)
+
+        self.evict()
+        return metadata
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits its size limit."""
+        with FileLock(os.path.join(self.cache_dir, ".evict.lock")):
+            entries = []
+            for key in os.listdir(self.cache_dir):
+                entry_dir = self._entry_dir(key)
+                if not os.path.isdir(entry_dir) or ".tmp-" in key:
+                    continue
+                size = sum(
+                    os.path.getsize(os.path.join(entry_dir, name))
+                    for name in os.listdir(entry_dir)
+                )
+                entries.append((os.path.getmtime(entry_dir), size, key))
+
+            total_size = sum(size for _, size, _ in entries)
+            for _, size, key in sorted(entries):
+                if total_size <= self.max_size:
+                    break
+                # Entries that are being read or written are skipped
+                lock = self._lock(key)
+                try:
+                    lock.acquire(timeout=0)
+                except Timeout:
+                    continue
+                try:
+                    shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+                    total_size -= size
+                finally:
+                    lock.release()
@@ -7,7 +7,10 @@ Utilities to handle data from other preprocessing pipelines
 ^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^
 
 """
+import os
 import re
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 UKB_DIR_PATTERN = re.compile("(\d+)_(\d+)_(\d+)")
@@ -42,15 +45,24 @@ def missing_from_ukb_directory(ukb_subject_dir):
     return [str(fpath) for fpath in required_files if not fpath.exists()]
 
 
-def create_ukb_layout(ukb_dir, participant_label=None):
+def create_ukb_layout(ukb_dir, participant_label=None, index_file=None, n_threads=8):
     """Find all valid ukb directories under ukb_dir.
 
+    The directories are recorded in a :class:`UKBIndex`, which is refreshed once per
+    process. Later calls, such as the per-subject lookups made while building the
+    workflow, only query the index.
+
     Parameters
     ----------
     ukb_dir : :obj:`pathlib.Path`
         The path to the ukb directory.
-    participant_label : :obj:`list` of :obj:`str`
-        A list of participant labels to search for.
+    participant_label : :obj:`str` or :obj:`list` of :obj:`str`
+        Participant label(s) to search for.
+    index_file : :obj:`pathlib.Path`, optional
+        SQLite file where the index is persisted between runs.
+        If not provided, the index is only kept in memory.
+    n_threads : :obj:`int`
+        Number of threads used to check the ukb directories.
 
     Returns
     -------
@@ -58,34 +70,168 @@ def create_ukb_layout(ukb_dir, participant_label=None):
         A list of dictionaries containing the subject ID, session ID, path to the ukb directory,
         and the path to the fake dwi file.
     """
-    # find directories starting with a number. These are the candidate directories
-    ukb_layout = []
-    for potential_dir in Path(ukb_dir).iterdir():
-        if participant_label and not potential_dir.name.startswith(participant_label):
-            continue
-
-        match = re.match(UKB_DIR_PATTERN, potential_dir.name)
-        if not match:
-            continue
-
-        if missing_from_ukb_directory(potential_dir):
-            continue
-
-        subject, ses_major, ses_minor = match.groups()
-        renamed_ses = "%02d%02d" % (int(ses_major), int(ses_minor))
-        fake_dwi_file = (
-            f"/bids/sub-{subject}/ses-{renamed_ses}/dwi/sub-{subject}_ses-{renamed_ses}_dwi.nii.gz"
-        )
-        ukb_layout.append(
-            {
-                "subject": subject,
-                "session": renamed_ses,
-                "path": potential_dir,
-                "bids_dwi_file": fake_dwi_file,
+    key = (str(Path(ukb_dir).absolute()), str(index_file or ":memory:"))
+    if key not in _UKB_INDEXES:
+        ukb_index = UKBIndex(ukb_dir, index_file=index_file)
+        ukb_index.refresh(n_threads=n_threads)
+        _UKB_INDEXES[key] = ukb_index
+
+    return _UKB_INDEXES[key].query(participant_label)
+
+
+_UKB_INDEXES = {}
+
+
+class UKBIndex:
+    """A SQLite index of the complete ukb directories under a root directory.
+
+    The root directory is only listed when its mtime has changed. Complete
+    directories are not checked again, and the files of incomplete ones are only
+    checked when the mtime of their dMRI directory has changed.
+
+    Parameters
+    ----------
+    ukb_dir : :obj:`pathlib.Path`
+        The path to the ukb directory.
+    index_file : :obj:`pathlib.Path`, optional
+        SQLite file where the index is persisted. If not provided, the index is only
+        kept in memory.
+    """
+
+    def __init__(self, ukb_dir, index_file=None):
+        self.ukb_dir = Path(ukb_dir).absolute()
+        if index_file is not None:
+            Path(index_file).parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(str(index_file or ":memory:"), timeout=60)
+        with self.connection:
+            self.connection.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS ukb_dirs (
+                    root TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    subject TEXT NOT NULL,
+                    session TEXT NOT NULL,
+                    dmri_mtime REAL,
+                    complete INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (root, name)
+                );
+                CREATE INDEX IF NOT EXISTS ukb_subjects ON ukb_dirs (root, subject);
+                CREATE TABLE IF NOT EXISTS ukb_roots (
+                    root TEXT PRIMARY KEY,
+                    mtime REAL NOT NULL
+                );
+                """
+            )
+
+    def refresh(self, n_threads=8):
+        """Bring the index up to date with the contents of the ukb directory."""
+        root = str(self.ukb_dir)
+        root_mtime = os.stat(root).st_mtime
+        stored = self.connection.execute(
+            "SELECT mtime FROM ukb_roots WHERE root = ?", (root,)
+        ).fetchone()
+        known = {
+            name: (dmri_mtime, complete)
+            for name, dmri_mtime, complete in self.connection.execute(
+                "SELECT name, dmri_mtime, complete FROM ukb_dirs WHERE root = ?", (root,)
+            )
+        }
+
+        # Only list the root directory if entries were added or removed
+        root_changed = stored is None or stored[0] != root_mtime
+        names = set(known)
+        if root_changed:
+            names = {
+                entry.name for entry in os.scandir(root) if re.match(UKB_DIR_PATTERN, entry.name)
             }
-        )
 
-    return ukb_layout
+        # Check the new and incomplete directories before writing, so that the
+        # database is not locked while the file system is read
+        to_check = [
+            (name, known[name][0] if name in known else None)
+            for name in sorted(names)
+            if name not in known or not known[name][1]
+        ]
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            updates = [
+                update
+                for update in executor.map(lambda row: self._check_dir(*row), to_check)
+                if update is not None
+            ]
+
+        with self.connection:
+            if root_changed:
+                self.connection.executemany(
+                    "DELETE FROM ukb_dirs WHERE root = ? AND name = ?",
+                    [(root, name) for name in set(known) - names],
+                )
+                new_rows = []
+                for name in sorted(names - set(known)):
+                    subject, ses_major, ses_minor = re.match(UKB_DIR_PATTERN, name).groups()
+                    renamed_ses = "%02d%02d" % (int(ses_major), int(ses_minor))
+                    new_rows.append((root, name, subject, renamed_ses))
+                self.connection.executemany(
+                    "INSERT OR IGNORE INTO ukb_dirs (root, name, subject, session) "
+                    "VALUES (?, ?, ?, ?)",
+                    new_rows,
+                )
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO ukb_roots (root, mtime) VALUES (?, ?)",
+                    (root, root_mtime),
+                )
+            self.connection.executemany(
+                "UPDATE ukb_dirs SET dmri_mtime = ?, complete = ? WHERE root = ? AND name = ?",
+                [(mtime, complete, root, name) for name, mtime, complete in updates],
+            )
+
+    def _check_dir(self, name, stored_mtime):
+        potential_dir = self.ukb_dir / name
+        try:
+            dmri_mtime = os.stat(potential_dir / "DTI" / "dMRI" / "dMRI").st_mtime
+        except OSError:
+            dmri_mtime = None
+        if stored_mtime is not None and dmri_mtime == stored_mtime:
+            return None
+        if dmri_mtime is None:
+            return name, None, 0
+        return name, dmri_mtime, int(not missing_from_ukb_directory(potential_dir))
+
+    def query(self, participant_label=None):
+        """Get the layout entries of the complete ukb directories.
+
+        Parameters
+        ----------
+        participant_label : :obj:`str` or :obj:`list` of :obj:`str`, optional
+            Only return the directories of these subjects.
+
+        Returns
+        -------
+        ukb_layout : :obj:`list` of :obj:`dict`
+            See :func:`create_ukb_layout`.
+        """
+        sql = "SELECT name, subject, session FROM ukb_dirs WHERE root = ? AND complete = 1"
+        params = [str(self.ukb_dir)]
+        if participant_label:
+            if isinstance(participant_label, str):
+                participant_label = [participant_label]
+            sql += " AND subject IN (%s)" % ", ".join("?" * len(participant_label))
+            params.extend(participant_label)
+        sql += " ORDER BY name"
+
+        ukb_layout = []
+        for name, subject, session in self.connection.execute(sql, params):
+            fake_dwi_file = (
+                f"/bids/sub-{subject}/ses-{session}/dwi/sub-{subject}_ses-{session}_dwi.nii.gz"
+            )
+            ukb_layout.append(
+                {
+                    "subject": subject,
+                    "session": session,
+                    "path": self.ukb_dir / name,
+                    "bids_dwi_file": fake_dwi_file,
+                }
+            )
+        return ukb_layout
 
 
 def ukb_dirname_to_bids(ukb_dir):
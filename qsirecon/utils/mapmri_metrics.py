@@ -0,0 +1,355 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Vectorized MAPMRI metrics
+^^^^^^^^^^^^^^^^^^^^^^^^^
+
+The metrics of :class:`dipy.reconst.mapmri.MapmriFit` are evaluated voxel by
+voxel, and rebuild the same index-dependent vectors and matrices each time.
+:class:`MapmriMetrics` builds them once for a model and evaluates each metric
+for all voxels at once, from the coefficients, scale factors and rotations
+of the fit.
+
+"""
+from itertools import product
+
+import numpy as np
+from dipy.core.geometry import cart2sphere
+from dipy.reconst.mapmri import (
+    binomialfloat,
+    mapmri_isotropic_odf_matrix,
+    mapmri_STU_reg_matrices,
+)
+from dipy.reconst.shm import real_sh_descoteaux_from_index
+from scipy.special import factorial, factorial2, gamma
+
+# The anisotropic ODF of this many voxels is evaluated at a time
+ODF_CHUNK_SIZE = 1024
+
+
+class MapmriMetrics:
+    """Evaluate the scalar maps and ODFs of fitted MAPMRI models.
+
+    Parameters
+    ----------
+    model : :class:`dipy.reconst.mapmri.MapmriModel`
+        The model that was fit.
+    sphere : :class:`dipy.core.sphere.Sphere`, optional
+        The sphere ODFs are sampled on. Required for :meth:`odf`.
+    s : int
+        Radial moment of the ODF.
+
+    Notes
+    -----
+    Each metric takes the coefficients ``coef`` (n_voxels, n_coefs), scale
+    factors ``mu`` (n_voxels, 3) and rotations ``R`` (n_voxels, 3, 3) of the
+    fit, i.e. its ``mapmri_coeff``, ``mapmri_mu`` and ``mapmri_R``, and returns
+    the same values as the method of :class:`~dipy.reconst.mapmri.MapmriFit`
+    with the same name, for every voxel.
+    """
+
+    def __init__(self, model, sphere=None, s=2):
+        self.model = model
+        self.anisotropic_scaling = model.anisotropic_scaling
+        self.radial_order = model.radial_order
+        self.sphere = sphere
+        self.s = s
+
+        ind_mat = model.ind_mat
+        Bm = model.Bm
+        # Only the coefficients with a non-zero B can contribute to most metrics
+        self._sel = Bm > 0.0
+        ind_sel = ind_mat[self._sel]
+        if self.anisotropic_scaling:
+            self._init_anisotropic(ind_mat, ind_sel, Bm)
+        else:
+            self._init_isotropic(ind_mat, ind_sel, Bm)
+
+    def _init_anisotropic(self, ind_mat, ind_sel, Bm):
+        B_sel = Bm[self._sel]
+        nx, ny, nz = ind_sel.T
+        self._rtop_vec = (-1.0) ** (np.sum(ind_mat, axis=1) / 2) * Bm
+        self._rtap_vec = B_sel * (-1.0) ** (np.sum(ind_sel[:, 1:], axis=1) / 2.0)
+        self._rtpp_vec = B_sel * (-1.0) ** (ind_sel[:, 0] / 2.0)
+
+        # MSD is sum_d mu_d ** 2 * sum_k coef_k * a_k * (1 + 2 n_kd)
+        ind_sum = np.sum(ind_sel, axis=1)
+        msd_numerator = (-1) ** (0.5 * (-ind_sum)) * np.pi ** (3 / 2.0)
+        msd_denominator = (
+            np.sqrt(2.0 ** (-ind_sum) * factorial(nx) * factorial(ny) * factorial(nz))
+            * gamma(0.5 - 0.5 * nx)
+            * gamma(0.5 - 0.5 * ny)
+            * gamma(0.5 - 0.5 * nz)
+        )
+        self._msd_mat = (msd_numerator / msd_denominator)[:, None] * (1 + 2 * ind_sel)
+
+        # QIV has a voxel-specific denominator for each coefficient
+        self._qiv_numerator = (
+            8
+            * np.pi**2
+            * np.sqrt(factorial(nx) * factorial(ny) * factorial(nz))
+            * gamma(0.5 - 0.5 * nx)
+            * gamma(0.5 - 0.5 * ny)
+            * gamma(0.5 - 0.5 * nz)
+        )
+        self._qiv_denominator = np.sqrt(2.0 ** (-1 + nx + ny + nz))
+        self._qiv_orders = 1 + 2 * ind_sel
+
+        # Weights of the parallel and perpendicular non-Gaussianities
+        n1, n2, n3 = ind_mat.T
+        self._ng_par_weights = np.zeros(ind_mat.shape[0])
+        self._ng_perp_weights = np.zeros(ind_mat.shape[0])
+        for i_coef, (c1, c2, c3) in enumerate(ind_mat):
+            if (c2 % 2 + c3 % 2) == 0:
+                self._ng_par_weights[i_coef] = (
+                    (-1) ** ((c2 + c3) / 2)
+                    * np.sqrt(factorial(c2) * factorial(c3))
+                    / (factorial2(c2) * factorial2(c3))
+                )
+            if c1 % 2 == 0 and c2 % 2 == 0 and c3 % 2 == 0:
+                self._ng_perp_weights[i_coef] = (
+                    (-1) ** (c1 / 2) * np.sqrt(factorial(c1)) / (factorial2(c1))
+                )
+        self._ng_par0 = n1 == 0
+        self._ng_perp00 = (n2 == 0) & (n3 == 0)
+
+        # The Laplacian matrix is a sum of six fixed matrices scaled by mu
+        S_mat, T_mat, U_mat = mapmri_STU_reg_matrices(self.radial_order)
+        x, y, z = (axis_orders[:, None] for axis_orders in ind_mat.T)
+        xt, yt, zt = (axis_orders[None, :] for axis_orders in ind_mat.T)
+        same_parity = ((x - xt) % 2 == 0) & ((y - yt) % 2 == 0) & ((z - zt) % 2 == 0)
+        Sx, Sy, Sz = S_mat[x, xt], S_mat[y, yt], S_mat[z, zt]
+        Tx, Ty, Tz = T_mat[x, xt], T_mat[y, yt], T_mat[z, zt]
+        Ux, Uy, Uz = U_mat[x, xt], U_mat[y, yt], U_mat[z, zt]
+        self._laplacian_mats = [
+            same_parity * mat
+            for mat in (
+                Sx * Uy * Uz,
+                Sy * Uz * Ux,
+                Sz * Ux * Uy,
+                2 * Tx * Ty * Uz,
+                2 * Tx * Tz * Uy,
+                2 * Tz * Ty * Ux,
+            )
+        ]
+
+        # The ODF is a polynomial in the scaled and rotated vertices
+        self._odf_powers, self._odf_weights = _anisotropic_odf_polynomial(ind_mat, self.s)
+
+    def _init_isotropic(self, ind_mat, ind_sel, Bm):
+        j_sel = ind_sel[:, 0]
+        B_sel = Bm[self._sel]
+        self._rtop_vec = (
+            1 / (2 * np.sqrt(2.0) * np.pi ** (3 / 2.0)) * (-1.0) ** (ind_mat[:, 0] - 1) * Bm
+        )
+        self._msd_vec = (4 * j_sel - 1) * B_sel
+        self._qiv_vec = (8 * (-1.0) ** (1 - j_sel) * np.sqrt(2) * np.pi ** (7 / 2.0)) / (
+            (4.0 * j_sel - 1) * B_sel
+        )
+        self._laplacian_matrix = self.model.laplacian_matrix
+
+        # RTAP and RTPP weight the spherical harmonics along the main direction
+        rtap_vec = np.zeros(ind_mat.shape[0])
+        rtpp_vec = np.zeros(ind_mat.shape[0])
+        count = 0
+        for n in range(0, self.radial_order + 1, 2):
+            for j in range(1, 2 + n // 2):
+                ell = n + 2 - 2 * j
+                kappa = ((-1) ** (j - 1) * 2 ** (-(ell + 3) / 2.0)) / np.pi
+                rtpp_const = (-1 / 2.0) ** (ell / 2) / np.sqrt(np.pi)
+                rtap_sum = 0
+                rtpp_sum = 0
+                for k in range(0, j):
+                    common = (-1) ** k * binomialfloat(j + ell - 0.5, j - k - 1)
+                    rtap_sum += (common * gamma((ell + 1) / 2.0 + k)) / (
+                        factorial(k) * 0.5 ** ((ell + 1) / 2.0 + k)
+                    )
+                    rtpp_sum += (common * gamma(ell / 2 + k + 1 / 2.0)) / (
+                        factorial(k) * 0.5 ** (ell / 2 + 1 / 2.0 + k)
+                    )
+                for _ in range(-ell, ell + 1):
+                    rtap_vec[count] = 2 * kappa * rtap_sum
+                    rtpp_vec[count] = rtpp_const * rtpp_sum
+                    count += 1
+        self._rtap_vec = rtap_vec
+        self._rtpp_vec = rtpp_vec
+
+        if self.sphere is not None:
+            self._odf_matrix = mapmri_isotropic_odf_matrix(
+                self.radial_order, 1, self.s, self.sphere.vertices
+            )
+
+    def _main_direction_sh(self, R):
+        """Sample the basis' spherical harmonics along the first axis of each rotation."""
+        _, theta, phi = cart2sphere(R[:, 0, 0], R[:, 1, 0], R[:, 2, 0])
+        ind_mat = self.model.ind_mat
+        return real_sh_descoteaux_from_index(
+            ind_mat[:, 2], ind_mat[:, 1], theta[:, None], phi[:, None]
+        )
+
+    def rtop(self, coef, mu, R):
+        """Return to the origin probability."""
+        if self.anisotropic_scaling:
+            return (coef @ self._rtop_vec) / (np.sqrt(8 * np.pi**3) * np.prod(mu, axis=1))
+        return (coef @ self._rtop_vec) / mu[:, 0] ** 3
+
+    def rtap(self, coef, mu, R):
+        """Return to the axis probability."""
+        if self.anisotropic_scaling:
+            return (coef[:, self._sel] @ self._rtap_vec) / (2 * np.pi * mu[:, 1] * mu[:, 2])
+        weighted = coef * self._main_direction_sh(R)
+        return (weighted @ self._rtap_vec) / mu[:, 0] ** 2
+
+    def rtpp(self, coef, mu, R):
+        """Return to the plane probability."""
+        if self.anisotropic_scaling:
+            return (coef[:, self._sel] @ self._rtpp_vec) / (np.sqrt(2 * np.pi) * mu[:, 0])
+        weighted = coef * self._main_direction_sh(R)
+        return (weighted @ self._rtpp_vec) / mu[:, 0]
+
+    def msd(self, coef, mu, R):
+        """Mean squared displacement."""
+        if self.anisotropic_scaling:
+            return np.sum(mu**2 * (coef[:, self._sel] @ self._msd_mat), axis=1)
+        return mu[:, 0] ** 2 * (coef[:, self._sel] @ self._msd_vec)
+
+    def qiv(self, coef, mu, R):
+        """Q-space inverse variance."""
+        if self.anisotropic_scaling:
+            ux2, uy2, uz2 = (mu**2).T[:, :, None]
+            nx, ny, nz = self._qiv_orders.T
+            denominator = self._qiv_denominator * (nx * uy2 * uz2 + ux2 * (nz * uy2 + ny * uz2))
+            qiv_vecs = coef[:, self._sel] * (self._qiv_numerator / denominator)
+            return np.prod(mu, axis=1) ** 3 * qiv_vecs.sum(axis=1)
+        return mu[:, 0] ** 5 * (coef[:, self._sel] @ self._qiv_vec)
+
+    def _check_anisotropic(self):
+        if not self.anisotropic_scaling:
+            raise ValueError("Non-Gaussianity is not defined using isotropic scaling.")
+
+    def ng(self, coef, mu, R):
+        """Non-Gaussianity."""
+        self._check_anisotropic()
+        return np.sqrt(1 - coef[:, 0] ** 2 / np.sum(coef**2, axis=1))
+
+    def ng_parallel(self, coef, mu, R):
+        """Parallel non-Gaussianity."""
+        self._check_anisotropic()
+        a_par = coef * self._ng_par_weights
+        a0 = a_par[:, self._ng_par0]
+        return np.sqrt(1 - np.sum(a0**2, axis=1) / np.sum(a_par**2, axis=1))
+
+    def ng_perpendicular(self, coef, mu, R):
+        """Perpendicular non-Gaussianity."""
+        self._check_anisotropic()
+        a_perp = coef * self._ng_perp_weights
+        a00 = a_perp[:, self._ng_perp00]
+        return np.sqrt(1 - np.sum(a00**2, axis=1) / np.sum(a_perp**2, axis=1))
+
+    def norm_of_laplacian_signal(self, coef, mu, R):
+        """Norm of the Laplacian of the fitted signal."""
+        if not self.anisotropic_scaling:
+            return mu[:, 0] * np.sum((coef @ self._laplacian_matrix) * coef, axis=1)
+
+        ux, uy, uz = mu.T
+        scales = (
+            ux**3 / (uy * uz),
+            uy**3 / (ux * uz),
+            uz**3 / (ux * uy),
+            (ux * uy) / uz,
+            (ux * uz) / uy,
+            (uz * uy) / ux,
+        )
+        norm = np.zeros(coef.shape[0])
+        for scale, laplacian_mat in zip(scales, self._laplacian_mats):
+            norm += scale * np.sum((coef @ laplacian_mat) * coef, axis=1)
+        return norm
+
+    def odf(self, coef, mu, R):
+        """The ODF sampled on the vertices of ``sphere``."""
+        if self.sphere is None:
+            raise ValueError("A sphere is needed to compute ODFs.")
+        if not self.anisotropic_scaling:
+            return mu[:, :1] ** self.s * (coef @ self._odf_matrix.T)
+
+        odf = np.zeros((coef.shape[0], self.sphere.vertices.shape[0]))
+        for start in range(0, coef.shape[0], ODF_CHUNK_SIZE):
+            chunk = slice(start, start + ODF_CHUNK_SIZE)
+            odf[chunk] = self._anisotropic_odf(coef[chunk], mu[chunk], R[chunk])
+        return odf
+
+    def _anisotropic_odf(self, coef, mu, R):
+        # Rotate the vertices into the frame of each voxel and scale them
+        scaled = np.einsum("vd,nde->nve", self.sphere.vertices, R) / mu[:, None, :]
+        rho = 1.0 / np.sqrt(np.sum(scaled**2, axis=2))
+        const = (
+            rho ** (3 + self.s)
+            / np.sqrt(2 ** (2 - self.s) * np.pi**3 * np.prod(mu**2, axis=1))[:, None]
+        )
+        max_power = self.radial_order + 1
+        axis_powers = [
+            (2 * rho * scaled[..., axis])[..., None] ** np.arange(max_power) for axis in range(3)
+        ]
+        # Sum over the monomials, each weighted by a combination of coefficients
+        monomial_weights = coef @ self._odf_weights
+        odf = np.zeros(rho.shape)
+        for i_monomial, (p1, p2, p3) in enumerate(self._odf_powers):
+            odf += monomial_weights[:, i_monomial, None] * (
+                axis_powers[0][..., p1] * axis_powers[1][..., p2] * axis_powers[2][..., p3]
+            )
+        return const * odf
+
+    def compute(self, metrics, coef, mu, R):
+        """Evaluate several metrics.
+
+        Parameters
+        ----------
+        metrics : :obj:`list` of :obj:`str`
+            Names of the metric methods, e.g. ``["rtop", "odf"]``.
+        coef, mu, R : :obj:`numpy.ndarray`
+            The coefficients, scale factors and rotations of the fit.
+
+        Returns
+        -------
+        results : :obj:`dict`
+            Maps each metric to its value in each voxel.
+        """
+        return {metric: getattr(self, metric)(coef, mu, R) for metric in metrics}
+
+
+def _anisotropic_odf_polynomial(ind_mat, s):
+    """Write the anisotropic MAPMRI ODF basis as polynomials of the scaled vertices.
+
+    Column ``j`` of the ODF matrix is ``const * sum_p weights[j, p] * a ** p1 *
+    b ** p2 * c ** p3``, where (a, b, c) are the alpha, beta and gamma of
+    Ozarslan et al. (2013) Eq. (35) and ``powers[p] = (p1, p2, p3)``.
+    """
+    terms = {}
+    for i_coef, (n1, n2, n3) in enumerate(ind_mat):
+        basis_norm = np.sqrt(factorial(n1) * factorial(n2) * factorial(n3))
+        for i, j, k in product(range(0, n1 + 1, 2), range(0, n2 + 1, 2), range(0, n3 + 1, 2)):
+            powers = (n1 - i, n2 - j, n3 - k)
+            weight = (
+                basis_norm
+                * (-1) ** ((i + j + k) / 2.0)
+                * gamma((3 + s + sum(powers)) / 2.0)
+                / (
+                    factorial(powers[0])
+                    * factorial(powers[1])
+                    * factorial(powers[2])
+                    * factorial2(i)
+                    * factorial2(j)
+                    * factorial2(k)
+                )
+            )
+            terms.setdefault(powers, {})
+            terms[powers][i_coef] = terms[powers].get(i_coef, 0.0) + weight
+
+    powers = sorted(terms)
+    weights = np.zeros((ind_mat.shape[0], len(powers)))
+    for i_monomial, monomial in enumerate(powers):
+        for i_coef, weight in terms[monomial].items():
+            weights[i_coef, i_monomial] = weight
+    return powers, weights
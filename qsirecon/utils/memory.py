@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Estimating the memory used by workflow nodes
+^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^
+
+The MultiProc plugin only keeps nodes from running out of memory together if
+each node declares how much memory it needs. The estimates here are linear
+models of a few size features of the input DWI series and of the node's
+parameters. Their coefficients can be refitted to the peak memory recorded
+by ``--resource-monitor`` in previous runs.
+
+"""
+import json
+import os
+from collections import defaultdict
+
+import nibabel as nb
+import numpy as np
+from filelock import FileLock
+from nipype.interfaces.base import isdefined
+
+GB = 1024**3
+FLOAT_BYTES = 8
+# A streamline of ~100 points with float32 coordinates
+STREAMLINE_BYTES = 1200
+# Nodes never get a smaller estimate than nipype's default
+MIN_MEM_GB = 0.2
+
+MEMORY_FEATURES_FILE = "memory_features.json"
+MEMORY_MODEL_FILE = "memory_model.json"
+
+# Coefficients in GB per unit of each feature, see node_features().
+# These are rough defaults, set from the arrays each interface keeps in memory
+# rather than fitted to measurements. calibrate_memory_models() replaces them
+# with fits to the peaks recorded by the resource monitor, which are saved in
+# the work directory as MEMORY_MODEL_FILE and take precedence in later runs.
+MEMORY_MODELS = {
+    "AtlasMapper": {"constant": 1.0},
+    "AutoTrack": {"constant": 1.0, "dwi_gb": 1.0, "masked_model_gb": 1.0},
+    "BrainSuiteShoreReconstruction": {
+        "constant": 0.5,
+        "masked_dwi_gb": 4.0,
+        "masked_model_gb": 4.0,
+    },
+    "BundleMapper": {"constant": 1.0},
+    "CLIReconPeaksReport": {"constant": 1.0, "masked_model_gb": 1.0},
+    "ConformDwi": {"constant": 0.2, "dwi_gb": 2.0},
+    "DSIStudioAtlasGraph": {"constant": 0.5, "masked_model_gb": 1.0, "streamlines_gb": 1.0},
+    "DSIStudioCreateSrc": {"constant": 0.3, "dwi_gb": 0.5},
+    "DSIStudioGQIReconstruction": {"constant": 0.5, "dwi_gb": 0.5, "masked_model_gb": 1.0},
+    "DSIStudioTracking": {"constant": 0.5, "masked_model_gb": 1.0, "streamlines_gb": 1.0},
+    "EstimateFOD": {"constant": 0.5, "dwi_gb": 1.0, "masked_model_gb": 2.0},
+    "GlobalTractography": {"constant": 1.0, "dwi_gb": 1.0, "masked_model_gb": 2.0},
+    "KurtosisReconstruction": {"constant": 0.5, "dwi_gb": 1.0, "masked_dwi_gb": 3.0},
+    "MAPMRIReconstruction": {"constant": 0.5, "masked_dwi_gb": 4.0, "masked_model_gb": 6.0},
+    "MRTrixAtlasGraph": {"constant": 0.3, "streamlines_gb": 1.0},
+    "MTNormalize": {"constant": 0.3, "masked_model_gb": 2.0},
+    "NODDI": {"constant": 2.0, "masked_dwi_gb": 3.0},
+    "PyAFQRecon": {"constant": 2.0, "dwi_gb": 4.0, "streamlines_gb": 2.0},
+    "TckGen": {"constant": 0.5, "masked_model_gb": 1.0},
+    "TemplateMapper": {"constant": 1.0},
+    "TensorReconstruction": {"constant": 0.3, "dwi_gb": 1.0, "masked_dwi_gb": 2.0},
+}
+
+
+def image_profile(dwi_file, mask_file=None):
+    """Summarize the size of a DWI series from its header and brain mask.
+
+    Parameters
+    ----------
+    dwi_file : :obj:`str`
+        The (4D) DWI series.
+    mask_file : :obj:`str`, optional
+        The brain mask of the series. Without it, the whole field of view is
+        assumed to be brain.
+
+    Returns
+    -------
+    profile : :obj:`dict`
+        The number of voxels and volumes, and the fraction of voxels in the mask.
+    """
+    img = nb.load(dwi_file)
+    n_voxels = int(np.prod(img.shape[:3]))
+    n_volumes = int(np.prod(img.shape[3:]))
+    mask_fraction = 1.0
+    if mask_file is not None and os.path.exists(mask_file):
+        mask = np.asanyarray(nb.load(mask_file).dataobj)
+        mask_fraction = np.count_nonzero(mask) / mask.size
+    return {"n_voxels": n_voxels, "n_volumes": n_volumes, "mask_fraction": mask_fraction}
+
+
+def _defined_input(inputs, name):
+    value = getattr(inputs, name, None)
+    if value is None or not isdefined(value):
+        return None
+    return value
+
+
+def n_model_parameters(inputs):
+    """Count the parameters a reconstruction estimates in each voxel."""
+    radial_order = _defined_input(inputs, "radial_order")
+    if radial_order is not None:
+        # MAPMRI and SHORE bases have the same number of coefficients
+        half_order = radial_order // 2
+        return (half_order + 1) * (half_order + 2) * (4 * half_order + 3) // 6
+
+    max_sh = _defined_input(inputs, "max_sh")
+    if max_sh is not None:
+        # One set of SH coefficients per tissue
+        return sum((lmax + 1) * (lmax + 2) // 2 for lmax in np.atleast_1d(max_sh))
+
+    odf_order = _defined_input(inputs, "odf_order")
+    if odf_order is not None:
+        # Directions of a tessellated hemisphere, plus the fibers' QA and indices
+        num_fibers = _defined_input(inputs, "num_fibers") or 3
+        return 5 * odf_order**2 + 1 + 2 * num_fibers
+
+    return 0
+
+
+def n_streamlines(inputs):
+    """Count the streamlines a tractography node generates."""
+    for name in ("select", "fiber_count", "n_tracks"):
+        value = _defined_input(inputs, name)
+        if value:
+            return value
+    return 0
+
+
+def node_features(interface, profile):
+    """Compute the size features of a node from its interface and the DWI profile.
+
+    All features are sizes in GB, so that coefficients stay comparable.
+    """
+    n_masked = profile["n_voxels"] * profile["mask_fraction"]
+    inputs = interface.inputs
+    return {
+        "constant": 1.0,
+        "dwi_gb": profile["n_voxels"] * profile["n_volumes"] * FLOAT_BYTES / GB,
+        "masked_dwi_gb": n_masked * profile["n_volumes"] * FLOAT_BYTES / GB,
+        "masked_model_gb": n_masked * n_model_parameters(inputs) * FLOAT_BYTES / GB,
+        "streamlines_gb": n_streamlines(inputs) * STREAMLINE_BYTES / GB,
+    }
+
+
+def estimate_mem_gb(model, features):
+    """Evaluate a memory model on a node's features."""
+    return max(MIN_MEM_GB, sum(coef * features.get(name, 0.0) for name, coef in model.items()))
+
+
+def load_memory_models(model_file=None):
+    """Get the memory models, with calibrated coefficients taking precedence."""
+    models = dict(MEMORY_MODELS)
+    if model_file is not None and os.path.exists(model_file):
+        with open(model_file) as fobj:
+            models.update(json.load(fobj))
+    return models
+
+
+def estimate_node_mem_gb(interface, profile, models=None, max_mem_gb=None):
+    """Estimate the memory a node needs to run an interface on a DWI series.
+
+    Parameters
+    ----------
+    interface : :obj:`~nipype.interfaces.base.BaseInterface`
+        The interface of the node, with its parameters set.
+    profile : :obj:`dict` or None
+        The output of :func:`image_profile` for the DWI series.
+    models : :obj:`dict`, optional
+        Maps interface class names to their coefficients. Defaults to
+        :data:`MEMORY_MODELS`.
+    max_mem_gb : :obj:`float`, optional
+        Estimates are capped at this value, so no node asks for more memory than
+        the scheduler can give.
+
+    Returns
+    -------
+    mem_gb : :obj:`float`
+        The estimate, or nipype's default if there is no profile or no model
+        for the interface.
+    """
+    models = MEMORY_MODELS if models is None else models
+    model = models.get(interface.__class__.__name__)
+    if profile is None or model is None:
+        return MIN_MEM_GB
+
+    mem_gb = estimate_mem_gb(model, node_features(interface, profile))
+    if max_mem_gb:
+        mem_gb = min(mem_gb, max_mem_gb)
+    return mem_gb
+
+
+def node_mem_gb(interface, profile):
+    """Get the ``mem_gb`` of a reconstruction node from the run's configuration.
+
+    The calibrated models in the work directory are used, and the estimate is
+    capped at the memory given to the scheduler.
+    """
+    from .. import config
+
+    if profile is None:
+        return MIN_MEM_GB
+    models = load_memory_models(config.execution.work_dir / MEMORY_MODEL_FILE)
+    return estimate_node_mem_gb(interface, profile, models, config.nipype.memory_gb)
+
+
+def record_node_features(workflow, profile, models=None):
+    """Get the features of every node of a workflow that has a memory model.
+
+    Parameters
+    ----------
+    workflow : :obj:`~nipype.pipeline.engine.Workflow`
+        A workflow whose nodes were given ``mem_gb`` by :func:`node_mem_gb`.
+    profile : :obj:`dict`
+        The output of :func:`image_profile` for the workflow's DWI series.
+    models : :obj:`dict`, optional
+        Maps interface class names to their coefficients. Defaults to
+        :data:`MEMORY_MODELS`.
+
+    Returns
+    -------
+    node_features : :obj:`dict`
+        Maps the full name of each node to its interface and features,
+        which :func:`calibrate_memory_models` needs.
+    """
+    models = MEMORY_MODELS if models is None else models
+    recorded = {}
+    for node_name in workflow.list_node_names():
+        interface = workflow.get_node(node_name).interface
+        interface_name = interface.__class__.__name__
+        if interface_name not in models:
+            continue
+        recorded[f"{workflow.name}.{node_name}"] = {
+            "interface": interface_name,
+            "features": node_features(interface, profile),
+        }
+    return recorded
+
+
+def write_node_features(recorded, features_file):
+    """Add the features of the nodes of a run to a features file."""
+    with FileLock(f"{features_file}.lock"):
+        all_features = {}
+        if os.path.exists(features_file):
+            with open(features_file) as fobj:
+                all_features = json.load(fobj)
+        all_features.update(recorded)
+        with open(features_file, "w") as fobj:
+            json.dump(all_features, fobj, indent=1, sort_keys=True)
+
+
+def read_peak_memory(resource_monitor_file):
+    """Get the peak resident memory (GB) of each node from nipype's resource monitor."""
+    with open(resource_monitor_file) as fobj:
+        monitor = json.load(fobj)
+
+    peaks = {}
+    for name, rss_gb in zip(monitor["name"], monitor["rss_GiB"]):
+        if rss_gb is not None:
+            peaks[name] = max(peaks.get(name, 0.0), rss_gb)
+    return peaks
+
+
+def calibrate_memory_models(resource_monitor_file, features_file, models=None):
+    """Refit the coefficients of the memory models to peaks from previous runs.
+
+    Nodes are matched by the end of their full names. For each interface,
+    the coefficients are fit with non-negative least squares when there are
+    enough observations, or else taken from the current model. They are then
+    scaled so that no observed peak is underestimated.
+
+    Parameters
+    ----------
+    resource_monitor_file : :obj:`str`
+        A ``resource_monitor.json`` file written by nipype.
+    features_file : :obj:`str`
+        The features recorded by :func:`write_node_features`.
+    models : :obj:`dict`, optional
+        The current models. Defaults to :data:`MEMORY_MODELS`.
+
+    Returns
+    -------
+    calibrated : :obj:`dict`
+        The new coefficients of each interface with observations.
+    """
+    from scipy.optimize import nnls
+
+    models = MEMORY_MODELS if models is None else models
+    peaks = read_peak_memory(resource_monitor_file)
+    with open(features_file) as fobj:
+        recorded = json.load(fobj)
+
+    observations = defaultdict(list)
+    for monitored_name, peak_gb in peaks.items():
+        for node_name, record in recorded.items():
+            if monitored_name == node_name or monitored_name.endswith("." + node_name):
+                observations[record["interface"]].append((record["features"], peak_gb))
+                break
+
+    calibrated = {}
+    for interface_name, interface_observations in observations.items():
+        model = models.get(interface_name)
+        if model is None:
+            continue
+        feature_names = sorted(model)
+        design = np.array(
+            [
+                [features.get(name, 0.0) for name in feature_names]
+                for features, _ in interface_observations
+            ]
+        )
+        peak_gbs = np.array([peak_gb for _, peak_gb in interface_observations])
+
+        current = np.array([model[name] for name in feature_names])
+        coefs = current
+        if len(peak_gbs) > len(feature_names):
+            coefs, _ = nnls(design, peak_gbs)
+            if not coefs.any():
+                coefs = current
+        # Scale the fit so that no observed peak is underestimated
+        predicted = np.maximum(design @ coefs, MIN_MEM_GB)
+        coefs = coefs * np.max(peak_gbs / predicted)
+        calibrated[interface_name] = dict(zip(feature_names, coefs.tolist()))
+    return calibrated
@@ -0,0 +1,415 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Reading and writing MRtrix images
+^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^
+
+A ``.mif`` file is a text header of ``key: value`` lines followed by the
+voxel data. The header gives the dimensions, voxel sizes, data type, the
+order and direction in which the axes are stored (``layout``) and the
+transform from (unit-sized) voxels to scanner coordinates.
+
+MRtrix realigns the axes of any image it loads so that they are close to
+RAS+, so the axes described by the header are not always the axes the data
+came from. Images are returned here with their spatial axes in the order
+and direction they are stored, which is how MRtrix would write them to a
+NIfTI file, so they share the voxel grid of the NIfTI images they were
+made from.
+
+Uncompressed images are memory-mapped. ``.mif.gz`` images are decompressed
+straight into their array when read, and compressed slab by slab when written.
+:class:`MifImage` wraps them as nibabel images, so they can be used (and saved
+as NIfTI) wherever a ``Nifti1Image`` is expected.
+
+"""
+import gzip
+import os.path as op
+
+import nibabel as nb
+import numpy as np
+from nibabel.filebasedimages import ImageFileError
+from nibabel.spatialimages import SpatialHeader, SpatialImage
+
+MIF_MAGIC = "mrtrix image"
+MIF_ALIGNMENT = 16  # The data offsets of written files are multiples of this
+MIF_BLOCK_BYTES = 64 * 1024**2  # Approximate size of the slabs that are read or written at a time
+# Keys that are written once per row of a matrix
+MIF_MATRIX_KEYS = ("transform", "dw_scheme", "prior_dw_scheme", "command_history", "comments")
+# Keys that describe the data rather than the image
+MIF_DATA_KEYS = ("dim", "vox", "layout", "datatype", "transform", "file", "scaling")
+MIF_DTYPES = {
+    "Int8": "i1",
+    "UInt8": "u1",
+    "Int16": "i2",
+    "UInt16": "u2",
+    "Int32": "i4",
+    "UInt32": "u4",
+    "Int64": "i8",
+    "UInt64": "u8",
+    "Float32": "f4",
+    "Float64": "f8",
+    "CFloat32": "c8",
+    "CFloat64": "c16",
+}
+
+
+def _parse_datatype(datatype):
+    """Get the numpy dtype of a MRtrix datatype, e.g. ``Float32LE``."""
+    byte_order = "="
+    if datatype.endswith("LE"):
+        datatype, byte_order = datatype[:-2], "<"
+    elif datatype.endswith("BE"):
+        datatype, byte_order = datatype[:-2], ">"
+    if datatype not in MIF_DTYPES:
+        raise NotImplementedError("Unsupported MRtrix datatype: %s" % datatype)
+    return np.dtype(MIF_DTYPES[datatype]).newbyteorder(byte_order)
+
+
+def _format_datatype(dtype):
+    """Get the MRtrix datatype of a numpy dtype."""
+    dtype = np.dtype(dtype)
+    names = {np.dtype(code).str[1:]: name for name, code in MIF_DTYPES.items()}
+    name = names[dtype.str[1:]]
+    if dtype.itemsize > 1:
+        name += "BE" if dtype.str[0] == ">" else "LE"
+    return name
+
+
+def read_mif_header(fileobj):
+    """Parse the header of a ``.mif`` file.
+
+    Parameters
+    ----------
+    fileobj : file-like
+        The file, opened in binary mode and positioned at its start.
+
+    Returns
+    -------
+    header : :obj:`dict`
+        Maps each key to its value (a list of lines for the keys in
+        ``MIF_MATRIX_KEYS``, such as ``transform``). ``dim``, ``vox``, ``layout``,
+        ``datatype``, ``transform``, ``file`` and ``scaling`` are parsed.
+    """
+    magic = fileobj.readline().decode("latin1").strip()
+    if magic != MIF_MAGIC:
+        raise ValueError("Not a MRtrix image: %s" % getattr(fileobj, "name", fileobj))
+
+    header = {}
+    while True:
+        line = fileobj.readline()
+        if not line:
+            raise ValueError("Incomplete MRtrix image header")
+        line = line.decode("latin1").strip()
+        if line == "END":
+            break
+        key, _, value = line.partition(":")
+        key, value = key.strip(), value.strip()
+        if key in MIF_MATRIX_KEYS:
+            header.setdefault(key, []).append(value)
+        elif key in header:
+            # MRtrix joins the values of other repeated keys with newlines
+            header[key] += "\n" + value
+        else:
+            header[key] = value
+
+    header["dim"] = tuple(int(dim) for dim in header["dim"].split(","))
+    header["vox"] = tuple(float(vox) for vox in header["vox"].split(","))
+    header["layout"] = [
+        (-1 if axis.strip().startswith("-") else 1, int(axis.strip().lstrip("+-")))
+        for axis in header["layout"].split(",")
+    ]
+    header["datatype"] = _parse_datatype(header["datatype"])
+    transform = np.eye(4)
+    if "transform" in header:
+        transform[:3] = [[float(val) for val in row.split(",")] for row in header["transform"]]
+    header["transform"] = transform
+    data_file, _, offset = header["file"].partition(" ")
+    header["file"] = (data_file, int(offset or 0))
+    if "scaling" in header:
+        header["scaling"] = tuple(float(val) for val in header["scaling"].split(","))
+    return header
+
+
+def _storage_view(raw, header):
+    """Arrange the stored data with its spatial axes in storage order.
+
+    Returns the array and the affine that maps its indices to scanner coordinates.
+    """
+    dim = header["dim"]
+    layout = header["layout"]
+    axes_by_rank = sorted(range(len(dim)), key=lambda axis: layout[axis][1])
+    stored = raw.reshape([dim[axis] for axis in axes_by_rank], order="F")
+
+    # The spatial axes come first, in the order they are stored, then the others
+    spatial = [rank for rank, axis in enumerate(axes_by_rank) if axis < 3]
+    others = sorted(
+        (rank for rank, axis in enumerate(axes_by_rank) if axis >= 3),
+        key=lambda rank: axes_by_rank[rank],
+    )
+    data = stored.transpose(spatial + others)
+
+    # Map the stored voxel indices to the indices of the header's axes
+    to_header = np.zeros((4, 4))
+    to_header[3, 3] = 1
+    for out_axis, rank in enumerate(spatial):
+        axis = axes_by_rank[rank]
+        sign = layout[axis][0]
+        to_header[axis, out_axis] = sign
+        if sign < 0:
+            to_header[axis, 3] = dim[axis] - 1
+
+    header_affine = header["transform"].copy()
+    header_affine[:3, :3] = header_affine[:3, :3] * np.array(header["vox"][:3])
+    return data, header_affine @ to_header
+
+
+def load_mif(filename, mmap=True):
+    """Load a ``.mif`` or ``.mif.gz`` image.
+
+    Parameters
+    ----------
+    filename : :obj:`str`
+        Path to the image.
+    mmap : :obj:`bool`
+        Memory-map the data of uncompressed, unscaled images instead of reading it.
+
+    Returns
+    -------
+    data : :obj:`numpy.ndarray`
+        The data, with its spatial axes in the order they are stored.
+    affine : :obj:`numpy.ndarray`
+        The 4x4 voxel to scanner (RAS+) transform of ``data``.
+    header : :obj:`dict`
+        The parsed header, see :func:`read_mif_header`.
+    """
+    compressed = filename.endswith(".gz")
+    file_open = gzip.open if compressed else open
+    with file_open(filename, "rb") as fileobj:
+        header = read_mif_header(fileobj)
+        data_file, offset = header["file"]
+        n_values = int(np.prod(header["dim"]))
+        dtype = header["datatype"]
+        if data_file != ".":
+            data_file = op.join(op.dirname(filename), data_file)
+            raw = np.memmap(data_file, dtype=dtype, mode="r", offset=offset, shape=(n_values,))
+        elif compressed:
+            fileobj.seek(offset)
+            raw = np.empty(n_values, dtype=dtype)
+            _read_into(fileobj, raw)
+        else:
+            raw = np.memmap(filename, dtype=dtype, mode="r", offset=offset, shape=(n_values,))
+
+    if not mmap and isinstance(raw, np.memmap):
+        raw = np.array(raw)
+    data, affine = _storage_view(raw, header)
+    if "scaling" in header:
+        intercept, slope = header["scaling"]
+        if (intercept, slope) != (0.0, 1.0):
+            data = data * np.float32(slope) + np.float32(intercept)
+    return data, affine, header
+
+
+def _read_into(fileobj, array):
+    """Fill a contiguous array with bytes read from ``fileobj``, one block at a time."""
+    view = memoryview(array).cast("B")
+    n_read = 0
+    while n_read < len(view):
+        chunk_read = fileobj.readinto(view[n_read : n_read + MIF_BLOCK_BYTES])
+        if not chunk_read:
+            raise EOFError("Unexpected end of MRtrix image data")
+        n_read += chunk_read
+
+
+def _mif_header_text(shape, affine, dtype, layout, zooms, extra):
+    transform = affine[:3, :3] / zooms[:3]
+    lines = [
+        MIF_MAGIC,
+        "dim: " + ",".join(str(dim) for dim in shape),
+        "vox: " + ",".join(repr(float(zoom)) for zoom in zooms),
+        "layout: " + ",".join(layout),
+        "datatype: " + _format_datatype(dtype),
+    ]
+    lines += [
+        "transform: " + ",".join(repr(float(val)) for val in np.append(row, affine[i_row, 3]))
+        for i_row, row in enumerate(transform)
+    ]
+    for key, value in (extra or {}).items():
+        if key in MIF_DATA_KEYS:
+            continue
+        values = [value] if isinstance(value, str) else value
+        lines += ["%s: %s" % (key, line) for value in values for line in str(value).split("\n")]
+    text = "\n".join(lines) + "\n"
+
+    # The offset of the data is part of the header it follows
+    offset = 0
+    while True:
+        tail = "file: . %d\nEND\n" % offset
+        needed = len(text) + len(tail)
+        aligned = -(-needed // MIF_ALIGNMENT) * MIF_ALIGNMENT
+        if aligned == offset:
+            break
+        offset = aligned
+    return (text + tail).encode("latin1"), offset
+
+
+def _write_mif_header(fileobj, shape, affine, dtype, zooms, extra=None):
+    """Write the header of a new image and return the parsed header."""
+    if zooms is None:
+        zooms = tuple(nb.affines.voxel_sizes(affine)) + (1.0,) * (len(shape) - 3)
+    zooms = np.array(zooms, dtype=float)
+    # The volumes of each voxel are stored contiguously, like dwi2fod's outputs
+    n_volume_axes = len(shape) - 3
+    layout = ["+%d" % (axis + n_volume_axes) for axis in range(3)]
+    layout += ["+%d" % axis for axis in range(n_volume_axes)]
+    header_bytes, offset = _mif_header_text(shape, affine, dtype, layout, zooms, extra)
+    fileobj.write(header_bytes)
+    fileobj.write(b"\0" * (offset - len(header_bytes)))
+    transform = np.array(affine, dtype=float)
+    transform[:3, :3] = transform[:3, :3] / zooms[:3]
+    return {
+        "dim": shape,
+        "vox": tuple(zooms),
+        "layout": [(1, int(axis)) for axis in layout],
+        "datatype": dtype,
+        "transform": transform,
+        "file": (".", offset),
+    }
+
+
+def create_mif(filename, shape, affine, dtype="float32", zooms=None, extra=None):
+    """Create a ``.mif`` file and memory-map its (zero-filled) data for writing.
+
+    Parameters
+    ----------
+    filename : :obj:`str`
+        Path to the new image.
+    shape : :obj:`tuple`
+        Shape of the image, with at least three dimensions.
+    affine : :obj:`numpy.ndarray`
+        The 4x4 voxel to scanner (RAS+) transform.
+    dtype : :obj:`str` or :obj:`numpy.dtype`
+        The data type, stored little-endian.
+    zooms : :obj:`tuple`, optional
+        Sizes of the voxels along each axis. By default, the spatial sizes come
+        from the affine and the others are 1.
+    extra : :obj:`dict`, optional
+        Other header entries, e.g. ``dw_scheme``. Values that are lists are
+        written as one line each.
+
+    Returns
+    -------
+    data : :obj:`numpy.memmap`
+        A writable view of the data, indexed like ``shape``.
+    """
+    shape = tuple(int(dim) for dim in shape)
+    dtype = np.dtype(dtype).newbyteorder("<")
+    n_values = int(np.prod(shape))
+    with open(filename, "wb") as fileobj:
+        header = _write_mif_header(fileobj, shape, affine, dtype, zooms, extra)
+        fileobj.truncate(header["file"][1] + n_values * dtype.itemsize)
+
+    raw = np.memmap(filename, dtype=dtype, mode="r+", offset=header["file"][1], shape=(n_values,))
+    data, _ = _storage_view(raw, header)
+    return data
+
+
+def save_mif(filename, data, affine, zooms=None, dtype=None, extra=None, compresslevel=6):
+    """Save an array as a ``.mif`` or ``.mif.gz`` image, stored as by :func:`create_mif`.
+
+    The data are read and written in slabs of axial slices, so an array proxy
+    (e.g. a NIfTI image's ``dataobj``) is streamed into the file without being
+    loaded whole, and ``.mif.gz`` files are compressed as they are written.
+
+    Parameters
+    ----------
+    filename : :obj:`str`
+        Path to the new image. It is compressed if it ends in ``.gz``.
+    data : array-like
+        The data, with at least three dimensions.
+    affine : :obj:`numpy.ndarray`
+        The 4x4 voxel to scanner (RAS+) transform.
+    zooms : :obj:`tuple`, optional
+        Sizes of the voxels along each axis, see :func:`create_mif`.
+    dtype : :obj:`str` or :obj:`numpy.dtype`, optional
+        The data type to store. By default, the type of the (scaled) data.
+    extra : :obj:`dict`, optional
+        Other header entries, see :func:`create_mif`.
+    compresslevel : :obj:`int`
+        The gzip compression level of ``.mif.gz`` files.
+    """
+    shape = tuple(int(dim) for dim in data.shape)
+    if dtype is None:
+        dtype = np.asarray(data[(slice(0, 1),) * len(shape)]).dtype
+    dtype = np.dtype(dtype).newbyteorder("<")
+    # The volumes are stored fastest and the slices slowest
+    stored_axes = tuple(range(3, len(shape))) + (0, 1, 2)
+    slice_bytes = int(np.prod(shape)) // shape[2] * dtype.itemsize
+    slab_thickness = max(1, MIF_BLOCK_BYTES // max(1, slice_bytes))
+
+    if filename.endswith(".gz"):
+        fileobj = gzip.open(filename, "wb", compresslevel=compresslevel)
+    else:
+        fileobj = open(filename, "wb")
+    with fileobj:
+        _write_mif_header(fileobj, shape, affine, dtype, zooms, extra)
+        for slab_start in range(0, shape[2], slab_thickness):
+            slab = np.asarray(data[:, :, slab_start : slab_start + slab_thickness], dtype=dtype)
+            fileobj.write(slab.transpose(stored_axes).tobytes(order="F"))
+
+
+class MifImage(SpatialImage):
+    """A MRtrix ``.mif`` or ``.mif.gz`` image, with the API of a nibabel image.
+
+    The header entries that do not describe the data (e.g. ``dw_scheme``) are
+    kept in :attr:`extra` and written back by :meth:`to_filename`.
+
+    Examples
+    --------
+    >>> img = MifImage.from_filename("fod.mif")  # doctest: +SKIP
+    >>> nb.Nifti1Image(img.get_fdata(), img.affine).to_filename("fod.nii.gz")  # doctest: +SKIP
+
+    """
+
+    header_class = SpatialHeader
+    files_types = (("image", ".mif"),)
+    valid_exts = (".mif",)
+    _compressed_suffixes = (".gz",)
+
+    @classmethod
+    def from_filename(cls, filename, mmap=True):
+        data, affine, header = load_mif(str(filename), mmap=mmap)
+        extra = {key: value for key, value in header.items() if key not in MIF_DATA_KEYS}
+        img = cls(data, affine, extra=extra)
+        # The spatial axes may have been reordered, the others have not
+        zooms = list(nb.affines.voxel_sizes(affine))
+        zooms += [zoom if np.isfinite(zoom) else 1.0 for zoom in header["vox"][3:]]
+        img.header.set_zooms(zooms)
+        return img
+
+    load = from_filename
+
+    def to_filename(self, filename, **kwargs):
+        """Save the image as ``.mif`` or ``.mif.gz``.
+
+        Use :func:`nibabel.save` to convert it to other formats, e.g. NIfTI.
+        """
+        filename = str(filename)
+        if not filename.endswith((".mif", ".mif.gz")):
+            raise ImageFileError("Not a MRtrix image file name: %s" % filename)
+        save_mif(
+            filename,
+            self.dataobj,
+            self.affine,
+            zooms=self.header.get_zooms(),
+            extra=self.extra,
+            **kwargs,
+        )
+
+
+def load_image(filename):
+    """Load an image with nibabel, or as a :class:`MifImage` if it is a MRtrix image."""
+    if str(filename).endswith((".mif", ".mif.gz")):
+        return MifImage.from_filename(filename)
+    return nb.load(filename)
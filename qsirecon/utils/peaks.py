@@ -0,0 +1,170 @@
+"""Batched peak detection for ODFs sampled on a discrete sphere."""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+def sphere_neighbors(sphere):
+    """Build a neighbor table from the edges of a sphere.
+
+    Parameters
+    ----------
+    sphere : dipy.core.sphere.Sphere
+        Sphere (or HemiSphere) whose ``edges`` define vertex adjacency.
+
+    Returns
+    -------
+    neighbors : (N, max_degree) ndarray
+        ``neighbors[i]`` holds the indices of the vertices adjacent to vertex ``i``.
+        Rows of vertices with fewer than ``max_degree`` neighbors are padded
+        with ``i`` itself, which never changes a peak comparison.
+    """
+    n_vertices = len(sphere.vertices)
+    edges = np.asarray(sphere.edges, dtype=int)
+    edges = np.unique(np.concatenate([edges, edges[:, ::-1]]), axis=0)
+    degree = np.bincount(edges[:, 0], minlength=n_vertices)
+    neighbors = np.repeat(np.arange(n_vertices)[:, None], degree.max(), axis=1)
+    starts = np.concatenate([[0], np.cumsum(degree)[:-1]])
+    neighbors[edges[:, 0], np.arange(len(edges)) - starts[edges[:, 0]]] = edges[:, 1]
+    return neighbors
+
+
+def batch_peak_directions(
+    odfs,
+    sphere,
+    num_peaks=5,
+    relative_peak_threshold=0.5,
+    min_separation_angle=25,
+    neighbors=None,
+    chunk_size=10000,
+    n_threads=1,
+):
+    """Find the largest peaks of many ODFs at once.
+
+    Each row gives the same peaks as
+    :func:`dipy.direction.peak_directions` with ``is_symmetric=True``,
+    truncated to ``num_peaks``.
+
+    Parameters
+    ----------
+    odfs : (n_odfs, N) ndarray
+        ODF amplitudes on the vertices of ``sphere``.
+    sphere : dipy.core.sphere.Sphere
+        The sphere the ODFs were sampled on.
+    num_peaks : int
+        Maximum number of peaks returned per ODF.
+    relative_peak_threshold : float
+        Only peaks greater than ``min + relative_peak_threshold * scale`` are
+        kept, where ``min = max(0, odf.min())`` and ``scale = odf.max() - min``.
+    min_separation_angle : float
+        Peaks closer than this many degrees to a larger peak are discarded.
+    neighbors : ndarray, optional
+        Precomputed output of :func:`sphere_neighbors` for ``sphere``.
+    chunk_size : int
+        Number of ODFs processed at a time. Bounds the temporary memory used.
+    n_threads : int
+        Number of threads used to process chunks.
+
+    Returns
+    -------
+    peak_values : (n_odfs, num_peaks) ndarray
+        Peak values sorted in descending order. Missing peaks are 0.
+    peak_indices : (n_odfs, num_peaks) ndarray
+        Sphere vertex index of each peak. Missing peaks are -1.
+    """
+    odfs = np.asarray(odfs)
+    if np.isnan(odfs).any():
+        raise ValueError("odf can not have nans")
+    if neighbors is None:
+        neighbors = sphere_neighbors(sphere)
+    similarity = np.abs(np.dot(sphere.vertices, sphere.vertices.T))
+    cos_separation = np.cos(np.deg2rad(min_separation_angle))
+
+    n_odfs = odfs.shape[0]
+    peak_values = np.zeros((n_odfs, num_peaks), dtype=odfs.dtype)
+    peak_indices = np.full((n_odfs, num_peaks), -1, dtype=int)
+
+    def _process(start):
+        stop = min(start + chunk_size, n_odfs)
+        peak_values[start:stop], peak_indices[start:stop] = _chunk_peak_directions(
+            odfs[start:stop],
+            neighbors,
+            similarity,
+            num_peaks,
+            relative_peak_threshold,
+            cos_separation,
+        )
+
+    starts = range(0, n_odfs, chunk_size)
+    if n_threads > 1 and len(starts) > 1:
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            list(executor.map(_process, starts))
+    else:
+        for start in starts:
+            _process(start)
+
+    return peak_values, peak_indices
+
+
+def _chunk_peak_directions(
+    odfs, neighbors, similarity, num_peaks, relative_peak_threshold, cos_separation
+):
+    n_odfs = odfs.shape[0]
+
+    # A vertex is a local maximum if it is >= all its neighbors and > at least one
+    ge_all = np.ones(odfs.shape, dtype=bool)
+    gt_any = np.zeros(odfs.shape, dtype=bool)
+    for column in neighbors.T:
+        neighbor_values = odfs[:, column]
+        ge_all &= odfs >= neighbor_values
+        gt_any |= odfs > neighbor_values
+    is_maximum = ge_all & gt_any
+    n_maxima = is_maximum.sum(1)
+    max_candidates = int(n_maxima.max()) if n_odfs else 0
+
+    peak_values = np.zeros((n_odfs, num_peaks), dtype=odfs.dtype)
+    peak_indices = np.full((n_odfs, num_peaks), -1, dtype=int)
+    if max_candidates == 0:
+        return peak_values, peak_indices
+
+    # Sort the local maxima of each ODF in descending order
+    rows, cols = np.nonzero(is_maximum)
+    values = odfs[rows, cols]
+    sort_order = np.lexsort((-values, rows))
+    rows, cols, values = rows[sort_order], cols[sort_order], values[sort_order]
+    ranks = np.arange(len(rows)) - np.concatenate([[0], np.cumsum(n_maxima)[:-1]])[rows]
+    candidate_values = np.full((n_odfs, max_candidates), -np.inf)
+    candidate_values[rows, ranks] = values
+    order = np.zeros((n_odfs, max_candidates), dtype=int)
+    order[rows, ranks] = cols
+    valid = np.isfinite(candidate_values)
+    valid &= candidate_values[:, :1] >= 0
+
+    # Remove small peaks, unless there is only a single maximum
+    odf_min = np.maximum(odfs.min(1), 0)[:, np.newaxis]
+    values_norm = candidate_values - odf_min
+    large_enough = values_norm >= values_norm[:, :1] * relative_peak_threshold
+    valid &= large_enough | (n_maxima == 1)[:, np.newaxis]
+
+    # Greedily remove peaks that are too close to a larger one
+    kept = np.zeros_like(valid)
+    n_kept = np.zeros(n_odfs, dtype=int)
+    # Valid candidates form a prefix of each row
+    for candidate in range(int(valid.sum(1).max())):
+        keep = valid[:, candidate] & (n_kept < num_peaks)
+        if not keep.any():
+            continue
+        if candidate:
+            too_close = (
+                similarity[order[:, candidate, np.newaxis], order[:, :candidate]] > cos_separation
+            )
+            keep &= ~(too_close & kept[:, :candidate]).any(1)
+        kept[:, candidate] = keep
+        n_kept += keep
+
+    rows, cols = np.nonzero(kept)
+    ranks = np.cumsum(kept, axis=1)[rows, cols] - 1
+    peak_values[rows, ranks] = candidate_values[rows, cols]
+    peak_indices[rows, ranks] = order[rows, cols]
+    return peak_values, peak_indices
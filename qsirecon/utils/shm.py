@@ -302,7 +302,7 @@ def real_sym_sh_brainsuite(sh_order, theta, phi):
                 )
             )
             * _legendre(ell, np.cos(phi)).T
-            * np.exp(np.complex(0, 1) * theta * span[:, None]).T
+            * np.exp(1j * theta * span[:, None]).T
         )
         span2 = np.arange(2, ell + 2)
         Pell = np.column_stack(
@@ -365,6 +365,40 @@ def real_sym_sh_mrtrix(sh_order, theta, phi):
     return real_sh, m, n
 
 
+def real_sym_sh_mrtrix3(sh_order, theta, phi):
+    """
+    Compute the real, orthonormal spherical harmonics used by MRtrix3.
+
+    This is the basis of :func:`real_sym_sh_mrtrix` (which is the basis of
+    MRtrix 0.2), with the harmonics where m != 0 scaled by sqrt(2) so that
+    the basis is orthonormal. FOD images written by ``dwi2fod`` and read by
+    ``sh2amp`` use this basis.
+
+    Parameters
+    -----------
+    sh_order : int
+        The maximum degree or the spherical harmonic basis.
+    theta : float [0, pi]
+        The polar (colatitudinal) coordinate.
+    phi : float [0, 2*pi]
+        The azimuthal (longitudinal) coordinate.
+
+    Returns
+    --------
+    y_mn : real float
+        The real harmonic $Y^m_n$ sampled at `theta` and `phi` as
+        implemented in MRtrix3.
+    m : array
+        The order of the harmonics.
+    n : array
+        The degree of the harmonics.
+
+    """
+    real_sh, m, n = real_sym_sh_mrtrix(sh_order, theta, phi)
+    real_sh *= np.where(m == 0, 1.0, np.sqrt(2))
+    return real_sh, m, n
+
+
 def real_sym_sh_basis(sh_order, theta, phi):
     """Samples a real symmetric spherical harmonic basis at point on the sphere
 
@@ -414,6 +448,7 @@ def real_sym_sh_basis(sh_order, theta, phi):
 sph_harm_lookup = {
     None: real_sym_sh_basis,
     "mrtrix": real_sym_sh_mrtrix,
+    "mrtrix3": real_sym_sh_mrtrix3,
     "fibernav": real_sym_sh_basis,
     "brainsuite": real_sym_sh_brainsuite,
 }
@@ -755,9 +790,10 @@ def sf_to_sh(sf, sphere, sh_order=4, basis_type=None, smooth=0.0):
     sh_order : int, optional
         Maximum SH order in the SH fit.  For `sh_order`, there will be
         ``(sh_order + 1) * (sh_order_2) / 2`` SH coefficients (default 4).
-    basis_type : {None, 'mrtrix', 'fibernav'}
+    basis_type : {None, 'mrtrix', 'mrtrix3', 'fibernav'}
         ``None`` for the default dipy basis,
-        ``mrtrix`` for the MRtrix basis, and
+        ``mrtrix`` for the MRtrix 0.2 basis,
+        ``mrtrix3`` for the MRtrix3 basis, and
         ``fibernav`` for the FiberNavigator basis
         (default ``None``).
     smooth : float, optional
@@ -794,9 +830,10 @@ def sh_to_sf(sh, sphere, sh_order, basis_type=None):
     sh_order : int, optional
         Maximum SH order in the SH fit.  For `sh_order`, there will be
         ``(sh_order + 1) * (sh_order_2) / 2`` SH coefficients (default 4).
-    basis_type : {None, 'mrtrix', 'fibernav'}
+    basis_type : {None, 'mrtrix', 'mrtrix3', 'fibernav'}
         ``None`` for the default dipy basis,
-        ``mrtrix`` for the MRtrix basis, and
+        ``mrtrix`` for the MRtrix 0.2 basis,
+        ``mrtrix3`` for the MRtrix3 basis, and
         ``fibernav`` for the FiberNavigator basis
         (default ``None``).
 
@@ -828,9 +865,10 @@ def sh_to_sf_matrix(sphere, sh_order, basis_type=None, return_inv=True, smooth=0
     sh_order : int, optional
         Maximum SH order in the SH fit.  For `sh_order`, there will be
         ``(sh_order + 1) * (sh_order_2) / 2`` SH coefficients (default 4).
-    basis_type : {None, 'mrtrix', 'fibernav'}
+    basis_type : {None, 'mrtrix', 'mrtrix3', 'fibernav'}
         ``None`` for the default dipy basis,
-        ``mrtrix`` for the MRtrix basis, and
+        ``mrtrix`` for the MRtrix 0.2 basis,
+        ``mrtrix3`` for the MRtrix3 basis, and
         ``fibernav`` for the FiberNavigator basis
         (default ``None``).
     return_inv : bool
@@ -9,6 +9,7 @@ import os.path as op
 import sys
 from copy import deepcopy
 from glob import glob
+from pathlib import Path
 
 import nipype.pipeline.engine as pe
 from bids.layout import BIDSLayout
@@ -28,7 +29,11 @@ from .. import config
 def init_qsirecon_wf():
     """Organize the execution of qsirecon, with a sub-workflow for each subject."""
     ver = Version(config.environment.version)
-    qsirecon_wf = Workflow(name=f"qsirecon_{ver.major}_{ver.minor}_wf")
+    wf_name = f"qsirecon_{ver.major}_{ver.minor}_wf"
+    if config.nipype.shard_index is not None:
+        # Shards share the working directory, so each one needs its own workflow directory
+        wf_name += f"_shard{config.nipype.shard_index:03d}"
+    qsirecon_wf = Workflow(name=wf_name)
     qsirecon_wf.base_dir = config.execution.work_dir
 
     if config.workflow.input_type not in ("qsiprep", "ukb"):
@@ -44,7 +49,11 @@ def init_qsirecon_wf():
         from ..utils.ingress import collect_ukb_participants, create_ukb_layout
 
         # The ukb input will always be specified as the bids input - we can't preproc it first
-        ukb_layout = create_ukb_layout(config.execution.bids_dir)
+        ukb_layout = create_ukb_layout(
+            config.execution.bids_dir,
+            index_file=_get_ukb_index_file(),
+            n_threads=config.nipype.omp_nthreads,
+        )
         to_recon_list = collect_ukb_participants(
             ukb_layout, participant_label=config.execution.participant_label
         )
@@ -95,9 +104,18 @@ def init_single_subject_recon_wf(subject_id):
     )
     from ..interfaces.reports import AboutSummary, SubjectSummary
     from ..interfaces.utils import GetUnique
+    from ..utils.memory import (
+        MEMORY_FEATURES_FILE,
+        MEMORY_MODEL_FILE,
+        image_profile,
+        load_memory_models,
+        record_node_features,
+        write_node_features,
+    )
     from .recon.anatomical import (
         init_dwi_recon_anatomical_workflow,
         init_highres_recon_anatomical_wf,
+        init_template_grid_node,
     )
     from .recon.build_workflow import init_dwi_recon_workflow
 
@@ -154,12 +172,17 @@ to workflows in *qsirecon*'s documentation]\
         name="aggregate_anatomical_nodes",
     )
 
+    # The output grids of all the runs are made from the same template grid
+    template_grid = init_template_grid_node()
+
     # create a processing pipeline for the dwis in each session
     dwi_recon_wfs = {}
     dwi_individual_anatomical_wfs = {}
     recon_full_inputs = {}
     dwi_ingress_nodes = {}
     anat_ingress_nodes = {}
+    memory_models = load_memory_models(config.execution.work_dir / MEMORY_MODEL_FILE)
+    memory_features = {}
     print(dwi_recon_inputs)
     dwi_files = [dwi_input["bids_dwi_file"] for dwi_input in dwi_recon_inputs]
     for i_run, dwi_input in enumerate(dwi_recon_inputs):
@@ -169,7 +192,9 @@ to workflows in *qsirecon*'s documentation]\
         # Get the preprocessed DWI and all the related preprocessed images
         if config.workflow.input_type == "qsiprep":
             dwi_ingress_nodes[dwi_file] = pe.Node(
-                QSIPrepDWIIngress(dwi_file=dwi_file),
+                QSIPrepDWIIngress(
+                    dwi_file=dwi_file, associated_files=dwi_input["associated_files"]
+                ),
                 name=f"{wf_name}_ingressed_dwi_data",
             )
             anat_ingress_nodes[dwi_file] = anat_ingress_node
@@ -184,7 +209,6 @@ to workflows in *qsirecon*'s documentation]\
                     subject_id=subject_id,
                     recon_input_dir=dwi_input["path"],
                     extras_to_make=spec.get("anatomical", []),
-                    pipeline_source="ukb",
                     needs_t1w_transform=needs_t1w_transform,
                     name=f"{wf_name}_ingressed_ukb_anat_data",
                 )
@@ -217,12 +241,24 @@ to workflows in *qsirecon*'s documentation]\
             name=f"{wf_name}_recon_inputs",
         )
 
+        # Let the scheduler know how much memory each reconstruction step needs.
+        # Without the series on disk, the nodes keep their default mem_gb.
+        dwi_series_file, dwi_mask_file = _get_dwi_series_files(dwi_input)
+        dwi_profile = None
+        if op.exists(dwi_series_file):
+            dwi_profile = image_profile(dwi_series_file, dwi_mask_file)
+
         # This is the actual recon workflow for this dwi file
         dwi_recon_wfs[dwi_file] = init_dwi_recon_workflow(
             available_anatomical_data=dwi_available_anatomical_data,
             workflow_spec=spec,
+            dwi_profile=dwi_profile,
             name=f"{wf_name}_recon_wf",
         )
+        if dwi_profile is not None:
+            memory_features.update(
+                record_node_features(dwi_recon_wfs[dwi_file], dwi_profile, models=memory_models)
+            )
 
         # Connect the collected diffusion data (gradients, etc) to the inputnode
         workflow.connect([
@@ -251,8 +287,15 @@ to workflows in *qsirecon*'s documentation]\
                 (f"outputnode.{trait}", f"inputnode.{trait}")
                 for trait in anatomical_workflow_outputs
             ]),
+            (template_grid, dwi_individual_anatomical_wfs[dwi_file], [
+                ("grid_image", "inputnode.template_image"),
+            ]),
         ])  # fmt:skip
 
+    # Keep the features of the estimates, so they can be calibrated after the run
+    config.execution.work_dir.mkdir(exist_ok=True, parents=True)
+    write_node_features(memory_features, config.execution.work_dir / MEMORY_FEATURES_FILE)
+
     # Preprocessing of anatomical data (includes possible registration template)
     dwi_basename = fix_multi_T1w_source_name(dwi_files)
 
@@ -276,7 +319,7 @@ to workflows in *qsirecon*'s documentation]\
             subjects_dir=config.execution.fs_subjects_dir,
             std_spaces=["MNIInfant" if config.workflow.infant else "MNI152NLin2009cAsym"],
             nstd_spaces=[],
-            dwi=dwi_files,
+            dwi=[_get_dwi_series_files(dwi_input)[0] for dwi_input in dwi_recon_inputs],
         ),
         name="summary",
         run_without_submitting=True,
@@ -385,6 +428,18 @@ def _load_recon_spec(spec_name):
     return spec
 
 
+def _get_dwi_series_files(dwi_input):
+    """Get the DWI series of a recon input that is on disk, and its brain mask.
+
+    The ``bids_dwi_file`` of a UKB input is only a name for the outputs, so the
+    series is found in the UKB directory. Its brain mask is on the T1w grid, so
+    it is not returned.
+    """
+    if config.workflow.input_type == "ukb":
+        return str(Path(dwi_input["path"]) / "DTI" / "dMRI" / "dMRI" / "data_ud.nii.gz"), None
+    return dwi_input["bids_dwi_file"], dwi_input.get("associated_files", {}).get("mask_file")
+
+
 def _get_iterable_dwi_inputs(subject_id):
     """Return inputs for the recon ingressors depending on the pipeline source.
 
@@ -396,6 +451,7 @@ def _get_iterable_dwi_inputs(subject_id):
     the other files needed.
 
     """
+    from ..interfaces.ingress import get_dwi_associations
     from ..utils.ingress import create_ukb_layout
 
     dwi_dir = config.execution.bids_dir
@@ -403,19 +459,43 @@ def _get_iterable_dwi_inputs(subject_id):
         if not (dwi_dir / f"sub-{subject_id}").exists():
             raise Exception(f"Unable to find subject directory in {config.execution.bids_dir}")
 
-        layout = BIDSLayout(dwi_dir, validate=False, absolute_paths=True)
+        # Query the database that is shared by the whole run (and --bids-database-dir)
+        layout = config.execution.layout
+        if layout is None:
+            layout = BIDSLayout(dwi_dir, validate=False, absolute_paths=True)
         # Get all the output files that are in this space
         dwi_files = [
             f.path
-            for f in layout.get(
-                suffix="dwi", subject=subject_id, absolute_paths=True, extension=["nii", "nii.gz"]
-            )
+            for f in layout.get(suffix="dwi", subject=subject_id, extension=["nii", "nii.gz"])
             if "space-T1w" in f.filename
         ]
         config.loggers.workflow.info("found %s in %s", dwi_files, dwi_dir)
-        return [{"bids_dwi_file": dwi_file} for dwi_file in dwi_files]
+
+        # Find the files that go with each dwi file from the same index
+        subject_files = layout.get(subject=subject_id, return_type="file")
+        return [
+            {
+                "bids_dwi_file": dwi_file,
+                "associated_files": get_dwi_associations(dwi_file, subject_files),
+            }
+            for dwi_file in dwi_files
+        ]
 
     if config.workflow.input_type == "ukb":
-        return create_ukb_layout(ukb_dir=config.execution.bids_dir, participant_label=subject_id)
+        return create_ukb_layout(
+            ukb_dir=config.execution.bids_dir,
+            participant_label=subject_id,
+            index_file=_get_ukb_index_file(),
+            n_threads=config.nipype.omp_nthreads,
+        )
 
     raise Exception("Unknown pipeline " + config.workflow.input_type)
+
+
+def _get_ukb_index_file():
+    """Get the path of the persistent UKB directory index.
+
+    The index is kept in the work directory, so that later runs with the same
+    work directory only check the directories that changed.
+    """
+    return Path(config.execution.work_dir) / "ukb_index.sqlite"
@@ -18,6 +18,7 @@ from ...interfaces.interchange import recon_workflow_input_fields
 from ...interfaces.recon_scalars import AMICOReconScalars
 from ...interfaces.reports import CLIReconPeaksReport
 from ...utils.bids import clean_datasinks
+from ...utils.memory import node_mem_gb
 from .utils import init_scalar_output_wf
 
 
@@ -26,6 +27,7 @@ def init_amico_noddi_fit_wf(
     name="amico_noddi_recon",
     qsirecon_suffix="",
     params={},
+    dwi_profile=None,
 ):
     """Reconstruct EAPs, ODFs, using 3dSHORE (brainsuite-style basis set).
 
@@ -88,7 +90,13 @@ diffusivity.""" % (
         name="recon_scalars",
         run_without_submitting=True,
     )
-    noddi_fit = pe.Node(NODDI(**params), name="recon_noddi", n_procs=omp_nthreads)
+    noddi_interface = NODDI(**params)
+    noddi_fit = pe.Node(
+        noddi_interface,
+        name="recon_noddi",
+        n_procs=omp_nthreads,
+        mem_gb=node_mem_gb(noddi_interface, dwi_profile),
+    )
     convert_to_fibgz = pe.Node(NODDItoFIBGZ(), name="convert_to_fibgz")
 
     workflow.connect([
@@ -123,7 +131,15 @@ diffusivity.""" % (
     ])  # fmt:skip
 
     if plot_reports:
-        plot_peaks = pe.Node(CLIReconPeaksReport(), name="plot_peaks", n_procs=omp_nthreads)
+        peaks_interface = CLIReconPeaksReport(
+            nthreads=omp_nthreads, sloppy=config.execution.sloppy
+        )
+        plot_peaks = pe.Node(
+            peaks_interface,
+            name="plot_peaks",
+            n_procs=omp_nthreads,
+            mem_gb=node_mem_gb(peaks_interface, dwi_profile),
+        )
         ds_report_peaks = pe.Node(
             DerivativesDataSink(
                 datatype="figures",
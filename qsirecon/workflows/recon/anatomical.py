@@ -6,7 +6,7 @@
 from pathlib import Path
 
 import nipype.interfaces.io as nio
-from nipype.interfaces import afni, ants, mrtrix3
+from nipype.interfaces import afni, ants
 from nipype.interfaces import utility as niu
 from nipype.interfaces.base import traits
 from nipype.pipeline import engine as pe
@@ -15,8 +15,8 @@ from pkg_resources import resource_filename as pkgrf
 
 from ... import config
 from ...interfaces.anatomical import (
-    GetTemplate,
     QSIPrepAnatomicalIngress,
+    TemplateGrid,
     UKBAnatomicalIngress,
     VoxelSizeChooser,
 )
@@ -32,7 +32,7 @@ from ...interfaces.interchange import (
 )
 from ...interfaces.mrtrix import GenerateMasked5tt, ITKTransformConvert, TransformHeader
 from ...utils.bids import clean_datasinks
-from qsirecon.interfaces.utils import GetConnectivityAtlases
+from qsirecon.interfaces.utils import GetConnectivityAtlases, ResampleROIs
 
 # Required freesurfer files for mrtrix's HSV 5tt generation
 HSV_REQUIREMENTS = [
@@ -64,16 +64,19 @@ def init_highres_recon_anatomical_wf(
     subject_id,
     extras_to_make,
     needs_t1w_transform,
+    recon_input_dir=None,
+    name="recon_anatomical_wf",
 ):
     """Gather any high-res anatomical data (images, transforms, segmentations) to use
     in recon workflows.
 
     This workflow searches through input data to see what anatomical data is available.
-    The anatomical data may be in a freesurfer directory.
+    The anatomical data may be in a freesurfer directory. For UKB inputs,
+    ``recon_input_dir`` is the directory of the session.
 
     """
 
-    workflow = Workflow(name="recon_anatomical_wf")
+    workflow = Workflow(name=name)
     outputnode = pe.Node(
         niu.IdentityInterface(fields=anatomical_workflow_outputs), name="outputnode"
     )
@@ -88,7 +91,7 @@ def init_highres_recon_anatomical_wf(
     if pipeline_source == "qsiprep":
         anat_ingress_node, status = gather_qsiprep_anatomical_data(subject_id)
     elif pipeline_source == "ukb":
-        anat_ingress_node, status = gather_ukb_anatomical_data(subject_id)
+        anat_ingress_node, status = gather_ukb_anatomical_data(subject_id, recon_input_dir)
     else:
         raise Exception(f"Unknown pipeline source '{pipeline_source}'")
     anat_ingress_node.inputs.infant_mode = config.workflow.infant
@@ -217,7 +220,7 @@ def init_highres_recon_anatomical_wf(
     return workflow, status
 
 
-def gather_ukb_anatomical_data(subject_id):
+def gather_ukb_anatomical_data(subject_id, recon_input_dir=None):
     """
     Check a UKB directory for the necessary files for recon workflows.
 
@@ -225,6 +228,8 @@ def gather_ukb_anatomical_data(subject_id):
     ----------
     subject_id : str
         List of subject labels
+    recon_input_dir : :obj:`pathlib.Path`, optional
+        The UKB directory of the session. Defaults to the input directory.
 
     """
     status = {
@@ -232,7 +237,8 @@ def gather_ukb_anatomical_data(subject_id):
         "has_freesurfer_5tt_hsvs": False,
         "has_freesurfer": False,
     }
-    recon_input_dir = config.execution.bids_dir
+    if recon_input_dir is None:
+        recon_input_dir = config.execution.bids_dir
 
     # Check to see if we have a T1w preprocessed by QSIRecon
     missing_ukb_anats = check_ukb_anatomical_outputs(recon_input_dir)
@@ -394,10 +400,7 @@ def init_register_fs_to_qsiprep_wf(
     workflow.__desc__ = "FreeSurfer outputs were registered to the QSIRecon outputs."
 
     # Convert the freesurfer inputs so we can register them with ANTs
-    convert_fs_brain = pe.Node(
-        mrtrix3.MRConvert(out_file="fs_brain.nii", args="-strides -1,-2,3"),
-        name="convert_fs_brain",
-    )
+    convert_fs_brain = pe.Node(TransformHeader(out_image="fs_brain.nii"), name="convert_fs_brain")
 
     # Register the brain to the QSIRecon reference
     ants_settings = pkgrf("qsirecon", "data/freesurfer_to_qsiprep.json")
@@ -434,11 +437,11 @@ def init_register_fs_to_qsiprep_wf(
 
     workflow.connect([
         (inputnode, convert_fs_brain, [
-            ("brain", "in_file")]),
+            ("brain", "in_image")]),
         (inputnode, register_to_qsiprep, [
             ("qsiprep_reference_image", "fixed_image")]),
         (convert_fs_brain, register_to_qsiprep, [
-            ("out_file", "moving_image")]),
+            ("out_image", "moving_image")]),
         (register_to_qsiprep, convert_ants_transform, [
             (("forward_transforms", _get_first), "in_transform")]),
         (register_to_qsiprep, outputnode, [
@@ -481,9 +484,11 @@ def init_dwi_recon_anatomical_workflow(
         has_qsiprep_t1w:
         has_qsiprep_t1w_transforms: True}
     """
-    # Inputnode holds data from the T1w-based anatomical workflow
+    # Inputnode holds data from the T1w-based anatomical workflow, and the subject's
+    # template grid (see init_template_grid_node)
     inputnode = pe.Node(
-        niu.IdentityInterface(fields=recon_workflow_input_fields), name="inputnode"
+        niu.IdentityInterface(fields=recon_workflow_input_fields + ["template_image"]),
+        name="inputnode",
     )
     connect_from_inputnode = set(recon_workflow_input_fields)
     # Buffer to hold the anatomical files that are calculated here
@@ -524,30 +529,12 @@ def init_dwi_recon_anatomical_workflow(
         }
 
     # XXX: This is a temporary solution until QSIRecon supports flexible output spaces.
-    get_template = pe.Node(
-        GetTemplate(
-            template_name="MNI152NLin2009cAsym" if not config.workflow.infant else "MNIInfant",
-        ),
-        name="get_template",
-    )
-    mask_template = pe.Node(
-        afni.Calc(expr="a*b", outputtype="NIFTI_GZ"),
-        name="mask_template",
-    )
-    reorient_to_lps = pe.Node(
-        afni.Resample(orientation="RAI", outputtype="NIFTI_GZ"),
-        name="reorient_to_lps",
-    )
-
     reference_grid_wf = init_output_grid_wf()
     workflow.connect([
-        (get_template, mask_template, [
-            ('template_file', 'in_file_a'),
-            ('mask_file', 'in_file_b'),
+        (inputnode, reference_grid_wf, [
+            ('dwi_ref', 'inputnode.input_image'),
+            ('template_image', 'inputnode.template_image'),
         ]),
-        (mask_template, reorient_to_lps, [('out_file', 'in_file')]),
-        (inputnode, reference_grid_wf, [('dwi_ref', 'inputnode.input_image')]),
-        (reorient_to_lps, reference_grid_wf, [('out_file', 'inputnode.template_image')]),
         (reference_grid_wf, buffernode, [('outputnode.grid_image', 'resampling_template')]),
     ])  # fmt:skip
 
@@ -708,13 +695,17 @@ def init_dwi_recon_anatomical_workflow(
         config.loggers.workflow.info("Transforming ODF ROIs into DWI space for visual report.")
         # Resample ROI targets to DWI resolution for ODF plotting
         crossing_rois_file = pkgrf("qsirecon", "data/crossing_rois.nii.gz")
+        # Runs with the same grid and transform share the result through the atlas cache
         odf_rois = pe.Node(
-            ants.ApplyTransforms(interpolation="MultiLabel", dimension=3), name="odf_rois"
+            ResampleROIs(
+                input_image=crossing_rois_file,
+                cache_dir=str(config.execution.work_dir / "atlas_cache"),
+            ),
+            name="odf_rois",
         )
-        odf_rois.inputs.input_image = crossing_rois_file
         workflow.connect([
             (_get_source_node('t1_2_mni_reverse_transform'), odf_rois, [
-                ('t1_2_mni_reverse_transform', 'transforms')]),
+                ('t1_2_mni_reverse_transform', 'transform')]),
             (inputnode, odf_rois, [
                 ("dwi_file", "reference_image")]),
             (odf_rois, buffernode, [("output_image", "odf_rois")])
@@ -727,11 +718,18 @@ def init_dwi_recon_anatomical_workflow(
                 "using the T1w-based spatial normalization. "
             )
 
-            # Resample all atlases to dwi_file's resolution
+            # Resample all atlases to dwi_file's resolution. Each atlas is resampled by its
+            # own antsApplyTransforms process, which needs about 1GB for a 1mm template.
+            n_atlas_procs = min(config.nipype.omp_nthreads, len(atlas_names))
             get_atlases = pe.Node(
-                GetConnectivityAtlases(atlas_names=atlas_names),
+                GetConnectivityAtlases(
+                    atlas_names=atlas_names,
+                    cache_dir=str(config.execution.work_dir / "atlas_cache"),
+                    num_threads=n_atlas_procs,
+                ),
                 name="get_atlases",
-                run_without_submitting=True,
+                n_procs=n_atlas_procs,
+                mem_gb=1.0 * n_atlas_procs,
             )
             workflow.connect([
                 (_get_source_node('t1_2_mni_reverse_transform'), get_atlases, [
@@ -837,8 +835,27 @@ def _get_resampled(atlas_configs, atlas_name, to_retrieve):
     return atlas_configs[atlas_name][to_retrieve]
 
 
+def init_template_grid_node(name="template_grid"):
+    """Make the grid of the template brain that the output grids of the runs are made from.
+
+    It only depends on the template, so one node serves all the runs of a subject.
+    """
+    return pe.Node(
+        TemplateGrid(
+            template_name="MNI152NLin2009cAsym" if not config.workflow.infant else "MNIInfant",
+            padding=4 if config.workflow.infant else 8,
+            cache_dir=str(config.execution.work_dir / "template_cache"),
+        ),
+        name=name,
+    )
+
+
 def init_output_grid_wf() -> Workflow:
-    """Generate a non-oblique, uniform voxel-size grid around a brain."""
+    """Generate a non-oblique, uniform voxel-size grid around a brain.
+
+    ``template_image`` is the output of :func:`init_template_grid_node`, which is shared
+    by all the runs of a subject. Only the voxel size depends on the input image.
+    """
     workflow = Workflow(name="output_grid_wf")
     inputnode = pe.Node(
         niu.IdentityInterface(fields=["template_image", "input_image"]), name="inputnode"
@@ -849,14 +866,7 @@ def init_output_grid_wf() -> Workflow:
         voxel_size = traits.Undefined
     else:
         voxel_size = config.workflow.output_resolution
-    padding = 4 if config.workflow.infant else 8
 
-    autobox_template = pe.Node(
-        afni.Autobox(outputtype="NIFTI_GZ", padding=padding), name="autobox_template"
-    )
-    deoblique_autobox = pe.Node(
-        afni.Warp(outputtype="NIFTI_GZ", deoblique=True), name="deoblique_autobox"
-    )
     voxel_size_chooser = pe.Node(
         VoxelSizeChooser(voxel_size=voxel_size), name="voxel_size_chooser"
     )
@@ -865,9 +875,7 @@ def init_output_grid_wf() -> Workflow:
     )
 
     workflow.connect([
-        (inputnode, autobox_template, [('template_image', 'in_file')]),
-        (autobox_template, deoblique_autobox, [('out_file', 'in_file')]),
-        (deoblique_autobox, resample_to_voxel_size, [('out_file', 'in_file')]),
+        (inputnode, resample_to_voxel_size, [('template_image', 'in_file')]),
         (resample_to_voxel_size, outputnode, [('out_file', 'grid_image')]),
         (inputnode, voxel_size_chooser, [('input_image', 'input_image')]),
         (voxel_size_chooser, resample_to_voxel_size, [(('voxel_size', _tupleize), 'voxel_size')])
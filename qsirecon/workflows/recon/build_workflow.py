@@ -24,7 +24,11 @@ from .mrtrix import (
     init_mrtrix_csd_recon_wf,
     init_mrtrix_tractography_wf,
 )
-from .scalar_mapping import init_scalar_to_bundle_wf, init_scalar_to_template_wf
+from .scalar_mapping import (
+    init_scalar_to_atlas_wf,
+    init_scalar_to_bundle_wf,
+    init_scalar_to_template_wf,
+)
 from .steinhardt import init_steinhardt_order_param_wf
 from .tortoise import init_tortoise_estimator_wf
 from .utils import init_conform_dwi_wf, init_discard_repeated_samples_wf
@@ -40,9 +44,14 @@ def _check_repeats(nodelist):
 def init_dwi_recon_workflow(
     workflow_spec,
     available_anatomical_data,
+    dwi_profile=None,
     name="recon_wf",
 ):
-    """Convert a workflow spec into a nipype workflow."""
+    """Convert a workflow spec into a nipype workflow.
+
+    ``dwi_profile`` is the :func:`~qsirecon.utils.memory.image_profile` of the
+    DWI series, from which the nodes estimate their ``mem_gb``.
+    """
 
     workflow = Workflow(name=name)
     inputnode = pe.Node(
@@ -58,6 +67,7 @@ def init_dwi_recon_workflow(
         new_node = workflow_from_spec(
             available_anatomical_data=available_anatomical_data,
             node_spec=node_spec,
+            dwi_profile=dwi_profile,
         )
         if new_node is None:
             raise Exception(f"Unable to create a node for {node_spec}")
@@ -171,7 +181,7 @@ def init_dwi_recon_workflow(
     return workflow
 
 
-def workflow_from_spec(available_anatomical_data, node_spec):
+def workflow_from_spec(available_anatomical_data, node_spec, dwi_profile=None):
     """Build a nipype workflow based on a json file."""
     software = node_spec.get("software", "qsirecon")
     qsirecon_suffix = node_spec.get("qsirecon_suffix", "")
@@ -197,6 +207,7 @@ def workflow_from_spec(available_anatomical_data, node_spec):
         "name": node_name,
         "qsirecon_suffix": qsirecon_suffix,
         "params": parameters,
+        "dwi_profile": dwi_profile,
     }
 
     # DSI Studio operations
@@ -261,6 +272,8 @@ def workflow_from_spec(available_anatomical_data, node_spec):
             return init_steinhardt_order_param_wf(**kwargs)
         if node_spec["action"] == "bundle_map":
             return init_scalar_to_bundle_wf(**kwargs)
+        if node_spec["action"] == "atlas_map":
+            return init_scalar_to_atlas_wf(**kwargs)
         if node_spec["action"] == "template_map":
             return init_scalar_to_template_wf(**kwargs)
 
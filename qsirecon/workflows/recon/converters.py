@@ -13,17 +13,23 @@ import nipype.interfaces.utility as niu
 import nipype.pipeline.engine as pe
 from niworkflows.engine.workflows import LiterateWorkflow as Workflow
 
+from ... import config
 from ...interfaces.bids import DerivativesDataSink
 from ...interfaces.converters import FODtoFIBGZ
 from ...interfaces.images import ConformDwi
 from ...interfaces.interchange import recon_workflow_input_fields
 from ...utils.bids import clean_datasinks
+from ...utils.memory import node_mem_gb
 
 LOGGER = logging.getLogger("nipype.workflow")
 
 
 def init_mif_to_fibgz_wf(
-    available_anatomical_data, name="mif_to_fibgz", qsirecon_suffix="", params={}
+    available_anatomical_data,
+    name="mif_to_fibgz",
+    qsirecon_suffix="",
+    params={},
+    dwi_profile=None,
 ):
     """Converts a MRTrix mif file to DSI Studio fib file.
 
@@ -51,7 +57,10 @@ def init_mif_to_fibgz_wf(
     )
     outputnode.inputs.recon_scalars = []
     workflow = Workflow(name=name)
-    convert_to_fib = pe.Node(FODtoFIBGZ(), name="convert_to_fib")
+    omp_nthreads = config.nipype.omp_nthreads
+    convert_to_fib = pe.Node(
+        FODtoFIBGZ(num_threads=omp_nthreads), name="convert_to_fib", n_procs=omp_nthreads
+    )
     workflow.connect([
         (inputnode, convert_to_fib, [
             ('fod_sh_mif', 'mif_file'),
@@ -86,7 +95,10 @@ def init_fibgz_to_mif_wf(name="fibgz_to_mif", qsirecon_suffix="", params={}):
     )
     outputnode.inputs.recon_scalars = []
     workflow = Workflow(name=name)
-    convert_to_fib = pe.Node(FODtoFIBGZ(), name="convert_to_fib")
+    omp_nthreads = config.nipype.omp_nthreads
+    convert_to_fib = pe.Node(
+        FODtoFIBGZ(num_threads=omp_nthreads), name="convert_to_fib", n_procs=omp_nthreads
+    )
     workflow.connect([
         (inputnode, convert_to_fib, [('mif_file', 'mif_file')]),
         (convert_to_fib, outputnode, [('fib_file', 'fib_file')])
@@ -96,7 +108,11 @@ def init_fibgz_to_mif_wf(name="fibgz_to_mif", qsirecon_suffix="", params={}):
 
 
 def init_qsirecon_to_fsl_wf(
-    available_anatomical_data, name="qsirecon_to_fsl", qsirecon_suffix="", params={}
+    available_anatomical_data,
+    name="qsirecon_to_fsl",
+    qsirecon_suffix="",
+    params={},
+    dwi_profile=None,
 ):
     """Converts QSIRecon outputs (images, bval, bvec) to fsl standard orientation"""
     inputnode = pe.Node(
@@ -107,8 +123,18 @@ def init_qsirecon_to_fsl_wf(
     workflow = Workflow(name=name)
     outputnode.inputs.recon_scalars = []
 
-    convert_dwi_to_fsl = pe.Node(ConformDwi(orientation="LAS"), name="convert_to_fsl")
-    convert_mask_to_fsl = pe.Node(ConformDwi(orientation="LAS"), name="convert_mask_to_fsl")
+    conform_interface = ConformDwi(orientation="LAS")
+    convert_dwi_to_fsl = pe.Node(
+        conform_interface,
+        name="convert_to_fsl",
+        mem_gb=node_mem_gb(conform_interface, dwi_profile),
+    )
+    conform_mask_interface = ConformDwi(orientation="LAS")
+    convert_mask_to_fsl = pe.Node(
+        conform_mask_interface,
+        name="convert_mask_to_fsl",
+        mem_gb=node_mem_gb(conform_mask_interface, dwi_profile),
+    )
     workflow.connect([
         (inputnode, convert_dwi_to_fsl, [
             ('dwi_file', 'dwi_file'),
@@ -29,6 +29,7 @@ from ...interfaces.recon_scalars import (
 )
 from ...interfaces.reports import CLIReconPeaksReport
 from ...utils.bids import clean_datasinks
+from ...utils.memory import node_mem_gb
 from .utils import init_scalar_output_wf
 
 LOGGER = logging.getLogger("nipype.interface")
@@ -71,6 +72,7 @@ def init_dipy_brainsuite_shore_recon_wf(
     name="dipy_3dshore_recon",
     qsirecon_suffix="",
     params={},
+    dwi_profile=None,
 ):
     """Reconstruct EAPs, ODFs, using 3dSHORE (brainsuite-style basis set).
 
@@ -152,7 +154,13 @@ def init_dipy_brainsuite_shore_recon_wf(
     plot_reports = not config.execution.skip_odf_reports
     workflow = Workflow(name=name)
     desc = "Dipy Reconstruction\n\n: "
-    recon_shore = pe.Node(BrainSuiteShoreReconstruction(**params), name="recon_shore")
+    shore_interface = BrainSuiteShoreReconstruction(num_threads=omp_nthreads, **params)
+    recon_shore = pe.Node(
+        shore_interface,
+        name="recon_shore",
+        n_procs=omp_nthreads,
+        mem_gb=node_mem_gb(shore_interface, dwi_profile),
+    )
     recon_scalars = pe.Node(
         BrainSuite3dSHOREReconScalars(qsirecon_suffix="name"),
         name="recon_scalars",
@@ -189,7 +197,15 @@ def init_dipy_brainsuite_shore_recon_wf(
     ])  # fmt:skip
 
     if plot_reports:
-        plot_peaks = pe.Node(CLIReconPeaksReport(), name="plot_peaks", n_procs=omp_nthreads)
+        peaks_interface = CLIReconPeaksReport(
+            nthreads=omp_nthreads, sloppy=config.execution.sloppy
+        )
+        plot_peaks = pe.Node(
+            peaks_interface,
+            name="plot_peaks",
+            n_procs=omp_nthreads,
+            mem_gb=node_mem_gb(peaks_interface, dwi_profile),
+        )
         ds_report_peaks = pe.Node(
             DerivativesDataSink(
                 desc="3dSHOREODF",
@@ -351,6 +367,7 @@ def init_dipy_mapmri_recon_wf(
     name="dipy_mapmri_recon",
     qsirecon_suffix="",
     params={},
+    dwi_profile=None,
 ):
     """Reconstruct EAPs, ODFs, using 3dSHORE (brainsuite-style basis set).
 
@@ -424,6 +441,10 @@ def init_dipy_mapmri_recon_wf(
             with a particular cvxpy solver. See http://www.cvxpy.org/ for
             details.
             Default: None (cvxpy chooses its own solver)
+        metrics : list of str, optional
+            The maps to write, from rtop, lapnorm, msd, qiv, rtap, rtpp, ng,
+            perng and parng. All of them are written by default. The
+            coefficients and ODFs are always written.
     """
 
     inputnode = pe.Node(
@@ -454,7 +475,13 @@ def init_dipy_mapmri_recon_wf(
     desc = "Dipy Reconstruction\n\n: "
     plot_reports = not config.execution.skip_odf_reports
     omp_nthreads = config.nipype.omp_nthreads
-    recon_map = pe.Node(MAPMRIReconstruction(**params), name="recon_map")
+    mapmri_interface = MAPMRIReconstruction(num_threads=omp_nthreads, **params)
+    recon_map = pe.Node(
+        mapmri_interface,
+        name="recon_map",
+        n_procs=omp_nthreads,
+        mem_gb=node_mem_gb(mapmri_interface, dwi_profile),
+    )
     recon_scalars = pe.Node(
         DIPYMAPMRIReconScalars(qsirecon_suffix=name),
         name="recon_scalars",
@@ -495,7 +522,15 @@ def init_dipy_mapmri_recon_wf(
     ])  # fmt:skip
 
     if plot_reports:
-        plot_peaks = pe.Node(CLIReconPeaksReport(), name="plot_peaks", n_procs=omp_nthreads)
+        peaks_interface = CLIReconPeaksReport(
+            nthreads=omp_nthreads, sloppy=config.execution.sloppy
+        )
+        plot_peaks = pe.Node(
+            peaks_interface,
+            name="plot_peaks",
+            n_procs=omp_nthreads,
+            mem_gb=node_mem_gb(peaks_interface, dwi_profile),
+        )
         ds_report_peaks = pe.Node(
             DerivativesDataSink(
                 desc="MAPLMRIODF",
@@ -544,7 +579,11 @@ def init_dipy_mapmri_recon_wf(
 
 
 def init_dipy_dki_recon_wf(
-    available_anatomical_data, name="dipy_dki_recon", qsirecon_suffix="", params={}
+    available_anatomical_data,
+    name="dipy_dki_recon",
+    qsirecon_suffix="",
+    params={},
+    dwi_profile=None,
 ):
     """Fit DKI
 
@@ -607,7 +646,14 @@ def init_dipy_dki_recon_wf(
     workflow = Workflow(name=name)
     desc = "Dipy Reconstruction\n\n: "
     plot_reports = not config.execution.skip_odf_reports
-    recon_dki = pe.Node(KurtosisReconstruction(**params), name="recon_dki")
+    omp_nthreads = config.nipype.omp_nthreads
+    dki_interface = KurtosisReconstruction(num_threads=omp_nthreads, **params)
+    recon_dki = pe.Node(
+        dki_interface,
+        name="recon_dki",
+        n_procs=omp_nthreads,
+        mem_gb=node_mem_gb(dki_interface, dwi_profile),
+    )
 
     workflow.connect([
         (inputnode, recon_dki, [
@@ -643,7 +689,11 @@ def init_dipy_dki_recon_wf(
 
     if plot_reports and False:
         plot_peaks = pe.Node(
-            CLIReconPeaksReport(peaks_only=True),
+            CLIReconPeaksReport(
+                peaks_only=True,
+                nthreads=config.nipype.omp_nthreads,
+                sloppy=config.execution.sloppy,
+            ),
             name="plot_peaks",
             n_procs=config.nipype.omp_nthreads,
         )
@@ -37,13 +37,18 @@ from ...interfaces.interchange import recon_workflow_input_fields
 from ...interfaces.recon_scalars import DSIStudioReconScalars
 from ...interfaces.reports import CLIReconPeaksReport, ConnectivityReport
 from ...utils.bids import clean_datasinks
+from ...utils.memory import node_mem_gb
 from .utils import init_scalar_output_wf
 
 LOGGER = logging.getLogger("nipype.interface")
 
 
 def init_dsi_studio_recon_wf(
-    available_anatomical_data, name="dsi_studio_recon", qsirecon_suffix="", params={}
+    available_anatomical_data,
+    name="dsi_studio_recon",
+    qsirecon_suffix="",
+    params={},
+    dwi_profile=None,
 ):
     """Reconstructs diffusion data using DSI Studio.
 
@@ -78,11 +83,18 @@ def init_dsi_studio_recon_wf(
     desc = """DSI Studio Reconstruction
 
 : """
-    create_src = pe.Node(DSIStudioCreateSrc(), name="create_src")
+    create_src_interface = DSIStudioCreateSrc()
+    create_src = pe.Node(
+        create_src_interface,
+        name="create_src",
+        mem_gb=node_mem_gb(create_src_interface, dwi_profile),
+    )
     romdd = params.get("ratio_of_mean_diffusion_distance", 1.25)
+    gqi_interface = DSIStudioGQIReconstruction(ratio_of_mean_diffusion_distance=romdd)
     gqi_recon = pe.Node(
-        DSIStudioGQIReconstruction(ratio_of_mean_diffusion_distance=romdd),
+        gqi_interface,
         name="gqi_recon",
+        mem_gb=node_mem_gb(gqi_interface, dwi_profile),
         n_procs=omp_nthreads,
     )
     desc += """\
@@ -104,8 +116,14 @@ distance of %02f in DSI Studio (version %s). """ % (
     ])  # fmt:skip
     if plot_reports:
         # Make a visual report of the model
+        peaks_interface = CLIReconPeaksReport(
+            subtract_iso=True, nthreads=omp_nthreads, sloppy=config.execution.sloppy
+        )
         plot_peaks = pe.Node(
-            CLIReconPeaksReport(subtract_iso=True), name="plot_peaks", n_procs=omp_nthreads
+            peaks_interface,
+            name="plot_peaks",
+            n_procs=omp_nthreads,
+            mem_gb=node_mem_gb(peaks_interface, dwi_profile),
         )
         ds_report_peaks = pe.Node(
             DerivativesDataSink(
@@ -163,6 +181,7 @@ def init_dsi_studio_tractography_wf(
     name="dsi_studio_tractography",
     params={},
     qsirecon_suffix="",
+    dwi_profile=None,
 ):
     """Calculate streamline-based connectivity matrices using DSI Studio.
 
@@ -235,10 +254,12 @@ def init_dsi_studio_tractography_wf(
         "(version %s) using a deterministic algorithm "
         "[@yeh2013deterministic]. " % DSI_STUDIO_VERSION
     )
+    tracking_interface = DSIStudioTracking(num_threads=omp_nthreads, **params)
     tracking = pe.Node(
-        DSIStudioTracking(num_threads=omp_nthreads, **params),
+        tracking_interface,
         name="tracking",
         n_procs=omp_nthreads,
+        mem_gb=node_mem_gb(tracking_interface, dwi_profile),
     )
     workflow.connect([
         (inputnode, tracking, [('fibgz', 'input_fib')]),
@@ -268,6 +289,7 @@ def init_dsi_studio_autotrack_wf(
     params={},
     qsirecon_suffix="",
     name="dsi_studio_autotrack_wf",
+    dwi_profile=None,
 ):
     """Run DSI Studio's AutoTrack method to produce bundles and bundle stats.
 
@@ -339,8 +361,12 @@ def init_dsi_studio_autotrack_wf(
     workflow.__desc__ = desc + bundle_desc
 
     # Run autotrack!
+    autotrack_interface = AutoTrack(num_threads=omp_nthreads, **params)
     actual_trk = pe.Node(
-        AutoTrack(num_threads=omp_nthreads, **params), name="actual_trk", n_procs=omp_nthreads
+        autotrack_interface,
+        name="actual_trk",
+        n_procs=omp_nthreads,
+        mem_gb=node_mem_gb(autotrack_interface, dwi_profile),
     )  # An extra thread is needed
 
     # Create a single output
@@ -412,6 +438,7 @@ def init_dsi_studio_connectivity_wf(
     name="dsi_studio_connectivity",
     params={},
     qsirecon_suffix="",
+    dwi_profile=None,
 ):
     """Calculate streamline-based connectivity matrices using DSI Studio.
 
@@ -483,10 +510,12 @@ def init_dsi_studio_connectivity_wf(
     plot_reports = not config.execution.skip_odf_reports
 
     workflow = pe.Workflow(name=name)
+    connectivity_interface = DSIStudioAtlasGraph(num_threads=omp_nthreads, **params)
     calc_connectivity = pe.Node(
-        DSIStudioAtlasGraph(num_threads=omp_nthreads, **params),
+        connectivity_interface,
         name="calc_connectivity",
         n_procs=omp_nthreads,
+        mem_gb=node_mem_gb(connectivity_interface, dwi_profile),
     )
 
     workflow.connect([
@@ -536,6 +565,7 @@ def init_dsi_studio_export_wf(
     name="dsi_studio_export",
     params={},
     qsirecon_suffix="",
+    dwi_profile=None,
 ):
     """Export scalar maps from a DSI Studio fib file into NIfTI files with correct headers.
 
@@ -37,6 +37,7 @@ from ...interfaces.mrtrix import (
 )
 from ...interfaces.reports import CLIReconPeaksReport, ConnectivityReport
 from ...utils.bids import clean_datasinks
+from ...utils.memory import node_mem_gb
 
 LOGGER = logging.getLogger("nipype.interface")
 MULTI_RESPONSE_ALGORITHMS = ("dhollander", "msmt_5tt")
@@ -50,7 +51,11 @@ CITATIONS = {
 
 
 def init_mrtrix_csd_recon_wf(
-    available_anatomical_data, name="mrtrix_recon", qsirecon_suffix="", params={}
+    available_anatomical_data,
+    name="mrtrix_recon",
+    qsirecon_suffix="",
+    params={},
+    dwi_profile=None,
 ):
     """Create FOD images for WM, GM and CSF.
 
@@ -179,7 +184,13 @@ def init_mrtrix_csd_recon_wf(
             raise Exception("Unrecognized 5tt method: " + method_5tt)
 
     if fod_algorithm in ("msmt_csd", "csd"):
-        estimate_fod = pe.Node(EstimateFOD(**fod), name="estimate_fod", n_procs=omp_nthreads)
+        fod_interface = EstimateFOD(**fod)
+        estimate_fod = pe.Node(
+            fod_interface,
+            name="estimate_fod",
+            n_procs=omp_nthreads,
+            mem_gb=node_mem_gb(fod_interface, dwi_profile),
+        )
         desc += " Reconstruction was done using MRtrix3 (@mrtrix3)."
     elif fod_algorithm == "ss3t":
         estimate_fod = pe.Node(SS3TEstimateFOD(**fod), name="estimate_fod", n_procs=omp_nthreads)
@@ -216,12 +227,14 @@ def init_mrtrix_csd_recon_wf(
                                         ('csf_odf', 'csf_odf')])
         ])  # fmt:skip
     else:
+        norm_interface = MTNormalize(
+            nthreads=omp_nthreads, inlier_mask="inliers.nii.gz", norm_image="norm.nii.gz"
+        )
         intensity_norm = pe.Node(
-            MTNormalize(
-                nthreads=omp_nthreads, inlier_mask="inliers.nii.gz", norm_image="norm.nii.gz"
-            ),
+            norm_interface,
             name="intensity_norm",
             n_procs=omp_nthreads,
+            mem_gb=node_mem_gb(norm_interface, dwi_profile),
         )
         workflow.connect([
             (inputnode, intensity_norm, [('dwi_mask', 'mask_file')]),
@@ -237,7 +250,15 @@ def init_mrtrix_csd_recon_wf(
 
     if plot_reports:
         # Make a visual report of the model
-        plot_peaks = pe.Node(CLIReconPeaksReport(), name="plot_peaks", n_procs=omp_nthreads)
+        peaks_interface = CLIReconPeaksReport(
+            nthreads=omp_nthreads, sloppy=config.execution.sloppy
+        )
+        plot_peaks = pe.Node(
+            peaks_interface,
+            name="plot_peaks",
+            n_procs=omp_nthreads,
+            mem_gb=node_mem_gb(peaks_interface, dwi_profile),
+        )
         ds_report_peaks = pe.Node(
             DerivativesDataSink(
                 desc="wmFOD",
@@ -401,7 +422,11 @@ def init_mrtrix_csd_recon_wf(
 
 
 def init_global_tractography_wf(
-    available_anatomical_data, name="mrtrix_recon", qsirecon_suffix="", params={}
+    available_anatomical_data,
+    name="mrtrix_recon",
+    qsirecon_suffix="",
+    params={},
+    dwi_profile=None,
 ):
     """Run multi-shell, multi-tissue global tractography
 
@@ -449,7 +474,10 @@ def init_global_tractography_wf(
     create_mif = pe.Node(MRTrixIngress(), name="create_mif")
 
     # Resample anat mask
-    tck_global = pe.Node(GlobalTractography(**params), name="tck_global")
+    global_interface = GlobalTractography(**params)
+    tck_global = pe.Node(
+        global_interface, name="tck_global", mem_gb=node_mem_gb(global_interface, dwi_profile)
+    )
     workflow.connect([
         (inputnode, create_mif, [
             ('dwi_file', 'dwi_file'),
@@ -521,7 +549,11 @@ def init_global_tractography_wf(
 
 
 def init_mrtrix_tractography_wf(
-    available_anatomical_data, name="mrtrix_tracking", qsirecon_suffix="", params={}
+    available_anatomical_data,
+    name="mrtrix_tracking",
+    qsirecon_suffix="",
+    params={},
+    dwi_profile=None,
 ):
     """Run tractography
 
@@ -563,7 +595,13 @@ def init_mrtrix_tractography_wf(
     use_5tt = params.get("use_5tt", False)
     sift_params = params.get("sift2", {})
     sift_params["nthreads"] = omp_nthreads
-    tracking = pe.Node(TckGen(**tracking_params), name="tractography", n_procs=omp_nthreads)
+    tracking_interface = TckGen(**tracking_params)
+    tracking = pe.Node(
+        tracking_interface,
+        name="tractography",
+        n_procs=omp_nthreads,
+        mem_gb=node_mem_gb(tracking_interface, dwi_profile),
+    )
     workflow.connect([
         (inputnode, tracking, [
             ('fod_sh_mif', 'in_file'),
@@ -643,6 +681,7 @@ def init_mrtrix_connectivity_wf(
     name="mrtrix_connectiity",
     params={},
     qsirecon_suffix="",
+    dwi_profile=None,
 ):
     """Runs ``tck2connectome`` on a ``tck`` file.
 
@@ -671,10 +710,12 @@ def init_mrtrix_connectivity_wf(
     plot_reports = not config.execution.skip_odf_reports
     workflow = pe.Workflow(name=name)
     conmat_params = params.get("tck2connectome", {})
+    connectivity_interface = MRTrixAtlasGraph(tracking_params=conmat_params, nthreads=omp_nthreads)
     calc_connectivity = pe.Node(
-        MRTrixAtlasGraph(tracking_params=conmat_params, nthreads=omp_nthreads),
+        connectivity_interface,
         name="calc_connectivity",
         n_procs=omp_nthreads,
+        mem_gb=node_mem_gb(connectivity_interface, dwi_profile),
     )
     workflow.connect([
         (inputnode, calc_connectivity, [
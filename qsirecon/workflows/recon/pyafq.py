@@ -16,6 +16,7 @@ from ...interfaces.bids import ReconDerivativesDataSink
 from ...interfaces.interchange import recon_workflow_input_fields
 from ...interfaces.pyafq import PyAFQRecon
 from ...utils.bids import clean_datasinks
+from ...utils.memory import node_mem_gb
 
 
 def _parse_qsirecon_params_dict(params_dict):
@@ -49,7 +50,9 @@ def _parse_qsirecon_params_dict(params_dict):
     return kwargs
 
 
-def init_pyafq_wf(available_anatomical_data, name="afq", qsirecon_suffix="", params={}):
+def init_pyafq_wf(
+    available_anatomical_data, name="afq", qsirecon_suffix="", params={}, dwi_profile=None
+):
     """Run PyAFQ on some qsirecon outputs
 
     Inputs
@@ -71,8 +74,12 @@ def init_pyafq_wf(available_anatomical_data, name="afq", qsirecon_suffix="", par
     omp_nthreads = config.nipype.omp_nthreads
     kwargs = _parse_qsirecon_params_dict(params)
     kwargs["omp_nthreads"] = config.nipype.omp_nthreads
+    afq_interface = PyAFQRecon(kwargs=kwargs, n_procs=omp_nthreads)
     run_afq = pe.Node(
-        PyAFQRecon(kwargs=kwargs, n_procs=omp_nthreads), name="run_afq", n_procs=omp_nthreads
+        afq_interface,
+        name="run_afq",
+        n_procs=omp_nthreads,
+        mem_gb=node_mem_gb(afq_interface, dwi_profile),
     )
     workflow = pe.Workflow(name=name)
     if params.get("use_external_tracking", False):
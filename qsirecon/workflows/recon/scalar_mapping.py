@@ -5,7 +5,6 @@ Summarize and Transform recon outputs
 .. autofunction:: init_scalar_to_bundle_wf
 .. autofunction:: init_scalar_to_atlas_wf
 .. autofunction:: init_scalar_to_template_wf
-.. autofunction:: init_scalar_to_surface_wf
 
 
 """
@@ -16,18 +15,23 @@ import nipype.interfaces.utility as niu
 import nipype.pipeline.engine as pe
 from niworkflows.engine.workflows import LiterateWorkflow as Workflow
 
-from ...interfaces.bids import DerivativesDataSink
+from ... import config
 from ...interfaces.interchange import recon_workflow_input_fields
 from ...interfaces.recon_scalars import ReconScalarsTableSplitterDataSink
-from ...interfaces.scalar_mapping import BundleMapper, TemplateMapper
+from ...interfaces.scalar_mapping import AtlasMapper, BundleMapper, TemplateMapper
 from ...utils.bids import clean_datasinks
+from ...utils.memory import node_mem_gb
 from .utils import init_scalar_output_wf
 
 LOGGER = logging.getLogger("nipype.workflow")
 
 
 def init_scalar_to_bundle_wf(
-    available_anatomical_data, name="scalar_to_bundle", qsirecon_suffix="", params={}
+    available_anatomical_data,
+    name="scalar_to_bundle",
+    qsirecon_suffix="",
+    params={},
+    dwi_profile=None,
 ):
     """Map scalar images to bundles
 
@@ -54,7 +58,12 @@ def init_scalar_to_bundle_wf(
     )
     outputnode = pe.Node(niu.IdentityInterface(fields=["bundle_summary"]), name="outputnode")
     workflow = Workflow(name=name)
-    bundle_mapper = pe.Node(BundleMapper(**params), name="bundle_mapper")
+    bundle_interface = BundleMapper(**params)
+    bundle_mapper = pe.Node(
+        bundle_interface,
+        name="bundle_mapper",
+        mem_gb=node_mem_gb(bundle_interface, dwi_profile),
+    )
     ds_bundle_mapper = pe.Node(
         ReconScalarsTableSplitterDataSink(dismiss_entities=["desc"], suffix="scalarstats"),
         name="ds_bundle_mapper",
@@ -87,22 +96,21 @@ def init_scalar_to_bundle_wf(
 
 def init_scalar_to_atlas_wf(
     available_anatomical_data,
-    name="scalar_to_template",
+    name="scalar_to_atlas",
     qsirecon_suffix="",
     params={},
+    dwi_profile=None,
 ):
-    """Map scalar images to atlas regions
+    """Summarize scalar images within the regions of atlases
 
     Inputs
-        tck_files
-            MRtrix3 format tck files for each bundle
-        bundle_names
-            Names that describe which bundles are present in `tck_files`
+        atlas_configs
+            Dictionary of the atlases resampled to the DWI, by atlas name
         recon_scalars
             List of dictionaries containing scalar info
 
     Outputs
-        bundle_summaries
+        atlas_summary
             summary statistics in tsv format
 
     """
@@ -112,29 +120,33 @@ def init_scalar_to_atlas_wf(
         ),
         name="inputnode",
     )
-    # outputnode = pe.Node(niu.IdentityInterface(fields=["atlas_summaries"]), name="outputnode")
+    outputnode = pe.Node(niu.IdentityInterface(fields=["atlas_summary"]), name="outputnode")
     workflow = Workflow(name=name)
-    bundle_mapper = pe.Node(BundleMapper(**params), name="bundle_mapper")
+    atlas_interface = AtlasMapper(**params)
+    atlas_mapper = pe.Node(
+        atlas_interface,
+        name="atlas_mapper",
+        mem_gb=node_mem_gb(atlas_interface, dwi_profile),
+    )
+    ds_atlas_mapper = pe.Node(
+        ReconScalarsTableSplitterDataSink(dismiss_entities=["desc"], suffix="scalarstats"),
+        name="ds_atlas_mapper",
+        run_without_submitting=True,
+    )
     workflow.connect([
-        (inputnode, bundle_mapper, [
+        (inputnode, atlas_mapper, [
             ("collected_scalars", "recon_scalars"),
-            ("tck_files", "tck_files"),
-            ("dwi_ref", "dwiref_image")])
+            ("atlas_configs", "atlas_configs"),
+            ("dwi_ref", "dwiref_image")]),
+        (atlas_mapper, ds_atlas_mapper, [
+            ("atlas_summary", "summary_tsv")]),
+        (atlas_mapper, outputnode, [
+            ("atlas_summary", "atlas_summary")]),
     ])  # fmt:skip
-    if qsirecon_suffix:
-
-        ds_bundle_summaries = pe.Node(
-            DerivativesDataSink(
-                dismiss_entities=("desc",),
-                desc="bundlemap",
-            ),
-            name="ds_bundle_summaries",
-            run_without_submitting=True,
-        )
-        workflow.connect([
-            (bundle_mapper, ds_bundle_summaries, [("bundle_summaries", "in_file")])
-        ])  # fmt:skip
-    return clean_datasinks(workflow, qsirecon_suffix)
+
+    # NOTE: Don't add qsirecon_suffix with clean_datasinks here,
+    # as the qsirecon_suffix is determined within ReconScalarsTableSplitterDataSink.
+    return clean_datasinks(workflow, qsirecon_suffix=None)
 
 
 def init_scalar_to_template_wf(
@@ -142,6 +154,7 @@ def init_scalar_to_template_wf(
     name="scalar_to_template",
     qsirecon_suffix="",
     params={},
+    dwi_profile=None,
 ):
     """Maps scalar data to a volumetric template
 
@@ -167,7 +180,14 @@ def init_scalar_to_template_wf(
         name="outputnode",
     )
     workflow = Workflow(name=name)
-    template_mapper = pe.Node(TemplateMapper(**params), name="template_mapper")
+    omp_nthreads = config.nipype.omp_nthreads
+    template_interface = TemplateMapper(num_threads=omp_nthreads, **params)
+    template_mapper = pe.Node(
+        template_interface,
+        name="template_mapper",
+        n_procs=omp_nthreads,
+        mem_gb=node_mem_gb(template_interface, dwi_profile),
+    )
 
     scalar_output_wf = init_scalar_output_wf()
     workflow.connect([
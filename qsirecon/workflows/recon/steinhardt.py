@@ -7,14 +7,17 @@ from niworkflows.engine.workflows import LiterateWorkflow as Workflow
 from ...interfaces.anatomical import CalculateSOP
 from ...interfaces.bids import DerivativesDataSink
 from ...interfaces.interchange import recon_workflow_input_fields
-from ...interfaces.mrtrix import MRConvert
 from ...utils.bids import clean_datasinks
 
 LOGGER = logging.getLogger("nipype.interface")
 
 
 def init_steinhardt_order_param_wf(
-    available_anatomical_data, name="sop_recon", qsirecon_suffix="", params={}
+    available_anatomical_data,
+    name="sop_recon",
+    qsirecon_suffix="",
+    params={},
+    dwi_profile=None,
 ):
     """Compute Steinhardt order parameters based on ODFs or FODs
 
@@ -52,9 +55,6 @@ def init_steinhardt_order_param_wf(
     desc = """Steinhardt Order Parameter Calculation:
 
 : """
-    sh_mif_to_nifti = pe.Node(
-        MRConvert(out_file="SH.nii", args="-strides -1,-2,3"), name="sh_mif_to_nifti"
-    )
     calc_sop = pe.Node(CalculateSOP(**params), name="calc_sop")
     desc += """\
 A series of Steinhardt order parameters (up to order %d) were calculated.
@@ -63,8 +63,7 @@ A series of Steinhardt order parameters (up to order %d) were calculated.
     )
 
     workflow.connect([
-        (inputnode, sh_mif_to_nifti, [('fod_sh_mif', 'in_file')]),
-        (sh_mif_to_nifti, calc_sop, [('out_file', 'sh_nifti')]),
+        (inputnode, calc_sop, [('fod_sh_mif', 'sh_nifti')]),
         (calc_sop, outputnode, [
             ('q2_file', 'q2_file'),
             ('q4_file', 'q4_file'),
@@ -42,7 +42,11 @@ CITATIONS = {
 
 
 def init_tortoise_estimator_wf(
-    available_anatomical_data, name="tortoise_recon", qsirecon_suffix="", params={}
+    available_anatomical_data,
+    name="tortoise_recon",
+    qsirecon_suffix="",
+    params={},
+    dwi_profile=None,
 ):
     """Run estimators from TORTOISE.
 
@@ -15,6 +15,7 @@ import nipype.pipeline.engine as pe
 
 from ...interfaces.bids import DerivativesDataSink
 from ...interfaces.interchange import recon_workflow_input_fields
+from ...utils.memory import node_mem_gb
 from qsirecon.interfaces import ConformDwi
 from qsirecon.interfaces.gradients import RemoveDuplicates
 from qsirecon.interfaces.mrtrix import MRTrixGradientTable
@@ -24,7 +25,11 @@ LOGGER = logging.getLogger("nipype.workflow")
 
 
 def init_conform_dwi_wf(
-    available_anatomical_data, name="conform_dwi", qsirecon_suffix="", params={}
+    available_anatomical_data,
+    name="conform_dwi",
+    qsirecon_suffix="",
+    params={},
+    dwi_profile=None,
 ):
     """If data were preprocessed elsewhere, ensure the gradients and images
     conform to LPS+ before running other parts of the pipeline."""
@@ -36,7 +41,12 @@ def init_conform_dwi_wf(
         name="outputnode",
     )
     workflow = pe.Workflow(name=name)
-    conform = pe.Node(ConformDwi(), name="conform_dwi")
+    conform_interface = ConformDwi()
+    conform = pe.Node(
+        conform_interface,
+        name="conform_dwi",
+        mem_gb=node_mem_gb(conform_interface, dwi_profile),
+    )
     grad_table = pe.Node(MRTrixGradientTable(), name="grad_table")
     workflow.connect([
         (inputnode, conform, [
@@ -60,6 +70,7 @@ def init_discard_repeated_samples_wf(
     qsirecon_suffix="",
     space="T1w",
     params={},
+    dwi_profile=None,
 ):
     """Remove a sample if a similar direction/gradient has already been sampled."""
     inputnode = pe.Node(